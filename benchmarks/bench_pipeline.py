@@ -0,0 +1,228 @@
+# PDF Comparer
+# Copyright (C) 2024 Ryan Lacadin
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Benchmark every stage of the comparison on its own and the full pipeline on the synthetic
+corpus, and report pages/sec, per-stage latency percentiles and peak memory as JSON.
+Run from the project directory:
+  python3 benchmarks/bench_pipeline.py --output result.json
+  python3 benchmarks/bench_pipeline.py --baseline result.json
+The second run compares against the first and exits with status 1 on a regression.
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+from io import BytesIO
+import numpy as np
+import pymupdf #PyMuPDF
+from PIL import Image
+
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, PROJECT_DIR)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from corpus import generate_corpus
+from image_utils import ImageUtils
+from text_comparer import TextComparer
+from page_fingerprint import PageFingerprinter
+from page_alignment import PageAligner
+from memory_budget import peak_rss_bytes
+
+# Latency percentiles reported for every stage
+PERCENTILES = (50, 90, 99)
+
+# Latencies below this in the baseline are too noisy to flag as regressions
+MIN_COMPARED_MS = 1.0
+
+def timed(latencies, stage, function, *args):
+  """Call function, recording its latency under the stage, and return its result."""
+  start = time.perf_counter()
+  result = function(*args)
+  latencies.setdefault(stage, []).append(time.perf_counter() - start)
+  return result
+
+def run_stages(old_dir, new_dir, quality, font_size):
+  """
+  Run every stage on its own over the page pairs of the corpus
+  :return: Dictionary of stage name -> latency statistics
+  """
+  image_utils = ImageUtils(quality)
+  text_comparer = TextComparer()
+  aligner = PageAligner()
+  latencies = {}
+
+  for file_name in sorted(os.listdir(old_dir)):
+    with pymupdf.open(os.path.join(old_dir, file_name)) as old_doc, pymupdf.open(os.path.join(new_dir, file_name)) as new_doc:
+      old_pages_words = timed(latencies, "extract_document", text_comparer.extract_document, old_doc)
+      new_pages_words = timed(latencies, "extract_document", text_comparer.extract_document, new_doc)
+      timed(
+        latencies, "align",
+        lambda: aligner.align(aligner.similarity(
+          aligner.signatures(old_doc, old_pages_words), aligner.signatures(new_doc, new_pages_words)
+        ))
+      )
+      old_fingerprinter = PageFingerprinter(old_doc)
+      new_fingerprinter = PageFingerprinter(new_doc)
+
+      for page_num in range(min(len(old_doc), len(new_doc))):
+        old_page, new_page = old_doc[page_num], new_doc[page_num]
+        timed(latencies, "fingerprint", lambda: (old_fingerprinter.fingerprint_page(old_page), new_fingerprinter.fingerprint_page(new_page)))
+        old_words = timed(latencies, "extract_page", text_comparer.text_extractor.extract_text, old_page)
+        new_words = timed(latencies, "extract_page", text_comparer.text_extractor.extract_text, new_page)
+        word_diffs = timed(latencies, "text_diff", text_comparer.compare_text, old_words, new_words)
+        old_array, new_array = timed(latencies, "render", image_utils.render_pages_to_arrays, old_page, new_page)
+        overlay_array = timed(latencies, "overlay", image_utils.overlay_differences_array, old_array, new_array, (170, 51, 106))
+
+        image = Image.fromarray(overlay_array if overlay_array is not None else old_array)
+        if word_diffs:
+          timed(latencies, "annotate", image_utils.annotate_text_differences, image, word_diffs, font_size * quality)
+        timed(latencies, "encode", lambda: image.save(BytesIO(), "JPEG", quality=85))
+        del old_array, new_array, overlay_array, image
+
+  return {stage: latency_stats(values) for stage, values in latencies.items()}
+
+def latency_stats(latencies):
+  """Return the count, throughput and latency percentiles in milliseconds of a stage."""
+  latencies = np.array(latencies)
+  stats = {"count": len(latencies), "per_second": len(latencies) / max(latencies.sum(), 1e-9)}
+  for percentile in PERCENTILES:
+    stats[f"p{percentile}_ms"] = float(np.percentile(latencies, percentile) * 1000)
+  return stats
+
+def run_pipeline(old_dir, new_dir, config_overrides, repeat):
+  """
+  Run pdfcomparer.py on the corpus in a scratch directory
+  :return: Dictionary of the pipeline timings and peak memory
+  """
+  with open(os.path.join(PROJECT_DIR, "config.json"), "r") as config_file:
+    config = json.load(config_file)
+  config.update(config_overrides)
+
+  page_count = 0
+  for file_name in os.listdir(new_dir):
+    with pymupdf.open(os.path.join(new_dir, file_name)) as doc:
+      page_count += len(doc)
+
+  timings = []
+  with tempfile.TemporaryDirectory() as work_dir:
+    config.update({
+      "old_documents_dir": old_dir,
+      "new_documents_dir": new_dir,
+      "output_dir": os.path.join(work_dir, "Output"),
+      "cache_dir": None,
+      "incremental": False,
+    })
+    with open(os.path.join(work_dir, "config.json"), "w") as config_file:
+      json.dump(config, config_file, indent=4)
+    font_path = os.path.join(PROJECT_DIR, "Arial.ttf")
+    if os.path.exists(font_path):
+      shutil.copy(font_path, work_dir)
+
+    for _ in range(repeat):
+      start = time.perf_counter()
+      subprocess.run(
+        [sys.executable, os.path.join(PROJECT_DIR, "pdfcomparer.py")],
+        cwd=work_dir, check=True, stdout=subprocess.DEVNULL
+      )
+      timings.append(time.perf_counter() - start)
+
+  seconds = float(np.median(timings))
+  peak_rss = peak_rss_bytes(children=True)
+  return {
+    "engine": config.get("engine", "process"),
+    "pages": page_count,
+    "seconds": seconds,
+    "pages_per_second": page_count / seconds,
+    "peak_rss_mb": peak_rss / 2**20 if peak_rss is not None else None,
+  }
+
+def flatten(result, prefix=""):
+  """Flatten nested metrics to "section.metric" keys."""
+  metrics = {}
+  for key, value in result.items():
+    if isinstance(value, dict):
+      metrics.update(flatten(value, f"{prefix}{key}."))
+    elif isinstance(value, (int, float)) and not isinstance(value, bool):
+      metrics[f"{prefix}{key}"] = value
+  return metrics
+
+def compare_to_baseline(result, baseline, tolerance):
+  """
+  Print how every metric moved against the baseline
+  :return: List of the metrics that regressed by more than the tolerance
+  """
+  current, previous = flatten(result), flatten(baseline)
+  regressions = []
+  print(f"{'metric':<40} {'baseline':>12} {'current':>12} {'change':>8}")
+  for metric in sorted(current.keys() & previous.keys()):
+    if metric == "quality" or metric.endswith("count") or metric.endswith("pages") or not previous[metric]:
+      continue
+    change = current[metric] / previous[metric] - 1
+    if metric.endswith("per_second"):
+      regressed = -change > tolerance
+    else:
+      regressed = change > tolerance and not (metric.endswith("_ms") and previous[metric] < MIN_COMPARED_MS)
+    if regressed:
+      regressions.append(metric)
+    flag = "  REGRESSION" if regressed else ""
+    print(f"{metric:<40} {previous[metric]:>12.2f} {current[metric]:>12.2f} {change:>+7.1%}{flag}")
+  return regressions
+
+def main():
+  parser = argparse.ArgumentParser(description="Benchmark the comparison stages and pipeline on a synthetic corpus.")
+  parser.add_argument("--corpus", help="Corpus directory, generated if missing (default: a temporary directory)")
+  parser.add_argument("--pages", type=int, default=12, help="Pages per corpus document")
+  parser.add_argument("--quality", type=float, default=2.0, help="Render zoom factor")
+  parser.add_argument("--engine", choices=("process", "thread"), default="process")
+  parser.add_argument("--repeat", type=int, default=3, help="Pipeline runs, the median is reported")
+  parser.add_argument("--skip-pipeline", action="store_true", help="Only benchmark the stages")
+  parser.add_argument("--output", help="Write the result JSON to this file")
+  parser.add_argument("--baseline", help="Result JSON of an earlier run to compare against")
+  parser.add_argument("--tolerance", type=float, default=0.1, help="Relative change reported as a regression")
+  args = parser.parse_args()
+
+  with tempfile.TemporaryDirectory() as scratch_dir:
+    corpus_dir = args.corpus or scratch_dir
+    old_dir, new_dir = os.path.join(corpus_dir, "Old_Documents"), os.path.join(corpus_dir, "New_Documents")
+    if not os.path.isdir(old_dir):
+      generate_corpus(corpus_dir, args.pages)
+    old_dir, new_dir = os.path.abspath(old_dir), os.path.abspath(new_dir)
+
+    result = {"quality": args.quality, "stages": run_stages(old_dir, new_dir, args.quality, font_size=8)}
+    peak_rss = peak_rss_bytes()
+    result["stages_peak_rss_mb"] = peak_rss / 2**20 if peak_rss is not None else None
+    if not args.skip_pipeline:
+      result["pipeline"] = run_pipeline(old_dir, new_dir, {"quality": args.quality, "engine": args.engine}, args.repeat)
+
+  print(json.dumps(result, indent=2))
+  if args.output:
+    with open(args.output, "w") as output_file:
+      json.dump(result, output_file, indent=2)
+
+  if args.baseline:
+    with open(args.baseline, "r") as baseline_file:
+      regressions = compare_to_baseline(result, json.load(baseline_file), args.tolerance)
+    if regressions:
+      print(f"{len(regressions)} metrics regressed by more than {args.tolerance:.0%}")
+      sys.exit(1)
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,81 @@
+# PDF Comparer
+# Copyright (C) 2024 Ryan Lacadin
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Compare the word diff engine with difflib.ndiff on synthetic dense pages.
+Run from the project directory: python3 benchmarks/bench_token_diff.py
+"""
+
+import os
+import sys
+import time
+import random
+import difflib
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from token_diff import intern_tokens, diff_opcodes
+
+def make_page(word_count, seed):
+  """Build a dense page of prose mixed with table cells full of repeated numbers."""
+  rng = random.Random(seed)
+  vocabulary = [f"word{i}" for i in range(400)]
+  words = []
+  while len(words) < word_count:
+    if rng.random() < 0.5:
+      words.extend(rng.choice(vocabulary) for _ in range(12))
+    else:
+      words.extend(str(rng.randint(0, 20)) for _ in range(12))
+  return words[:word_count]
+
+def edit_page(words, edit_count, seed, rewrite=False):
+  """Apply random substitutions, insertions and deletions, or rewrite whole passages."""
+  rng = random.Random(seed)
+  edited = list(words)
+  if rewrite:
+    for _ in range(edit_count):
+      position = rng.randrange(len(edited))
+      edited[position:position + 200] = make_page(200, rng.randint(0, 10 ** 6))
+    return edited
+  for _ in range(edit_count):
+    position = rng.randrange(len(edited))
+    choice = rng.random()
+    if choice < 0.4:
+      edited[position] = f"edit{rng.randint(0, 99)}"
+    elif choice < 0.7:
+      edited.insert(position, f"new{rng.randint(0, 99)}")
+    else:
+      del edited[position]
+  return edited
+
+def time_call(function):
+  start = time.perf_counter()
+  result = function()
+  return time.perf_counter() - start, result
+
+def main():
+  print(f"{'words':>7} {'edits':>16} {'ndiff (s)':>10} {'token diff (s)':>15} {'speedup':>8}")
+  for word_count in (1000, 5000, 10000):
+    for edit_count, rewrite in ((5, False), (50, False), (2, True), (5, True)):
+      old_words = make_page(word_count, word_count)
+      new_words = edit_page(old_words, edit_count, edit_count, rewrite)
+      edits = f"{edit_count} {'passages' if rewrite else 'words'}"
+
+      ndiff_time, _ = time_call(lambda: list(difflib.ndiff(old_words, new_words)))
+      token_time, _ = time_call(lambda: diff_opcodes(*intern_tokens(old_words, new_words)))
+      print(f"{word_count:>7} {edits:>16} {ndiff_time:>10.3f} {token_time:>15.4f} {ndiff_time / token_time:>7.0f}x")
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,184 @@
+# PDF Comparer
+# Copyright (C) 2024 Ryan Lacadin
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Generate a deterministic corpus of old and new PDF documents for benchmarking.
+Every document pair covers one kind of page and one kind of edit, and the same
+arguments always produce the same pages.
+Run from the project directory: python3 benchmarks/corpus.py <corpus_dir> [--pages N]
+"""
+
+import os
+import random
+import argparse
+from io import BytesIO
+import numpy as np
+import pymupdf #PyMuPDF
+from PIL import Image
+
+# Page geometry of the regular and the large format documents, in points
+A4 = (595, 842)
+A0 = (2384, 3370)
+MARGIN = 50
+LINE_HEIGHT = 15
+FONT_SIZE = 10
+WORDS_PER_LINE = 12
+
+VOCABULARY = (
+  "the of and to in is that for it as with was on be by at this from or have an are which "
+  "contract clause party shall agreement payment notice term period date section schedule "
+  "amount total invoice delivery service provider customer liability warranty 1 2 3 4 5 10 "
+  "20 50 100 2024 2025 USD EUR per cent annual monthly review approved pending final draft"
+).split()
+
+# Document pairs of the corpus: name -> (page kind, edit)
+DOCUMENTS = {
+  "text_word_substitution": ("text", "word_substitution"),
+  "text_paragraph_insertion": ("text", "paragraph_insertion"),
+  "text_page_insertion": ("text", "page_insertion"),
+  "image_swap": ("image", "image_swap"),
+  "vector_edit": ("vector", "vector_edit"),
+  "large_format_edit": ("large", "word_substitution"),
+  "text_identical": ("text", None),
+}
+
+def make_lines(line_count, seed):
+  """Return deterministic lines of text."""
+  rng = random.Random(seed)
+  return [" ".join(rng.choice(VOCABULARY) for _ in range(WORDS_PER_LINE)) for _ in range(line_count)]
+
+def make_image(seed, size=(320, 240)):
+  """Return the PNG bytes of a deterministic image of smooth gradients and noise."""
+  rng = np.random.default_rng(seed)
+  y, x = np.mgrid[0:size[1], 0:size[0]]
+  channels = [
+    np.sin(x / rng.uniform(10, 60) + rng.uniform(0, 6)) + np.cos(y / rng.uniform(10, 60))
+    for _ in range(3)
+  ]
+  pixels = np.stack(channels, axis=2) * 60 + 128 + rng.normal(0, 12, (size[1], size[0], 3))
+  buffer = BytesIO()
+  Image.fromarray(np.clip(pixels, 0, 255).astype(np.uint8)).save(buffer, "PNG")
+  return buffer.getvalue()
+
+def lines_per_page(page_size):
+  """Return the number of text lines that fit on a page."""
+  return int((page_size[1] - 2 * MARGIN) // LINE_HEIGHT)
+
+def write_text_pages(doc, lines, page_size, font_size=FONT_SIZE):
+  """Lay out lines of text over as many pages as they need."""
+  per_page = lines_per_page(page_size)
+  for start in range(0, len(lines), per_page):
+    page = doc.new_page(width=page_size[0], height=page_size[1])
+    for row, line in enumerate(lines[start:start + per_page]):
+      page.insert_text((MARGIN, MARGIN + (row + 1) * LINE_HEIGHT), line, fontsize=font_size)
+
+def write_image_page(doc, page_num, image_seeds):
+  """Write a page of captioned images in a grid."""
+  page = doc.new_page(width=A4[0], height=A4[1])
+  for slot, seed in enumerate(image_seeds):
+    column, row = slot % 2, slot // 2
+    rect = pymupdf.Rect(MARGIN + column * 255, MARGIN + row * 240, MARGIN + column * 255 + 240, MARGIN + row * 240 + 180)
+    page.insert_image(rect, stream=make_image(seed))
+    page.insert_text((rect.x0, rect.y1 + 14), f"Figure {page_num + 1}.{slot + 1}", fontsize=FONT_SIZE)
+
+def write_vector_page(doc, page_num, moved_shape=None):
+  """Write a page of deterministic line art, optionally moving one shape."""
+  page = doc.new_page(width=A4[0], height=A4[1])
+  rng = random.Random(page_num)
+  shape = page.new_shape()
+  for index in range(150):
+    x, y = rng.uniform(MARGIN, A4[0] - MARGIN), rng.uniform(MARGIN, A4[1] - MARGIN)
+    if index == moved_shape:
+      x, y = x + 20, y + 20
+    kind = index % 3
+    if kind == 0:
+      shape.draw_line((x, y), (x + rng.uniform(-60, 60), y + rng.uniform(-60, 60)))
+    elif kind == 1:
+      shape.draw_rect(pymupdf.Rect(x, y, x + rng.uniform(5, 40), y + rng.uniform(5, 40)))
+    else:
+      shape.draw_circle((x, y), rng.uniform(3, 20))
+    shape.finish(color=(rng.random(), rng.random(), rng.random()), width=rng.uniform(0.5, 2))
+  shape.commit()
+
+def substitute_words(lines, count, seed):
+  """Replace one word on each of count evenly spread lines."""
+  rng = random.Random(seed)
+  edited = list(lines)
+  for line_num in range(0, len(lines), max(1, len(lines) // count))[:count]:
+    words = edited[line_num].split()
+    words[rng.randrange(len(words))] = "SUBSTITUTED"
+    edited[line_num] = " ".join(words)
+  return edited
+
+def build_document(kind, edit, page_count, new):
+  """Build the old or new document of a pair."""
+  doc = pymupdf.open()
+  if kind in ("text", "large"):
+    page_size = A0 if kind == "large" else A4
+    lines = make_lines(lines_per_page(page_size) * page_count, seed=page_count)
+    if new and edit == "word_substitution":
+      lines = substitute_words(lines, count=3, seed=1)
+    elif new and edit == "paragraph_insertion":
+      middle = len(lines) // 3
+      lines = lines[:middle] + make_lines(6, seed=10 ** 6) + lines[middle:]
+    elif new and edit == "page_insertion":
+      middle = lines_per_page(page_size) * (page_count // 2)
+      lines = lines[:middle] + make_lines(lines_per_page(page_size), seed=10 ** 6 + 1) + lines[middle:]
+    write_text_pages(doc, lines, page_size)
+  elif kind == "image":
+    for page_num in range(page_count):
+      seeds = [page_num * 10 + slot for slot in range(6)]
+      if new and edit == "image_swap" and page_num == page_count // 2:
+        seeds[2] = 10 ** 6
+      write_image_page(doc, page_num, seeds)
+  elif kind == "vector":
+    for page_num in range(page_count):
+      moved = 7 if new and edit == "vector_edit" and page_num == page_count // 2 else None
+      write_vector_page(doc, page_num, moved)
+  return doc
+
+def generate_corpus(corpus_dir, page_count=12, large_page_count=2):
+  """
+  Write the old and new documents of every corpus pair
+  :param corpus_dir: Directory the Old_Documents and New_Documents folders are created in
+  :param page_count: Pages per document
+  :param large_page_count: Pages of the large format document
+  :return: (old documents directory, new documents directory)
+  """
+  old_dir = os.path.join(corpus_dir, "Old_Documents")
+  new_dir = os.path.join(corpus_dir, "New_Documents")
+  os.makedirs(old_dir, exist_ok=True)
+  os.makedirs(new_dir, exist_ok=True)
+  for name, (kind, edit) in DOCUMENTS.items():
+    pages = large_page_count if kind == "large" else page_count
+    for directory, new in ((old_dir, False), (new_dir, True)):
+      doc = build_document(kind, edit, pages, new)
+      doc.set_metadata({})
+      doc.save(os.path.join(directory, f"{name}.pdf"), garbage=3, deflate=True, no_new_id=True)
+      doc.close()
+  return old_dir, new_dir
+
+def main():
+  parser = argparse.ArgumentParser(description="Generate the synthetic benchmark corpus.")
+  parser.add_argument("corpus_dir")
+  parser.add_argument("--pages", type=int, default=12, help="Pages per document")
+  parser.add_argument("--large-pages", type=int, default=2, help="Pages of the large format document")
+  args = parser.parse_args()
+  generate_corpus(args.corpus_dir, args.pages, args.large_pages)
+  print(f"Wrote {len(DOCUMENTS)} document pairs to {args.corpus_dir}")
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,147 @@
+# PDF Comparer
+# Copyright (C) 2024 Ryan Lacadin
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import numpy as np
+
+def grid_runs(grid):
+  """
+  Return the horizontal runs of set cells of a boolean grid, in row-major order
+  :return: (rows, starts, ends) arrays, ends exclusive
+  """
+  padded = np.zeros((grid.shape[0], grid.shape[1] + 2), dtype=np.int8)
+  padded[:, 1:-1] = grid
+  edges = np.diff(padded, axis=1)
+  rows, starts = np.nonzero(edges == 1)
+  _, ends = np.nonzero(edges == -1)
+  return rows, starts, ends
+
+def label_runs(rows, starts, ends, width):
+  """
+  Group runs into 8-connected components: runs on neighbouring rows whose spans overlap or
+  touch diagonally are joined, by propagating the smallest run index over the joins.
+  :param width: Row length of the grid the runs were taken from
+  :return: Component index of every run, numbered from 0
+  """
+  run_count = len(rows)
+  if not run_count:
+    return np.zeros(0, dtype=np.intp)
+
+  # Runs are sorted by row and start, so the runs of the next row that touch a run form one
+  # contiguous range, found for every run at once
+  start_keys = rows * (width + 1) + starts
+  end_keys = rows * (width + 1) + ends
+  first = np.searchsorted(end_keys, (rows + 1) * (width + 1) + starts, side="left")
+  last = np.searchsorted(start_keys, (rows + 1) * (width + 1) + ends, side="right")
+  counts = np.maximum(last - first, 0)
+  upper = np.repeat(np.arange(run_count), counts)
+  lower = np.repeat(first, counts) + np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+
+  labels = np.arange(run_count)
+  while True:
+    previous = labels
+    joined = np.minimum(labels[upper], labels[lower])
+    labels = labels.copy()
+    np.minimum.at(labels, upper, joined)
+    np.minimum.at(labels, lower, joined)
+    labels = labels[labels]
+    if np.array_equal(labels, previous):
+      break
+  return np.unique(labels, return_inverse=True)[1]
+
+def find_regions(mask, merge_distance=1, min_pixels=1):
+  """
+  Find the boxes of the connected regions of set pixels in a boolean mask. Pixels are grouped
+  into cells of merge_distance pixels first, so regions closer than that are merged into one.
+  :param mask: Boolean (height, width) array
+  :param merge_distance: Cell size in pixels, regions at most this far apart are merged
+  :param min_pixels: Regions with fewer set pixels in their box are dropped as speckles
+  :return: List of (x0, y0, x1, y1) pixel boxes, ends exclusive, from top to bottom
+  """
+  height, width = mask.shape
+  cell = max(1, int(merge_distance))
+  rows, cols = -(-height // cell), -(-width // cell)
+  padded = np.zeros((rows * cell, cols * cell), dtype=bool)
+  padded[:height, :width] = mask
+  # Reducing one axis at a time is several times faster than any(axis=(1, 3))
+  grid = np.logical_or.reduce(padded.reshape(rows, cell, cols * cell), axis=1)
+  grid = np.logical_or.reduce(grid.reshape(rows, cols, cell), axis=2)
+
+  run_rows, run_starts, run_ends = grid_runs(grid)
+  labels = label_runs(run_rows, run_starts, run_ends, cols)
+  if not len(labels):
+    return []
+
+  # Cell boxes of the components, reduced from their runs
+  component_count = labels.max() + 1
+  boxes = np.empty((component_count, 4), dtype=np.int64)
+  boxes[:, :2] = np.iinfo(np.int64).max
+  boxes[:, 2:] = 0
+  np.minimum.at(boxes[:, 0], labels, run_starts)
+  np.minimum.at(boxes[:, 1], labels, run_rows)
+  np.maximum.at(boxes[:, 2], labels, run_ends)
+  np.maximum.at(boxes[:, 3], labels, run_rows + 1)
+
+  # Tighten the cell boxes to the set pixels inside them, dropping boxes with too few
+  regions = []
+  for x0, y0, x1, y1 in boxes.tolist():
+    x0, y0, x1, y1 = x0 * cell, y0 * cell, min(width, x1 * cell), min(height, y1 * cell)
+    window = mask[y0:y1, x0:x1]
+    if min_pixels > 1 and np.count_nonzero(window) < min_pixels:
+      continue
+    set_rows = np.flatnonzero(window.any(axis=1))
+    set_cols = np.flatnonzero(window.any(axis=0))
+    regions.append((x0 + int(set_cols[0]), y0 + int(set_rows[0]), x0 + int(set_cols[-1]) + 1, y0 + int(set_rows[-1]) + 1))
+  regions.sort(key=lambda box: (box[1], box[0]))
+  return regions
+
+def merge_boxes(boxes, merge_distance, shape):
+  """
+  Merge boxes that overlap or lie within merge_distance pixels of each other, by labeling the
+  grid of cells they cover
+  :param boxes: (x0, y0, x1, y1) pixel boxes, clipped to the image
+  :param shape: (height, width) of the image the boxes lie in
+  :return: List of merged (x0, y0, x1, y1) pixel boxes from top to bottom
+  """
+  height, width = shape
+  boxes = np.clip(np.asarray(boxes, dtype=np.int64).reshape(-1, 4), 0, [width, height, width, height])
+  boxes = boxes[(boxes[:, 2] > boxes[:, 0]) & (boxes[:, 3] > boxes[:, 1])]
+  if not len(boxes):
+    return []
+
+  cell = max(1, int(merge_distance))
+  cols = -(-width // cell)
+  cells = np.concatenate((boxes[:, :2] // cell, -(-boxes[:, 2:] // cell)), axis=1)
+  grid = np.zeros((-(-height // cell), cols), dtype=bool)
+  for x0, y0, x1, y1 in cells.tolist():
+    grid[y0:y1, x0:x1] = True
+
+  run_rows, run_starts, run_ends = grid_runs(grid)
+  labels = label_runs(run_rows, run_starts, run_ends, cols)
+  # Every box belongs to the component of the run holding its top left cell
+  start_keys = run_rows * (cols + 1) + run_starts
+  runs = np.searchsorted(start_keys, cells[:, 1] * (cols + 1) + cells[:, 0], side="right") - 1
+  components = labels[runs]
+
+  merged = np.empty((labels.max() + 1, 4), dtype=np.int64)
+  merged[:, :2] = np.iinfo(np.int64).max
+  merged[:, 2:] = 0
+  np.minimum.at(merged[:, 0], components, boxes[:, 0])
+  np.minimum.at(merged[:, 1], components, boxes[:, 1])
+  np.maximum.at(merged[:, 2], components, boxes[:, 2])
+  np.maximum.at(merged[:, 3], components, boxes[:, 3])
+  regions = [tuple(box) for box in merged[merged[:, 2] > 0].tolist()]
+  regions.sort(key=lambda box: (box[1], box[0]))
+  return regions
@@ -0,0 +1,173 @@
+# PDF Comparer
+# Copyright (C) 2024 Ryan Lacadin
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from bisect import bisect_left
+import numpy as np
+from token_diff import diff_opcodes
+from text_comparer import WordDiffs, ADDED, REMOVED
+
+# Number of words hashed into each anchor
+ANCHOR_LENGTH = 8
+
+# Multiplier of the polynomial rolling hash, arithmetic wraps modulo 2**64
+HASH_BASE = np.uint64(1000003)
+
+def rolling_hashes(ids, length=ANCHOR_LENGTH):
+  """Return the polynomial hash of every run of `length` consecutive ids."""
+  count = len(ids) - length + 1
+  if count <= 0:
+    return np.zeros(0, dtype=np.uint64)
+  ids = ids.astype(np.uint64)
+  hashes = np.zeros(count, dtype=np.uint64)
+  with np.errstate(over="ignore"):
+    for offset in range(length):
+      hashes = hashes * HASH_BASE + ids[offset:offset + count]
+  return hashes
+
+def unique_positions(hashes):
+  """Return the hashes that occur exactly once and their positions."""
+  values, first, counts = np.unique(hashes, return_index=True, return_counts=True)
+  unique = counts == 1
+  return values[unique], first[unique]
+
+def find_anchor_runs(old_ids, new_ids):
+  """
+  Find runs of ANCHOR_LENGTH words that occur exactly once in each stream, join anchors that
+  follow each other in both streams into longer runs, and keep the longest chain of runs
+  whose positions increase in both.
+  :return: List of (old_position, new_position, length) runs in stream order
+  """
+  old_values, old_positions = unique_positions(rolling_hashes(old_ids))
+  new_values, new_positions = unique_positions(rolling_hashes(new_ids))
+  _, old_index, new_index = np.intersect1d(old_values, new_values, assume_unique=True, return_indices=True)
+  order = np.argsort(old_positions[old_index], kind="stable")
+  old_anchors = old_positions[old_index][order]
+  new_anchors = new_positions[new_index][order]
+  if not len(old_anchors):
+    return []
+
+  breaks = np.flatnonzero((np.diff(old_anchors) != 1) | (np.diff(new_anchors) != 1)) + 1
+  starts = np.concatenate(([0], breaks))
+  lengths = np.diff(np.concatenate((starts, [len(old_anchors)]))) + ANCHOR_LENGTH - 1
+  runs = list(zip(old_anchors[starts].tolist(), new_anchors[starts].tolist(), lengths.tolist()))
+
+  # Longest increasing subsequence of the new positions (patience sorting)
+  tails, tail_runs, previous = [], [], []
+  for index, (_, new_position, _) in enumerate(runs):
+    slot = bisect_left(tails, new_position)
+    previous.append(tail_runs[slot - 1] if slot else -1)
+    if slot == len(tails):
+      tails.append(new_position)
+      tail_runs.append(index)
+    else:
+      tails[slot] = new_position
+      tail_runs[slot] = index
+
+  chain = []
+  index = tail_runs[-1] if tail_runs else -1
+  while index >= 0:
+    chain.append(runs[index])
+    index = previous[index]
+  return chain[::-1]
+
+def anchored_opcodes(old_ids, new_ids):
+  """
+  Diff two long word id streams: unique rolling-hash anchors split them into short gaps,
+  and only the gaps are diffed word by word.
+  :return: List of (tag, i1, i2, j1, j2) opcodes
+  """
+  # Clip the anchor runs so they do not overlap, and verify them against hash collisions
+  blocks = []
+  old_end = new_end = 0
+  for old_position, new_position, length in find_anchor_runs(old_ids, new_ids):
+    shift = max(old_end - old_position, new_end - new_position, 0)
+    if shift >= length:
+      continue
+    old_start, new_start = old_position + shift, new_position + shift
+    length -= shift
+    if not np.array_equal(old_ids[old_start:old_start + length], new_ids[new_start:new_start + length]):
+      continue
+    blocks.append((old_start, new_start, length))
+    old_end, new_end = old_start + length, new_start + length
+
+  opcodes = []
+  old_lo = new_lo = 0
+  for old_start, new_start, length in blocks + [(len(old_ids), len(new_ids), 0)]:
+    gap = diff_opcodes(old_ids[old_lo:old_start].tolist(), new_ids[new_lo:new_start].tolist())
+    opcodes.extend((tag, i1 + old_lo, i2 + old_lo, j1 + new_lo, j2 + new_lo) for tag, i1, i2, j1, j2 in gap)
+    if length:
+      opcodes.append(("equal", old_start, old_start + length, new_start, new_start + length))
+    old_lo, new_lo = old_start + length, new_start + length
+  return opcodes
+
+class DocumentDiff:
+  """
+  Word diff of two whole documents, projected back onto the pages of each side.
+  Because the word streams are diffed once, text that reflows onto another page after an
+  insertion is matched instead of being reported as removed and added on every later page.
+  """
+
+  def __init__(self, old_pages, new_pages):
+    """
+    :param old_pages: PageWords of every old page, extracted with one vocabulary
+    :param new_pages: PageWords of every new page
+    """
+    if old_pages:
+      new_pages = [page_words.with_vocabulary(old_pages[0].vocabulary) for page_words in new_pages]
+    self.old_pages = old_pages
+    self.new_pages = new_pages
+    self.removed = [[] for _ in old_pages]
+    self.added = [[] for _ in new_pages]
+
+    old_ids = np.concatenate([page.ids for page in old_pages] + [np.zeros(0, dtype=np.int32)])
+    new_ids = np.concatenate([page.ids for page in new_pages] + [np.zeros(0, dtype=np.int32)])
+    old_starts = np.cumsum([0] + [len(page) for page in old_pages])
+    new_starts = np.cumsum([0] + [len(page) for page in new_pages])
+
+    for order, (tag, i1, i2, j1, j2) in enumerate(anchored_opcodes(old_ids, new_ids)):
+      if tag in ("delete", "replace"):
+        self.project(order, REMOVED, i1, i2, old_starts, self.removed)
+      if tag in ("insert", "replace"):
+        self.project(order, ADDED, j1, j2, new_starts, self.added)
+
+  def project(self, order, sign, start, end, page_starts, segments_by_page):
+    """Split a stream range over the pages it spans, as page-local segments."""
+    page = int(np.searchsorted(page_starts, start, side="right")) - 1
+    while start < end:
+      page_end = min(end, int(page_starts[page + 1]))
+      if page_end > start:
+        local = slice(start - int(page_starts[page]), page_end - int(page_starts[page]))
+        segments_by_page[page].append((order, sign, local))
+      start = page_end
+      page += 1
+
+  def page_word_diffs(self, old_page_num, new_page_num):
+    """Return the WordDiffs of a page pair: words removed from the old page and added to the new one."""
+    segments = sorted(
+      [(order, sign, self.old_pages[old_page_num], local) for order, sign, local in self.removed[old_page_num]]
+      + [(order, sign, self.new_pages[new_page_num], local) for order, sign, local in self.added[new_page_num]],
+      key=lambda segment: segment[0]
+    )
+    return WordDiffs.from_segments(
+      [(sign, page_words, local) for _, sign, page_words, local in segments],
+      self.old_pages[old_page_num].vocabulary
+    )
+
+  def is_reflowed(self, old_page_num, new_page_num):
+    """Return True if a page pair has no word changes but its words moved to or from other pages."""
+    if self.removed[old_page_num] or self.added[new_page_num]:
+      return False
+    return not np.array_equal(self.old_pages[old_page_num].ids, self.new_pages[new_page_num].ids)
@@ -0,0 +1,251 @@
+# PDF Comparer
+# Copyright (C) 2024 Ryan Lacadin
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import re
+import zlib
+import json
+import pickle
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+
+# MinHash permutations of the first page shingles, checked for candidates in LSH bands of
+# BAND_ROWS rows. Pages whose shingles overlap by about half share a band.
+MINHASH_PERMUTATIONS = 64
+BAND_ROWS = 4
+MINHASH_SEEDS = np.random.default_rng(20240229).integers(0, 1 << 63, MINHASH_PERMUTATIONS, dtype=np.uint64)
+
+# Words per shingle of the first page text
+SHINGLE_WORDS = 3
+
+# The thumbnail hash is looked up by its four 16 bit chunks, so hashes up to three bits
+# apart always share a bucket
+THUMBNAIL_CHUNKS = 4
+
+# Pixel size the first page is rendered at for its thumbnail hash, whatever its aspect
+THUMBNAIL_SIZE = (36, 32)
+
+# Buckets holding more documents than this, such as those of a blank first page or a
+# shared cover sheet, tell documents apart too poorly to propose candidates from
+MAX_BUCKET_SIZE = 64
+
+# Signatures extracted in the calling process below this many documents
+PARALLEL_MIN_DOCUMENTS = 32
+
+WORD_PATTERN = re.compile(r"\w+")
+
+DocumentSignature = namedtuple("DocumentSignature", "title creator page_count page_size minhash thumbnail")
+
+def document_signature(file_path):
+  """
+  Return the DocumentSignature of a PDF file from its metadata and first page, or None if
+  it cannot be read
+  """
+  import pymupdf #PyMuPDF
+  try:
+    with pymupdf.open(file_path) as doc:
+      metadata = doc.metadata or {}
+      title = (metadata.get("title") or "").strip().lower()
+      creator = (metadata.get("creator") or "").strip().lower()
+      if not doc.page_count:
+        return DocumentSignature(title, creator, 0, None, None, None)
+      page = doc[0]
+      words = WORD_PATTERN.findall(page.get_text().lower())
+      # Rendered a little larger than the thumbnail, whatever the rounding of the page size
+      matrix = pymupdf.Matrix((THUMBNAIL_SIZE[0] + 0.5) / page.rect.width, (THUMBNAIL_SIZE[1] + 0.5) / page.rect.height)
+      pix = page.get_pixmap(matrix=matrix, colorspace=pymupdf.csGRAY, alpha=False)
+      return DocumentSignature(
+        title,
+        creator,
+        doc.page_count,
+        (round(page.rect.width), round(page.rect.height)),
+        minhash(words),
+        thumbnail_hash(pix),
+      )
+  except Exception as e:
+    print(f"Cannot index {file_path}: {e}")
+    return None
+
+def minhash(words):
+  """Return the MinHash of the word shingles of a text as a tuple, or None for a text without words."""
+  if not words:
+    return None
+  count = max(len(words) - SHINGLE_WORDS + 1, 1)
+  shingles = {" ".join(words[index:index + SHINGLE_WORDS]) for index in range(count)}
+  values = np.fromiter((zlib.crc32(shingle.encode()) for shingle in shingles), dtype=np.uint64, count=len(shingles))
+  # One seeded 64 bit mix function per permutation, relying on the wrap around of uint64
+  hashes = values[:, None] ^ MINHASH_SEEDS
+  hashes *= np.uint64(0xBF58476D1CE4E5B9)
+  hashes ^= hashes >> np.uint64(31)
+  hashes *= np.uint64(0x94D049BB133111EB)
+  hashes ^= hashes >> np.uint64(29)
+  return tuple(hashes.min(axis=0).tolist())
+
+def thumbnail_hash(pix):
+  """Return the 64 bit difference hash of a grayscale thumbnail Pixmap, from its 9x8 cell averages."""
+  width, height = THUMBNAIL_SIZE
+  samples = np.frombuffer(pix.samples, dtype=np.uint8).reshape(pix.height, pix.stride)[:height, :width]
+  cells = samples.reshape(8, height // 8, 9, width // 9).mean(axis=(1, 3))
+  bits = (cells[:, 1:] > cells[:, :-1]).flatten()
+  return int(sum(1 << index for index, bit in enumerate(bits) if bit))
+
+def similarity(old, new):
+  """
+  Score how likely two DocumentSignatures are of versions of the same document
+  :return: Confidence between 0 and 1
+  """
+  page_score = min(old.page_count, new.page_count) / max(old.page_count, new.page_count, 1)
+  thumbnail_score = 0
+  if old.thumbnail is not None and new.thumbnail is not None:
+    thumbnail_score = 1 - bin(old.thumbnail ^ new.thumbnail).count("1") / 64
+  metadata_score = 0.5 * bool(old.title and old.title == new.title) + 0.5 * bool(old.creator and old.creator == new.creator)
+  if old.page_size != new.page_size:
+    page_score /= 2
+
+  if old.minhash and new.minhash:
+    text_score = sum(a == b for a, b in zip(old.minhash, new.minhash)) / MINHASH_PERMUTATIONS
+    return 0.6 * text_score + 0.2 * thumbnail_score + 0.1 * page_score + 0.1 * metadata_score
+  if old.minhash or new.minhash:
+    return 0 # Only one of them has text on its first page
+  # Scans and drawings without text are only told apart by their looks
+  return 0.6 * thumbnail_score + 0.2 * page_score + 0.2 * metadata_score
+
+def bucket_keys(signature):
+  """Return the LSH buckets a DocumentSignature is filed under."""
+  keys = []
+  if signature.minhash:
+    for band in range(0, MINHASH_PERMUTATIONS, BAND_ROWS):
+      keys.append(("text", band, signature.minhash[band:band + BAND_ROWS]))
+  elif signature.thumbnail is not None:
+    # Documents without text fall back to their thumbnails
+    for chunk in range(THUMBNAIL_CHUNKS):
+      keys.append(("thumbnail", chunk, (signature.thumbnail >> (16 * chunk)) & 0xFFFF))
+  if signature.title:
+    keys.append(("title", signature.title))
+  return keys
+
+class DocumentIndex:
+  """
+  Signatures of the documents of a directory, optionally kept in an index file between runs
+  so only new and changed files are read again.
+  """
+
+  def __init__(self, index_file=None, workers=1):
+    """
+    :param index_file: Optional path of the index file of earlier runs.
+    :param workers: Processes signatures are extracted with.
+    """
+    self.index_file = index_file
+    self.workers = workers
+    self.entries = {} # File path -> (size, mtime_ns, DocumentSignature)
+    if index_file and os.path.exists(index_file):
+      try:
+        with open(index_file, "rb") as file:
+          self.entries = pickle.load(file)
+      except Exception as e:
+        print(f"Ignoring unreadable pairing index {index_file}: {e}")
+
+  def signatures(self, file_paths):
+    """Return a dictionary of file path -> DocumentSignature, leaving out unreadable files."""
+    states = {}
+    missing = []
+    for file_path in file_paths:
+      stat = os.stat(file_path)
+      states[file_path] = (stat.st_size, stat.st_mtime_ns)
+      entry = self.entries.get(file_path)
+      if entry is None or entry[:2] != states[file_path]:
+        missing.append(file_path)
+
+    if len(missing) >= PARALLEL_MIN_DOCUMENTS and self.workers > 1:
+      with ProcessPoolExecutor(max_workers=self.workers) as executor:
+        signatures = list(executor.map(document_signature, missing, chunksize=16))
+    else:
+      signatures = [document_signature(file_path) for file_path in missing]
+    for file_path, signature in zip(missing, signatures):
+      self.entries[file_path] = states[file_path] + (signature,)
+
+    return {
+      file_path: self.entries[file_path][2] for file_path in file_paths if self.entries[file_path][2] is not None
+    }
+
+  def save(self):
+    """Write the index file, if there is one."""
+    if not self.index_file:
+      return
+    os.makedirs(os.path.dirname(os.path.abspath(self.index_file)), exist_ok=True)
+    with open(self.index_file + ".part", "wb") as file:
+      pickle.dump(self.entries, file, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(self.index_file + ".part", self.index_file)
+
+def match_documents(old_signatures, new_signatures, threshold):
+  """
+  Pair old and new documents by their signatures. Candidates are only scored when they share
+  an LSH bucket, so the work grows with the number of documents rather than its square, and
+  the best scoring candidates are paired first.
+  :param old_signatures: Dictionary of old file path -> DocumentSignature
+  :param new_signatures: Dictionary of new file path -> DocumentSignature
+  :param threshold: Lowest confidence a pair is made with.
+  :return: List of (old_file_path, new_file_path, confidence) tuples
+  """
+  buckets = {}
+  for new_path, signature in new_signatures.items():
+    for key in bucket_keys(signature):
+      buckets.setdefault(key, []).append(new_path)
+
+  candidates = []
+  for old_path, signature in old_signatures.items():
+    scored = set()
+    for key in bucket_keys(signature):
+      bucket = buckets.get(key, ())
+      if len(bucket) > MAX_BUCKET_SIZE:
+        continue
+      for new_path in bucket:
+        if new_path in scored:
+          continue
+        scored.add(new_path)
+        confidence = similarity(signature, new_signatures[new_path])
+        if confidence >= threshold:
+          candidates.append((confidence, old_path, new_path))
+
+  pairs = []
+  paired_old = set()
+  paired_new = set()
+  for confidence, old_path, new_path in sorted(candidates, key=lambda candidate: -candidate[0]):
+    if old_path in paired_old or new_path in paired_new:
+      continue
+    paired_old.add(old_path)
+    paired_new.add(new_path)
+    pairs.append((old_path, new_path, round(confidence, 3)))
+  return pairs
+
+def write_pairing_report(report_path, pairs, unpaired_old, unpaired_new):
+  """
+  Write the pairing report as JSON
+  :param pairs: List of (old_file_path, new_file_path, confidence, method) tuples
+  :param unpaired_old: Old file paths without a new version
+  :param unpaired_new: New file paths without an old version
+  """
+  report = {
+    "pairs": [
+      {"old": old_path, "new": new_path, "confidence": confidence, "method": method}
+      for old_path, new_path, confidence, method in pairs
+    ],
+    "unpaired_old": sorted(unpaired_old),
+    "unpaired_new": sorted(unpaired_new),
+  }
+  with open(report_path, "w") as file:
+    json.dump(report, file, indent=2)
@@ -14,104 +14,425 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import functools
+from io import BytesIO
 import pymupdf
-from PIL import Image, ImageDraw, ImageFont, ImageChops, ImageEnhance
+from PIL import Image, ImageDraw, ImageFont
 import numpy as np
+from instrumentation import Metrics
+from diff_regions import find_regions, merge_boxes
+from text_comparer import ADDED, REMOVED, MARKER
+
+# Rows of a page compared at a time, sized so the temporaries of one strip stay small
+STRIP_BYTES = 4 * 1024 * 1024
+
+# Size in coarse pixels of the grid cells dirty regions are built from
+COARSE_CELL_SIZE = 16
+
+# Margin in points kept around a changed region when it is cropped out of a page
+CROP_MARGIN = 12
+
+# Fonts of the text annotations in order of preference, looked up in the working directory and
+# the system font directories. Helvetica bundled with pymupdf is used when none of them is found.
+ANNOTATION_FONTS = ("Arial.ttf", "arial.ttf", "LiberationSans-Regular.ttf", "DejaVuSans.ttf")
+
+ANNOTATION_COLORS = {ADDED: (0, 204, 0), REMOVED: (204, 0, 0), MARKER: (0, 0, 0)}
+
+# Words whose rendered glyph masks are kept per annotation font
+MASK_CACHE_WORDS = 20000
+
+class AnnotationFont:
+  """
+  Annotation font with memos of the width and the rendered glyph mask of every word drawn in it,
+  so a word is measured and rasterised once per process however often it is annotated.
+  """
+
+  def __init__(self, font):
+    self.font = font
+    self.widths = {}
+    self.masks = {}
+
+  def text_width(self, text):
+    """Return the width of the text, measuring it only the first time."""
+    width = self.widths.get(text)
+    if width is None:
+      width = self.widths[text] = self.font.getbbox(text)[2]
+    return width
+
+  def text_mask(self, text):
+    """Return the grayscale glyph mask of the text and its (x, y) offset from the text position."""
+    mask = self.masks.get(text)
+    if mask is None:
+      left, top, right, bottom = self.font.getbbox(text)
+      image = Image.new("L", (max(right - left, 1), max(bottom - top, 1)))
+      ImageDraw.Draw(image).text((-left, -top), text, font=self.font, fill=255)
+      mask = (image, left, top)
+      if len(self.masks) < MASK_CACHE_WORDS:
+        self.masks[text] = mask
+    return mask
+
+@functools.lru_cache(maxsize=None)
+def annotation_font_path():
+  """Return the first of ANNOTATION_FONTS that can be loaded, or None for the bundled font."""
+  for font_path in ANNOTATION_FONTS:
+    try:
+      ImageFont.truetype(font_path, 10)
+    except OSError:
+      continue
+    if font_path != ANNOTATION_FONTS[0]:
+      print(f"{ANNOTATION_FONTS[0]} not found, annotating text differences with {font_path}")
+    return font_path
+  print(f"{ANNOTATION_FONTS[0]} not found, annotating text differences with the bundled Helvetica")
+  return None
+
+@functools.lru_cache(maxsize=None)
+def load_font(font_path, size):
+  """Return the AnnotationFont of a font at a size, loaded once per process."""
+  if font_path is None:
+    return AnnotationFont(ImageFont.truetype(BytesIO(pymupdf.Font("helv").buffer), size))
+  return AnnotationFont(ImageFont.truetype(font_path, size))
+
+def any_channel(mask):
+  """Reduce an (height, width, 3) boolean array over its channels, several times faster than any(axis=2)."""
+  return mask[..., 0] | mask[..., 1] | mask[..., 2]
+
+class PixmapArray(np.ndarray):
+  """NumPy view over the samples of a pymupdf Pixmap that keeps the Pixmap alive."""
+
+  pixmap = None
 
 class ImageUtils:
 
-  def __init__(self, quality):
+  def __init__(self, quality, tolerance=0, coarse_zoom=None, cache=None, metrics=None, region_merge_distance=4, min_region_area=1):
+    """
+    :param quality: Zoom factor pages are rendered at.
+    :param tolerance: Largest per-channel difference still treated as equal, either one
+      value for every channel or an (r, g, b) sequence.
+    :param coarse_zoom: Zoom factor of the cheap pre-pass used to find dirty regions,
+      or None to always diff full quality renders of the whole page.
+    :param cache: Optional RenderCache full page renders are read from and stored in.
+    :param metrics: Optional Metrics the render, raster diff and annotate stages are timed in.
+    :param region_merge_distance: Changed regions closer than this many points are merged.
+    :param min_region_area: Changed regions of fewer square points are dropped as speckles.
+    """
     self.quality = quality
-  
-  def render_page_to_image(self, page):
-    """Render the page at a higher resolution using the zoom factor."""
-    mat = pymupdf.Matrix(self.quality, self.quality)
-    pix = page.get_pixmap(matrix=mat)
-    img = Image.frombytes("RGB", [pix.width, pix.height], pix.samples)
-    return img
+    self.tolerance = np.asarray(tolerance, dtype=np.uint8)
+    self.coarse_zoom = coarse_zoom
+    self.cache = cache
+    self.metrics = metrics or Metrics(enabled=False)
+    self.region_merge_pixels = max(1, int(round(region_merge_distance * quality)))
+    self.min_region_pixels = max(1, int(round(min_region_area * quality * quality)))
+
+  def render_page_to_array(self, page, zoom=None, clip=None):
+    """Render the page at the zoom factor and return an RGB array viewing the pixmap samples."""
+    zoom = zoom or self.quality
+    with self.metrics.timer("render"):
+      cache_key = None
+      if self.cache and clip is None:
+        cache_key = self.cache.make_key("render", page, zoom)
+        cached = self.cache.get_array(cache_key)
+        if cached is not None:
+          return cached
 
-  def create_binary_diff_image(self, img1, img2):
-    """Create a binary difference image where differences are white and no differences are black."""
-    # Find the differences between the images
-    diff = ImageChops.difference(img1, img2)
+      mat = pymupdf.Matrix(zoom, zoom)
+      pix = page.get_pixmap(matrix=mat, clip=clip, alpha=False)
+      array = self.pixmap_to_array(pix)
+      if cache_key:
+        self.cache.put_array(cache_key, array)
+      return array
 
-    # Convert the difference image to grayscale and then to binery using a threshold
-    binary_diff = diff.convert("L").point(lambda p: 255 if p > 0 else 0)
+  def pixmap_to_array(self, pix):
+    """Return a (height, width, channels) array sharing memory with the pixmap."""
+    if pix.stride == pix.width * pix.n:
+      samples = np.frombuffer(pix.samples_mv, dtype=np.uint8)
+    else:
+      samples = np.frombuffer(pix.samples, dtype=np.uint8)
+    array = samples.reshape(pix.height, pix.width, pix.n).view(PixmapArray)
+    array.pixmap = pix
+    return array
 
-    return binary_diff
+  def render_size(self, page):
+    """Return the (width, height) in pixels of the page rendered at full quality."""
+    rect = (page.rect * pymupdf.Matrix(self.quality, self.quality)).irect
+    return rect.width, rect.height
 
-  def tint_image(self, img, tint_color):
-    """Apply a color tint to a binery image where white is the tine color and black is transparent."""
-    # Create a new image with the same size as the binary image
-    img_rgba = Image.new("RGBA", img.size)
+  def render_strip(self, display_list, top, bottom, width):
+    """Render rows top to bottom of a page display list at full quality as an RGB array."""
+    with self.metrics.timer("render"):
+      # Clip edges are rounded to whole pixels, so render a row more on each side and slice
+      clip = pymupdf.Rect(0, max(0, top - 1), width, bottom + 1) / self.quality
+      pix = display_list.get_pixmap(matrix=pymupdf.Matrix(self.quality, self.quality), alpha=False, clip=clip)
+      return self.pixmap_to_array(pix)[top - pix.y:bottom - pix.y, :width]
 
-    # Create a numpy array from the binary image
-    img_data = np.array(img)
+  def compare_page_strips(self, old_page, new_page, strip_height, tint_color=(255, 0, 0), opacity=0.5):
+    """
+    Render two pages strip by strip through their display lists and overlay the differences of
+    every strip, so only one strip of each page is held at a time however large the pages are.
+    :param strip_height: Rows rendered and compared at a time
+    :return: Iterator of (top row, old strip array, tinted strip array or None)
+    """
+    width, height = self.render_size(old_page)
+    new_width, new_height = self.render_size(new_page)
+    old_list = old_page.get_displaylist()
+    new_list = new_page.get_displaylist()
+    for top in range(0, height, strip_height):
+      bottom = min(top + strip_height, height)
+      old_strip = self.render_strip(old_list, top, bottom, width)
+      tinted = None
+      if top < new_height:
+        new_strip = self.render_strip(new_list, top, min(bottom, new_height), min(width, new_width))
+        with self.metrics.timer("raster_diff"):
+          tinted = self.overlay_differences_array(old_strip, new_strip, tint_color, opacity)
+        del new_strip
+      yield top, old_strip, tinted
 
-    # Create a mask where white pixels in the binary image are set to the tint color and black pixels are transparent
-    mask = img_data == 255
-    
-    img_rgba_data = np.zeros((img_data.shape[0], img_data.shape[1], 4), dtype=np.uint8)
-    img_rgba_data[mask] = tint_color + (255,)
-    img_rgba_data[~mask] = (0, 0, 0, 0)
+  def render_page_to_image(self, page):
+    """Render the page at a higher resolution using the zoom factor."""
+    return Image.fromarray(self.render_page_to_array(page))
+
+  def diff_mask(self, img1, img2):
+    """Return a boolean mask of pixels where any channel differs by more than the tolerance."""
+    if self.tolerance.any():
+      diff = np.maximum(img1, img2)
+      diff -= np.minimum(img1, img2)
+      return any_channel(diff > self.tolerance)
+    return any_channel(img1 != img2)
 
-    # Convert the numpy array back to an image
-    img_rgba = Image.fromarray(img_rgba_data, mode="RGBA")
+  def blend_tint(self, img, mask, tint_color, opacity, source=None):
+    """
+    Blend tint_color with the given opacity into the masked pixels of img, in place.
+    Pixels are taken from source when given, so blending the same region twice is harmless.
+    """
+    alpha = int(opacity * 255)
+    tint = np.asarray(tint_color, dtype=np.uint16) * alpha + 127
+    pixels = (img if source is None else source)[mask].astype(np.uint16)
+    pixels *= 255 - alpha
+    pixels += tint
+    pixels //= 255
+    img[mask] = pixels
 
-    return img_rgba
+  def overlay_differences_array(self, img1, img2, tint_color=(255, 0, 0), opacity=0.5):
+    """
+    Tint the pixels where img2 differs from img1 in a single pass over row strips.
+    :param img1: Base RGB array, the output is a copy of it
+    :param img2: RGB array compared against img1
+    :return: Tinted RGB array, or None if the images do not differ
+    """
+    height = min(img1.shape[0], img2.shape[0])
+    width = min(img1.shape[1], img2.shape[1])
+    strip_rows = max(1, STRIP_BYTES // max(1, width * img1.shape[2]))
+
+    combined = None
+    for top in range(0, height, strip_rows):
+      bottom = min(top + strip_rows, height)
+      mask = self.diff_mask(img1[top:bottom, :width, :3], img2[top:bottom, :width, :3])
+      if not mask.any():
+        continue
+      if combined is None:
+        combined = np.array(img1[:, :, :3])
+      self.blend_tint(combined[top:bottom, :width], mask, tint_color, opacity)
+    return combined
 
   def overlay_differences(self, img1, img2, tint_color=(255, 0, 0), opacity=0.5):
     """Overlay differences between img2 and img1 with the specified color tint and opacity."""
-    # Create the binary difference image
-    binary_diff = self.create_binary_diff_image(img1, img2)
-
-    # Check if there are any differences
-    if binary_diff.getbbox() is None:
+    combined = self.overlay_differences_array(
+      np.asarray(img1.convert("RGB")) if isinstance(img1, Image.Image) else img1,
+      np.asarray(img2.convert("RGB")) if isinstance(img2, Image.Image) else img2,
+      tint_color, opacity
+    )
+    if combined is None:
       return None
+    return Image.fromarray(combined)
+
+  def find_dirty_regions(self, old_page, new_page):
+    """
+    Find the regions where two pages differ using renders at the coarse zoom.
+    :return: List of (x0, y0, x1, y1) pixel boxes at full quality
+    """
+    full_width = int(round(old_page.rect.width * self.quality))
+    full_height = int(round(old_page.rect.height * self.quality))
+    old_thumb = self.render_page_to_array(old_page, zoom=self.coarse_zoom)
+    new_thumb = self.render_page_to_array(new_page, zoom=self.coarse_zoom)
+    if old_thumb.shape != new_thumb.shape:
+      return [(0, 0, full_width, full_height)]
+    mask = self.diff_mask(old_thumb, new_thumb)
+    if not mask.any():
+      return []
+
+    # Convert cells to full quality pixels, with a coarse pixel of margin for anti-aliasing
+    cell = COARSE_CELL_SIZE
+    regions = self.grid_regions(mask, cell)
+    scale = self.quality / self.coarse_zoom
+    return [
+      (
+        max(0, int((x0 * cell - 1) * scale)),
+        max(0, int((y0 * cell - 1) * scale)),
+        min(full_width, int(np.ceil((x1 * cell + 1) * scale))),
+        min(full_height, int(np.ceil((y1 * cell + 1) * scale))),
+      )
+      for x0, y0, x1, y1 in regions
+    ]
+
+  def grid_regions(self, mask, cell):
+    """
+    Reduce a boolean mask to a grid of dirty cells and join them into boxes
+    :return: List of (x0, y0, x1, y1) boxes in cells
+    """
+    height, width = mask.shape
+    rows, cols = -(-height // cell), -(-width // cell)
+    padded = np.zeros((rows * cell, cols * cell), dtype=bool)
+    padded[:height, :width] = mask
+    grid = padded.reshape(rows, cell, cols, cell).any(axis=(1, 3))
+
+    # Join runs of dirty cells in a row, then stack runs with the same span across rows
+    regions = []
+    open_runs = {}
+    for row in range(rows + 1):
+      runs = set()
+      if row < rows:
+        edges = np.flatnonzero(np.diff(np.concatenate(([False], grid[row], [False])).astype(np.int8)))
+        runs = set(zip(edges[::2].tolist(), edges[1::2].tolist()))
+      for run in list(open_runs):
+        if run not in runs:
+          regions.append((run[0], open_runs.pop(run), run[1], row))
+      for run in runs:
+        open_runs.setdefault(run, row)
+    return regions
 
-    # Apply the tint color to the binary difference image
-    diff_tinted = self.tint_image(binary_diff, tint_color)
+  def changed_regions(self, img1, tinted):
+    """
+    Label the pixels an overlay tinted into connected regions, merging nearby regions and
+    dropping speckles
+    :param img1: RGB array of the old page
+    :param tinted: Tinted copy of img1 from compare_page_images
+    :return: List of (x0, y0, x1, y1) pixel boxes
+    """
+    with self.metrics.timer("regions"):
+      height = min(img1.shape[0], tinted.shape[0])
+      width = min(img1.shape[1], tinted.shape[1])
+      mask = any_channel(tinted[:height, :width] != img1[:height, :width, :3])
+      return find_regions(mask, self.region_merge_pixels, self.min_region_pixels)
 
-    # Apply the opacity to the tinted difference image
-    alpha = diff_tinted.split()[3]
-    alpha = ImageEnhance.Brightness(alpha).enhance(opacity)
-    diff_tinted.putalpha(alpha)
+  def merge_regions(self, regions, size):
+    """Merge changed regions found in separate strips of a page image of the given (width, height)."""
+    return merge_boxes(regions, self.region_merge_pixels, (size[1], size[0]))
 
-    # Composite the tinted difference on top of the base image without affecting the brightness
-    img1_rgba = img1.convert("RGBA")
-    combined = Image.alpha_composite(img1_rgba, diff_tinted)
+  def regions_to_points(self, regions):
+    """Convert pixel boxes to [x0, y0, x1, y1] boxes in PDF points."""
+    return [[round(value / self.quality, 2) for value in box] for box in regions]
+
+  def crop_boxes(self, regions, size):
+    """
+    Return the boxes to crop out of a page image of the given (width, height) to show the
+    regions, each with a margin around it and joined where the margins overlap
+    """
+    margin = int(round(CROP_MARGIN * self.quality))
+    padded = [(x0 - margin, y0 - margin, x1 + margin, y1 + margin) for x0, y0, x1, y1 in regions]
+    return merge_boxes(padded, margin, (size[1], size[0]))
+
+  def region_differences(self, old_page, new_page, regions):
+    """
+    Diff the given regions of two pages, rendering just those clips of both at full quality.
+    The old page is rendered with the same clip as the new one, as a clipped render of vector
+    strokes does not match the same pixels of a full render exactly.
+    :param regions: Pixel boxes from find_dirty_regions or vector_regions
+    :return: List of (top, left, old region array, mask) of the regions that differ
+    """
+    differences = []
+    for x0, y0, x1, y1 in regions:
+      clip = pymupdf.Rect(x0, y0, x1, y1) / self.quality
+      old_region = self.render_page_to_array(old_page, clip=clip)
+      new_region = self.render_page_to_array(new_page, clip=clip)
+      height = min(old_region.shape[0], new_region.shape[0])
+      width = min(old_region.shape[1], new_region.shape[1])
+      mask = self.diff_mask(old_region[:height, :width], new_region[:height, :width])
+      if mask.any():
+        differences.append((old_region.pixmap.y, old_region.pixmap.x, old_region[:height, :width], mask))
+    return differences
+
+  def overlay_region_differences(self, img1, differences, tint_color=(255, 0, 0), opacity=0.5):
+    """
+    Tint the differences of region_differences onto a copy of the old page
+    :param img1: Full quality RGB array of the old page, the base of the output
+    :param differences: Regions from region_differences
+    :return: Tinted RGB array, or None if there are no differences
+    """
+    if not differences:
+      return None
+    combined = np.array(img1[:, :, :3])
+    for top, left, old_region, mask in differences:
+      height = min(mask.shape[0], combined.shape[0] - top)
+      width = min(mask.shape[1], combined.shape[1] - left)
+      target = combined[top:top + height, left:left + width]
+      self.blend_tint(target, mask[:height, :width], tint_color, opacity, source=old_region[:height, :width])
     return combined
 
+  def vector_regions(self, boxes, page):
+    """
+    Convert boxes in points from a vector comparison to pixel boxes of the page at full
+    quality, with a pixel of margin for anti-aliasing, merging boxes region_merge_distance apart.
+    region_differences renders these boxes of both pages with the same clip, so the
+    strokes cut by a box edge are cut the same way on both sides.
+    """
+    width, height = self.render_size(page)
+    regions = [
+      (int(x0 * self.quality) - 1, int(y0 * self.quality) - 1, int(np.ceil(x1 * self.quality)) + 1, int(np.ceil(y1 * self.quality)) + 1)
+      for x0, y0, x1, y1 in boxes
+    ]
+    return merge_boxes(regions, self.region_merge_pixels, (height, width))
+
+  def compare_page_images(self, old_page, new_page, tint_color=(255, 0, 0), opacity=0.5, base_required=True, dirty_regions=None):
+    """
+    Render two pages and overlay their differences.
+    With a coarse zoom configured, or the dirty regions known from a vector comparison, only
+    those clips of both pages are rendered at full quality and compared. The whole old page
+    is only rendered when a clip differs or base_required is set, as the base of the output.
+    :param base_required: Render the old page even when the pages look identical
+    :param dirty_regions: Pixel boxes from vector_regions holding every difference, or None
+    :return: (old page array or None, tinted array or None)
+    """
+    # Renders inside are timed as their own stage, so raster_diff is the diffing and tinting only
+    with self.metrics.timer("raster_diff"):
+      regions = dirty_regions
+      if regions is None and self.coarse_zoom and old_page.rotation == 0 and new_page.rotation == 0:
+        regions = self.find_dirty_regions(old_page, new_page)
+      if regions is not None:
+        differences = self.region_differences(old_page, new_page, regions)
+        if not differences and not base_required:
+          return None, None
+        old_array = self.render_page_to_array(old_page)
+        return old_array, self.overlay_region_differences(old_array, differences, tint_color, opacity)
+
+      old_array, new_array = self.render_pages_to_arrays(old_page, new_page)
+      return old_array, self.overlay_differences_array(old_array, new_array, tint_color, opacity)
+
+  def render_pages_to_arrays(self, old_page, new_page):
+    """Render PDF pages to RGB arrays."""
+    old_image = self.render_page_to_array(old_page)
+    new_image = self.render_page_to_array(new_page)
+    return old_image, new_image
+
   def render_pages_to_images(self, old_page, new_page):
     """Render PDF pages to images."""
     old_image = self.render_page_to_image(old_page)
     new_image = self.render_page_to_image(new_page)
     return old_image, new_image
   
-  def annotate_text_differences(self, image, word_diffs, font_size):
-    """Annotate word-level text differences on an image"""
-    draw = ImageDraw.Draw(image)
-    font = ImageFont.truetype("Arial.ttf", int(font_size))
-    current_x_position = {}
-    
-    for word, bbox in word_diffs:
-      if word.startswith('+ '):
-        text_color = (0, 204, 0)
-        word_text = word[2:]
-      elif word.startswith('- '):
-        text_color = (204, 0, 0)
-        word_text = word[2:]
-        
-      text_pos_x = float(bbox[0]) * self.quality
-      text_pos_y = float(bbox[1]) * self.quality
-      
-      if text_pos_y in current_x_position:
-        last_x_position = current_x_position[text_pos_y]
-        if last_x_position + font.getbbox(" ")[2] > text_pos_x:
-          arrow_text = " >"
-          arrow_width = font.getbbox(arrow_text)[2]
-          draw.text((last_x_position, text_pos_y - font_size), arrow_text, font=font, fill=(0,0,0))
-          text_pos_x = last_x_position + arrow_width + font.getbbox(" ")[2]
-          
-      draw.text((text_pos_x, text_pos_y - font_size), word_text, font=font, fill=text_color)
-      current_x_position[text_pos_y] = text_pos_x + font.getbbox(word_text)[2]
+  def annotate_text_differences(self, image, word_diffs, font_size, top=0):
+    """
+    Annotate word-level text differences (WordDiffs) on an image
+    :param top: Page row of the first image row, when the image is a strip of the page
+    :return: List of the (x0, y0, x1, y1) page pixel boxes of the drawn annotations
+    """
+    with self.metrics.timer("annotate"):
+      font = load_font(annotation_font_path(), int(font_size))
+      boxes = []
+      # Words are stamped from their cached glyph masks at whole pixel positions
+      for text_pos_x, text_pos_y, word_text, sign in word_diffs.layout(font.text_width, self.quality):
+        mask, left, mask_top = font.text_mask(word_text)
+        x, y = round(text_pos_x) + left, round(text_pos_y - font_size) + mask_top
+        if y + mask.height <= top or y >= top + image.height:
+          continue
+        image.paste(ANNOTATION_COLORS[sign], (x, y - top), mask)
+        boxes.append((x, y, x + mask.width, y + mask.height))
+      return boxes
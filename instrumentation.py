@@ -0,0 +1,200 @@
+# PDF Comparer
+# Copyright (C) 2024 Ryan Lacadin
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import json
+import time
+import cProfile
+import threading
+import tracemalloc
+from contextlib import contextmanager, nullcontext
+
+# Shared do-nothing timer, so timing a stage with metrics disabled costs one attribute lookup and a call
+_NULL_TIMER = nullcontext()
+
+# Allocation sites listed in a tracemalloc capture
+TRACEMALLOC_TOP = 25
+
+class _Timer:
+  """Context manager timing one stage, excluding the time of stages timed inside it."""
+
+  __slots__ = ("metrics", "stage", "start", "child_seconds")
+
+  def __init__(self, metrics, stage):
+    self.metrics = metrics
+    self.stage = stage
+
+  def __enter__(self):
+    self.child_seconds = 0.0
+    self.metrics.stack().append(self)
+    self.start = time.perf_counter()
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    elapsed = time.perf_counter() - self.start
+    stack = self.metrics.stack()
+    stack.pop()
+    if stack:
+      stack[-1].child_seconds += elapsed
+    self.metrics.add_time(self.stage, elapsed - self.child_seconds)
+
+class Metrics:
+  """
+  Per-process stage timers and counters. Stages record their own time only, so nested stages
+  such as a render inside a raster diff are not counted twice. Recorded values are drained
+  into page and plan results like the cache statistics, and merged per document and per run.
+  """
+
+  def __init__(self, enabled=True):
+    """
+    :param enabled: With metrics disabled every timer is a shared no-op context manager.
+    """
+    self.enabled = enabled
+    self.lock = threading.Lock()
+    self.local = threading.local()
+    self.timers = {} # Stage -> [calls, seconds, max seconds]
+    self.counters = {}
+
+  def stack(self):
+    """Return the calling thread's stack of running timers."""
+    try:
+      return self.local.stack
+    except AttributeError:
+      self.local.stack = []
+      return self.local.stack
+
+  def timer(self, stage):
+    """Return a context manager that times a stage."""
+    if not self.enabled:
+      return _NULL_TIMER
+    return _Timer(self, stage)
+
+  def add_time(self, stage, seconds, calls=1):
+    """Record seconds spent in a stage."""
+    with self.lock:
+      timer = self.timers.get(stage)
+      if timer is None:
+        self.timers[stage] = [calls, seconds, seconds]
+      else:
+        timer[0] += calls
+        timer[1] += seconds
+        timer[2] = max(timer[2], seconds)
+
+  def count(self, name, value=1):
+    """Add value to a counter."""
+    if self.enabled:
+      with self.lock:
+        self.counters[name] = self.counters.get(name, 0) + value
+
+  def drain(self):
+    """Return and reset the values recorded so far, as a picklable snapshot."""
+    with self.lock:
+      snapshot = {"timers": self.timers, "counters": self.counters}
+      self.timers = {}
+      self.counters = {}
+    return snapshot
+
+  def merge(self, snapshot):
+    """Add a snapshot from drain to the recorded values."""
+    if not snapshot:
+      return
+    with self.lock:
+      for stage, (calls, seconds, max_seconds) in snapshot["timers"].items():
+        timer = self.timers.setdefault(stage, [0, 0.0, 0.0])
+        timer[0] += calls
+        timer[1] += seconds
+        timer[2] = max(timer[2], max_seconds)
+      for name, value in snapshot["counters"].items():
+        self.counters[name] = self.counters.get(name, 0) + value
+
+  def to_dict(self):
+    """Return the recorded values in the JSON layout of the exports."""
+    with self.lock:
+      return {
+        "stages": {
+          stage: {"calls": calls, "seconds": round(seconds, 6), "max_seconds": round(max_seconds, 6)}
+          for stage, (calls, seconds, max_seconds) in sorted(self.timers.items())
+        },
+        "counters": dict(sorted(self.counters.items())),
+      }
+
+class MetricsExporter:
+  """Append metrics records to a JSON lines file and write the run totals as a Prometheus textfile."""
+
+  def __init__(self, metrics_dir):
+    """
+    :param metrics_dir: Directory of metrics.jsonl and pdf_comparer.prom, e.g. the node_exporter textfile directory
+    """
+    os.makedirs(metrics_dir, exist_ok=True)
+    self.jsonl_path = os.path.join(metrics_dir, "metrics.jsonl")
+    self.prometheus_path = os.path.join(metrics_dir, "pdf_comparer.prom")
+
+  def write_record(self, record_type, metrics, **fields):
+    """Append one JSON line holding the metrics and extra fields."""
+    record = {"type": record_type, "time": round(time.time(), 3), "pid": os.getpid(), **fields, **metrics.to_dict()}
+    # One write per line, so lines appended by several processes do not interleave
+    with open(self.jsonl_path, "a") as jsonl_file:
+      jsonl_file.write(json.dumps(record) + "\n")
+
+  def write_prometheus(self, metrics, **gauges):
+    """Write the metrics and run gauges in the Prometheus text format, replacing the file atomically."""
+    values = metrics.to_dict()
+    lines = [
+      "# HELP pdf_comparer_stage_seconds_total Seconds spent in each comparison stage.",
+      "# TYPE pdf_comparer_stage_seconds_total counter",
+    ]
+    lines += [f'pdf_comparer_stage_seconds_total{{stage="{stage}"}} {timer["seconds"]}' for stage, timer in values["stages"].items()]
+    lines += [
+      "# HELP pdf_comparer_stage_calls_total Times each comparison stage ran.",
+      "# TYPE pdf_comparer_stage_calls_total counter",
+    ]
+    lines += [f'pdf_comparer_stage_calls_total{{stage="{stage}"}} {timer["calls"]}' for stage, timer in values["stages"].items()]
+    for name, value in values["counters"].items():
+      lines += [f"# TYPE pdf_comparer_{name}_total counter", f"pdf_comparer_{name}_total {value}"]
+    for name, value in gauges.items():
+      lines += [f"# TYPE pdf_comparer_{name} gauge", f"pdf_comparer_{name} {value}"]
+
+    temp_path = f"{self.prometheus_path}.tmp"
+    with open(temp_path, "w") as prometheus_file:
+      prometheus_file.write("\n".join(lines) + "\n")
+    os.replace(temp_path, self.prometheus_path)
+
+@contextmanager
+def profile_capture(path_prefix):
+  """
+  Profile the enclosed code with cProfile and tracemalloc
+  :param path_prefix: Path the .prof and .tracemalloc.txt files are written to, without extension
+  """
+  os.makedirs(os.path.dirname(path_prefix), exist_ok=True)
+  started_tracing = not tracemalloc.is_tracing()
+  if started_tracing:
+    tracemalloc.start()
+  before = tracemalloc.take_snapshot()
+  profiler = cProfile.Profile()
+  profiler.enable()
+  try:
+    yield
+  finally:
+    profiler.disable()
+    profiler.dump_stats(f"{path_prefix}.prof")
+    after = tracemalloc.take_snapshot()
+    _, peak = tracemalloc.get_traced_memory()
+    if started_tracing:
+      tracemalloc.stop()
+    with open(f"{path_prefix}.tracemalloc.txt", "w") as trace_file:
+      trace_file.write(f"Peak traced memory: {peak / 2**20:.1f} MB\n")
+      for stat in after.compare_to(before, "lineno")[:TRACEMALLOC_TOP]:
+        trace_file.write(f"{stat}\n")
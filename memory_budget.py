@@ -0,0 +1,103 @@
+# PDF Comparer
+# Copyright (C) 2024 Ryan Lacadin
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import sys
+import threading
+
+try:
+  import resource
+except ImportError: # Not available on Windows
+  resource = None
+
+# Bytes per pixel of a page render and number of page sized buffers alive at once while
+# comparing a page: both renders, the overlay, the combined and word images and a conversion
+BYTES_PER_PIXEL = 3
+PAGE_BUFFERS = 6
+
+# Share of the physical memory used as budget when none is configured
+DEFAULT_MEMORY_SHARE = 0.5
+
+def default_budget_bytes():
+  """Return the default memory budget, a share of the physical memory or 4 GB if it is unknown."""
+  try:
+    physical_bytes = os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+  except (AttributeError, ValueError, OSError):
+    return 4 * 1024 ** 3
+  return int(physical_bytes * DEFAULT_MEMORY_SHARE)
+
+def page_footprint(doc, page_num, zoom, tile_threshold_pixels=None, tile_height=None):
+  """
+  Estimate the peak bytes comparing a page rendered at the zoom factor takes
+  :param tile_threshold_pixels: Pages rendering to more pixels are compared in strips of
+    tile_height rows, so only a strip counts
+  """
+  rect = doc.page_cropbox(page_num)
+  width, height = int(rect.width * zoom), int(rect.height * zoom)
+  if tile_threshold_pixels and width * height > tile_threshold_pixels:
+    height = min(height, tile_height)
+  return width * height * BYTES_PER_PIXEL * PAGE_BUFFERS
+
+def peak_rss_bytes(children=False):
+  """Return the peak resident set size of this process, or of its largest finished child process."""
+  if resource is None:
+    return None
+  usage = resource.getrusage(resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF)
+  # ru_maxrss is in kilobytes, except on macOS where it is in bytes
+  return usage.ru_maxrss if sys.platform == "darwin" else usage.ru_maxrss * 1024
+
+class MemoryBudget:
+  """
+  Budget of the estimated bytes of the page work in flight. Work is only started while its
+  estimate fits in what is left of the budget; work larger than the whole budget still
+  runs, but only when nothing else is in flight.
+  """
+
+  def __init__(self, max_bytes):
+    """
+    :param max_bytes: Bytes the page work in flight may take together.
+    """
+    self.max_bytes = max_bytes
+    self.condition = threading.Condition()
+    self.in_use = 0
+    self.peak_in_use = 0
+
+  def fits(self, nbytes):
+    """Return True if work of nbytes can start now."""
+    return not self.in_use or self.in_use + nbytes <= self.max_bytes
+
+  def try_acquire(self, nbytes):
+    """Reserve nbytes if they fit, returning whether they were reserved."""
+    with self.condition:
+      if not self.fits(nbytes):
+        return False
+      self.in_use += nbytes
+      self.peak_in_use = max(self.peak_in_use, self.in_use)
+      return True
+
+  def acquire(self, nbytes):
+    """Reserve nbytes, waiting until they fit."""
+    with self.condition:
+      while not self.fits(nbytes):
+        self.condition.wait()
+      self.in_use += nbytes
+      self.peak_in_use = max(self.peak_in_use, self.in_use)
+
+  def release(self, nbytes):
+    """Return nbytes reserved by acquire or try_acquire."""
+    with self.condition:
+      self.in_use -= nbytes
+      self.condition.notify_all()
@@ -0,0 +1,273 @@
+# PDF Comparer
+# Copyright (C) 2024 Ryan Lacadin
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import time
+import zlib
+import queue
+import struct
+import threading
+from io import BytesIO
+from collections import deque
+import numpy as np
+from instrumentation import Metrics
+
+# PNG signature and the filter type of every row written by PNGStreamWriter
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+PNG_FILTER_SUB = 1
+
+class PNGStreamWriter:
+  """
+  Write an RGB PNG strip by strip, so an image never has to be held whole. Strips are filtered
+  with NumPy and compressed on a background thread, at most max_pending strips behind the
+  caller. The file is written under a temporary name and only appears under its own once
+  closed with keep=True.
+  """
+
+  def __init__(self, file_path, width, height, compress_level=3, max_pending=2):
+    """
+    :param file_path: Path of the PNG file
+    :param width: Image width in pixels
+    :param height: Image height in pixels, the rows written must add up to it
+    :param compress_level: zlib compression level, 3 is about twice as fast as 6 for 25% more bytes
+    :param max_pending: Strips that may wait to be compressed before write_rows blocks
+    """
+    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+    self.file_path = file_path
+    self.temp_path = f"{file_path}.part"
+    self.width = width
+    self.rows_left = height
+    self.file = open(self.temp_path, "wb")
+    self.file.write(PNG_SIGNATURE)
+    self.write_chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)) # 8-bit RGB
+    self.compressor = zlib.compressobj(compress_level)
+    self.strips = queue.Queue(max_pending)
+    self.error = None
+    self.thread = threading.Thread(target=self.run, daemon=True)
+    self.thread.start()
+
+  def write_chunk(self, chunk_type, data):
+    """Write one PNG chunk."""
+    self.file.write(struct.pack(">I", len(data)) + chunk_type)
+    self.file.write(data)
+    self.file.write(struct.pack(">I", zlib.crc32(data, zlib.crc32(chunk_type))))
+
+  def write_rows(self, rows):
+    """Queue a (rows, width, 3) uint8 strip of the image. The array must not be modified afterwards."""
+    if self.error:
+      raise self.error
+    self.rows_left -= rows.shape[0]
+    self.strips.put(rows)
+
+  def run(self):
+    """Filter, compress and write the queued strips until None is queued."""
+    while True:
+      rows = self.strips.get()
+      if rows is None:
+        return
+      if self.error:
+        continue
+      try:
+        rows = rows.reshape(rows.shape[0], self.width * 3)
+        # The Sub filter stores every byte as its difference to the same channel of the pixel before
+        filtered = np.empty((rows.shape[0], rows.shape[1] + 1), dtype=np.uint8)
+        filtered[:, 0] = PNG_FILTER_SUB
+        filtered[:, 1:4] = rows[:, :3]
+        np.subtract(rows[:, 3:], rows[:, :-3], out=filtered[:, 4:])
+        data = self.compressor.compress(filtered)
+        if data:
+          self.write_chunk(b"IDAT", data)
+      except Exception as e:
+        self.error = e
+
+  def close(self, keep=True):
+    """Finish the file and move it to its path, or delete it if keep is False."""
+    self.strips.put(None)
+    self.thread.join()
+    try:
+      if keep:
+        if self.error:
+          raise self.error
+        if self.rows_left:
+          raise ValueError(f"{self.file_path} is missing {self.rows_left} rows")
+        self.write_chunk(b"IDAT", self.compressor.flush())
+        self.write_chunk(b"IEND", b"")
+    finally:
+      self.file.close()
+      if keep and not self.error and not self.rows_left:
+        os.replace(self.temp_path, self.file_path)
+      else:
+        os.remove(self.temp_path)
+
+class OutputWriter:
+  """
+  Encode and write page images on a pool of threads, so comparing pages does not stall on
+  JPEG encoding and disk I/O. Images wait in a queue bounded by their decoded size: submit
+  only blocks while the queue is over its memory budget. Images of the same document are
+  written one at a time in the order they were submitted.
+  """
+
+  def __init__(self, thread_count, max_pending_bytes, metrics=None):
+    """
+    :param thread_count: Number of encoder threads.
+    :param max_pending_bytes: Memory budget of the images waiting to be written.
+    :param metrics: Optional Metrics the encode and write stages are timed in.
+    """
+    self.max_pending_bytes = max_pending_bytes
+    self.metrics = metrics or Metrics(enabled=False)
+    self.condition = threading.Condition()
+    self.queues = {} # Document key -> deque of pending writes
+    self.ready = deque() # Document keys with pending writes and none in flight
+    self.pending_bytes = 0
+    self.in_flight = 0
+    self.closed = False
+    self.failures = [] # (document_key, file_path, exception) of the images that could not be written
+
+    self.images_written = 0
+    self.bytes_written = 0
+    self.encode_seconds = 0.0
+    self.blocked_seconds = 0.0
+    self.peak_pending_bytes = 0
+    self.start_time = time.time()
+
+    self.threads = [threading.Thread(target=self.run_worker, daemon=True) for _ in range(thread_count)]
+    for thread in self.threads:
+      thread.start()
+
+  def submit(self, document_key, image, file_path):
+    """
+    Queue an image to be saved as JPEG. The image must not be modified afterwards.
+    :param document_key: Key whose images are written in submission order, e.g. the output directory
+    :param image: PIL image to save
+    :param file_path: Path of the JPEG file
+    """
+    size = image.width * image.height * len(image.getbands())
+    with self.condition:
+      blocked_since = time.time()
+      while self.pending_bytes and self.pending_bytes + size > self.max_pending_bytes:
+        self.condition.wait()
+      self.blocked_seconds += time.time() - blocked_since
+
+      self.pending_bytes += size
+      self.peak_pending_bytes = max(self.peak_pending_bytes, self.pending_bytes)
+      if document_key not in self.queues:
+        self.queues[document_key] = deque()
+        self.ready.append(document_key)
+      self.queues[document_key].append((image, file_path, size))
+      self.condition.notify_all()
+
+  def run_worker(self):
+    """Encoder thread: write the next image of a document that has none in flight."""
+    while True:
+      with self.condition:
+        while not self.ready and not self.closed:
+          self.condition.wait()
+        if not self.ready:
+          return
+        document_key = self.ready.popleft()
+        image, file_path, size = self.queues[document_key].popleft()
+        self.in_flight += 1
+
+      encode_start = time.time()
+      failure = None
+      try:
+        self.save_image(image, file_path)
+      except Exception as e:
+        print(f"Failed to write {file_path}. Reason: {e}")
+        failure = e
+      encode_seconds = time.time() - encode_start
+
+      with self.condition:
+        self.in_flight -= 1
+        self.pending_bytes -= size
+        self.encode_seconds += encode_seconds
+        if failure:
+          self.failures.append((document_key, file_path, failure))
+        else:
+          self.images_written += 1
+          self.bytes_written += os.path.getsize(file_path)
+        if self.queues[document_key]:
+          self.ready.append(document_key)
+        else:
+          del self.queues[document_key]
+        self.condition.notify_all()
+
+  def save_image(self, image, file_path):
+    """Encode an image as JPEG and write it."""
+    with self.metrics.timer("encode"):
+      if image.mode != "RGB":
+        image = image.convert("RGB")
+      buffer = BytesIO()
+      image.save(buffer, "JPEG", quality=85)
+    with self.metrics.timer("write"):
+      os.makedirs(os.path.dirname(file_path), exist_ok=True)
+      # Written under a temporary name, so an image file that exists is always complete
+      temp_path = f"{file_path}.part"
+      with open(temp_path, "wb") as image_file:
+        image_file.write(buffer.getbuffer())
+      os.replace(temp_path, file_path)
+    self.metrics.count("images_written")
+    self.metrics.count("output_bytes", buffer.tell())
+
+  def flush(self, document_key=None):
+    """
+    Wait until every submitted image has been written
+    :param document_key: Only wait for the images of this document key, if given
+    :raises OSError: if images (of the document key) could not be written since the last flush
+    """
+    with self.condition:
+      if document_key is None:
+        while self.queues or self.in_flight:
+          self.condition.wait()
+        failures, self.failures = self.failures, []
+      else:
+        # A document key stays queued until its last image in flight is written
+        while document_key in self.queues:
+          self.condition.wait()
+        failures = [failure for failure in self.failures if failure[0] == document_key]
+        self.failures = [failure for failure in self.failures if failure[0] != document_key]
+    if failures:
+      _, file_path, error = failures[0]
+      raise OSError(f"Failed to write {len(failures)} images, the first {file_path}: {error}") from error
+
+  def close(self):
+    """
+    Write the remaining images, stop the encoder threads and log their throughput
+    :raises OSError: if images could not be written since the last flush
+    """
+    try:
+      self.flush()
+    finally:
+      with self.condition:
+        self.closed = True
+        self.condition.notify_all()
+      for thread in self.threads:
+        thread.join()
+      self.report()
+
+  def report(self):
+    """Print per-stage throughput, to size the encoder pool."""
+    if not self.images_written:
+      return
+    elapsed = max(time.time() - self.start_time, 1e-9)
+    print(
+      f"Output writer {os.getpid()}: {self.images_written} images, {self.bytes_written / 1e6:.1f} MB "
+      f"in {elapsed:.2f}s ({self.images_written / elapsed:.1f} images/s), "
+      f"encoding {self.images_written / max(self.encode_seconds, 1e-9):.1f} images/s per thread "
+      f"with {len(self.threads)} threads {100 * self.encode_seconds / (elapsed * len(self.threads)):.0f}% busy, "
+      f"compare blocked {self.blocked_seconds:.2f}s on a full queue, "
+      f"peak queue {self.peak_pending_bytes / 1e6:.1f} MB"
+    )
@@ -0,0 +1,187 @@
+# PDF Comparer
+# Copyright (C) 2024 Ryan Lacadin
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import numpy as np
+import pymupdf #PyMuPDF
+from document_diff import rolling_hashes
+
+# Width in pixels of the thumbnail the perceptual hash is computed from
+THUMBNAIL_WIDTH = 64
+
+# Words per text shingle and number of MinHash permutations
+SHINGLE_LENGTH = 3
+MINHASH_PERMUTATIONS = 32
+
+# Similarity two pages need before aligning them is preferred over aligning other pages. Pages
+# left over between two aligned pairs are still paired by position.
+MATCH_THRESHOLD = 0.5
+
+# Weight of the text similarity when both pages have text, the rest goes to the image similarity
+TEXT_WEIGHT = 0.6
+
+# Largest alignment table (old pages * new pages) before falling back to pairing pages by position
+MAX_ALIGNMENT_CELLS = 25000000
+
+# Fixed MinHash permutations, odd multipliers of a multiply-shift hash
+_rng = np.random.default_rng(20240101)
+MINHASH_MULTIPLIERS = _rng.integers(1, 2 ** 63, MINHASH_PERMUTATIONS, dtype=np.uint64) | np.uint64(1)
+MINHASH_OFFSETS = _rng.integers(0, 2 ** 63, MINHASH_PERMUTATIONS, dtype=np.uint64)
+
+def image_hash(page):
+  """Return the 64-bit difference hash of a tiny grayscale render of the page."""
+  from PIL import Image # Only needed when pages are compared as images
+  zoom = THUMBNAIL_WIDTH / max(page.rect.width, 1)
+  pix = page.get_pixmap(matrix=pymupdf.Matrix(zoom, zoom), colorspace=pymupdf.csGRAY, alpha=False)
+  thumbnail = Image.frombytes("L", (pix.width, pix.height), pix.samples).resize((9, 8), Image.BOX)
+  pixels = np.asarray(thumbnail, dtype=np.int16)
+  bits = np.packbits((pixels[:, 1:] > pixels[:, :-1]).ravel())
+  return int.from_bytes(bits.tobytes(), "big")
+
+def text_minhash(page_words):
+  """Return the MinHash of the page's word shingles, or None for pages with too little text."""
+  shingles = rolling_hashes(page_words.ids, SHINGLE_LENGTH)
+  if not len(shingles):
+    return None
+  with np.errstate(over="ignore"):
+    hashed = shingles[None, :] * MINHASH_MULTIPLIERS[:, None] + MINHASH_OFFSETS[:, None]
+  return hashed.min(axis=1)
+
+class PageAligner:
+  """
+  Align the pages of two documents before any full resolution work, so an inserted or
+  deleted page does not shift every later page pair out of step. Pages are compared by a
+  perceptual hash of a thumbnail and a MinHash of their text shingles, and the two page
+  sequences are aligned by maximising the summed similarity of the matched pairs. Old and new
+  pages left over between the same two aligned pairs, such as heavily edited pages, are then
+  paired by position, so only pages beyond the other side's count are reported as inserted
+  or deleted.
+  """
+
+  def __init__(self, use_images=True):
+    """
+    :param use_images: Compare page thumbnails too. Without them pages are aligned on their
+      text alone and two pages without text always match.
+    """
+    self.use_images = use_images
+
+  def signatures(self, doc, pages_words, page_nums=None):
+    """
+    Return the signatures of the pages of a document
+    :param doc: Open document
+    :param pages_words: PageWords of the pages, in the order of page_nums
+    :param page_nums: Numbers of the pages, or None for every page of the document
+    """
+    if page_nums is None:
+      page_nums = range(len(doc))
+    image_hashes = None
+    if self.use_images:
+      image_hashes = np.array([image_hash(doc[page_num]) for page_num in page_nums], dtype=np.uint64)
+    minhashes = [text_minhash(page_words) for page_words in pages_words]
+    return image_hashes, minhashes
+
+  def similarity(self, old_signatures, new_signatures):
+    """Return the (old pages, new pages) similarity matrix of two documents."""
+    old_image_hashes, old_minhashes = old_signatures
+    new_image_hashes, new_minhashes = new_signatures
+
+    use_images = old_image_hashes is not None and new_image_hashes is not None
+    if not use_images:
+      image_similarity = np.ones((len(old_minhashes), len(new_minhashes)))
+    else:
+      differing_bits = np.bitwise_count(old_image_hashes[:, None] ^ new_image_hashes[None, :])
+      image_similarity = 1 - differing_bits / 64
+
+    old_has_text = np.array([minhash is not None for minhash in old_minhashes])
+    new_has_text = np.array([minhash is not None for minhash in new_minhashes])
+    both_have_text = old_has_text[:, None] & new_has_text[None, :]
+    if not both_have_text.any():
+      return image_similarity
+
+    empty = np.zeros(MINHASH_PERMUTATIONS, dtype=np.uint64)
+    old_matrix = np.array([empty if minhash is None else minhash for minhash in old_minhashes])
+    new_matrix = np.array([empty if minhash is None else minhash for minhash in new_minhashes])
+    text_similarity = np.zeros(both_have_text.shape)
+    for permutation in range(MINHASH_PERMUTATIONS):
+      text_similarity += old_matrix[:, None, permutation] == new_matrix[None, :, permutation]
+    text_similarity /= MINHASH_PERMUTATIONS
+
+    combined = text_similarity
+    if use_images:
+      combined = TEXT_WEIGHT * text_similarity + (1 - TEXT_WEIGHT) * image_similarity
+
+    # A page with text never matches a page without text
+    similarity = np.where(both_have_text, combined, image_similarity)
+    return np.where(old_has_text[:, None] == new_has_text[None, :], similarity, 0)
+
+  def align(self, similarity):
+    """
+    Align two page sequences from their similarity matrix
+    :return: List of (old_page, new_page) tuples in document order, with None on the missing
+      side of deleted and inserted pages
+    """
+    return self.pair_gaps(self.align_similar(similarity))
+
+  def pair_gaps(self, alignment):
+    """Pair the old and new pages of every run of unaligned pages by position."""
+    paired = []
+    gap = []
+    for pair in alignment + [None]:
+      if pair is not None and (pair[0] is None or pair[1] is None):
+        gap.append(pair)
+        continue
+      old_pages = [old_page for old_page, new_page in gap if new_page is None]
+      new_pages = [new_page for old_page, new_page in gap if old_page is None]
+      common = min(len(old_pages), len(new_pages))
+      paired += list(zip(old_pages[:common], new_pages[:common]))
+      paired += [(old_page, None) for old_page in old_pages[common:]]
+      paired += [(None, new_page) for new_page in new_pages[common:]]
+      gap = []
+      if pair is not None:
+        paired.append(pair)
+    return paired
+
+  def align_similar(self, similarity):
+    """Align the pages of a similarity matrix that are similar enough, leaving the others unaligned."""
+    old_count, new_count = similarity.shape
+    if old_count * new_count > MAX_ALIGNMENT_CELLS:
+      common = min(old_count, new_count)
+      return (
+        [(page_num, page_num) for page_num in range(common)]
+        + [(page_num, None) for page_num in range(common, old_count)]
+        + [(None, page_num) for page_num in range(common, new_count)]
+      )
+
+    # Gaps cost nothing, so each row is the running maximum of the diagonal and upper moves
+    gain = similarity - MATCH_THRESHOLD
+    scores = np.zeros((old_count + 1, new_count + 1))
+    for row in range(1, old_count + 1):
+      candidates = scores[row - 1].copy()
+      candidates[1:] = np.maximum(candidates[1:], scores[row - 1, :-1] + gain[row - 1])
+      scores[row] = np.maximum.accumulate(candidates)
+
+    alignment = []
+    row, column = old_count, new_count
+    while row or column:
+      if row and column and gain[row - 1, column - 1] > 0 and scores[row, column] == scores[row - 1, column - 1] + gain[row - 1, column - 1]:
+        alignment.append((row - 1, column - 1))
+        row, column = row - 1, column - 1
+      elif row and scores[row, column] == scores[row - 1, column]:
+        alignment.append((row - 1, None))
+        row -= 1
+      else:
+        alignment.append((None, column - 1))
+        column -= 1
+    return alignment[::-1]
@@ -0,0 +1,179 @@
+# PDF Comparer
+# Copyright (C) 2024 Ryan Lacadin
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import hashlib
+import re
+
+# Indirect object references, e.g. "12 0 R"
+REFERENCE_PATTERN = re.compile(rb"(\d+) 0 R")
+
+# Back references that would pull the whole page tree into a resource digest
+BACK_REFERENCE_PATTERN = re.compile(rb"/(Parent|P|StructParent|StructParents)\s+\d+(\s+0\s+R)?")
+
+def hash_file(file_path):
+  """Return the SHA-256 hex digest of a file's content."""
+  digest = hashlib.sha256()
+  with open(file_path, "rb") as file:
+    for chunk in iter(lambda: file.read(1024 * 1024), b""):
+      digest.update(chunk)
+  return digest.hexdigest()
+
+def rounded(value):
+  """Round the floats of nested drawing values to hundredths of a point, so rounding noise does not count."""
+  if isinstance(value, float):
+    return round(value, 2)
+  if isinstance(value, (tuple, list)):
+    return tuple(rounded(item) for item in value)
+  return value
+
+def graphics_fingerprint(page):
+  """
+  Return a digest of what a page draws besides its text: vector paths, images and
+  annotations, with their positions
+  """
+  digest = hashlib.sha256()
+  for drawing in page.get_cdrawings():
+    digest.update(repr([(key, rounded(drawing[key])) for key in sorted(drawing)]).encode())
+  for image in page.get_image_info(hashes=True):
+    digest.update(image["digest"])
+    digest.update(repr(rounded((tuple(image["bbox"]), tuple(image["transform"])))).encode())
+  for annot in page.annots():
+    digest.update(repr((annot.type[0], rounded(tuple(annot.rect)), annot.info.get("content"))).encode())
+  return digest.hexdigest()
+
+class PageFingerprinter:
+  """
+  Fingerprint pages by what they draw, so structurally identical pages can be skipped.
+  A fingerprint covers the page geometry, the decompressed content streams, and a
+  recursive digest of every resource (fonts, images, xobjects) and annotation the page
+  references. Object numbers are replaced by the digest of the object they point to,
+  so the same page saved into differently numbered files still matches.
+  """
+
+  def __init__(self, doc):
+    """
+    :param doc: Open document whose pages will be fingerprinted.
+    """
+    self.doc = doc
+    self.object_digests = {}
+    self.page_numbers = None # Page object xref -> page number, built on first use
+
+  def leaf_digest(self, xref):
+    """
+    Return the digest of an object that is not walked into, or None. Pages, which link
+    annotations and destinations point at, stand for their page number, so a page does not
+    take in the content of the pages it links to.
+    """
+    value_type, value = self.doc.xref_get_key(xref, "Type")
+    if value_type != "name" or value not in ("/Page", "/Pages"):
+      return None
+    if value == "/Pages":
+      return b"pages"
+    if self.page_numbers is None:
+      self.page_numbers = {self.doc.page_xref(page_num): page_num for page_num in range(self.doc.page_count)}
+    return b"page:%d" % self.page_numbers.get(xref, -1)
+
+  def object_source(self, xref):
+    """Return the source of an indirect object without its back references."""
+    return BACK_REFERENCE_PATTERN.sub(b"", self.doc.xref_object(xref, compressed=True).encode("latin-1", "replace"))
+
+  def object_digest(self, xref):
+    """
+    Return a digest of an indirect object and everything it references. The references are
+    walked depth first with an explicit stack, as chains of objects can be thousands long.
+    """
+    if xref in self.object_digests:
+      return self.object_digests[xref]
+    stack = [(xref, None)] # (xref, source once its references are pushed)
+    walking = set()
+    while stack:
+      current, source = stack[-1]
+      if source is None:
+        if current in self.object_digests or not 0 < current < self.doc.xref_length():
+          stack.pop()
+          continue
+        leaf = self.leaf_digest(current)
+        if leaf is not None:
+          self.object_digests[current] = leaf
+          stack.pop()
+          continue
+        source = self.object_source(current)
+        stack[-1] = (current, source)
+        walking.add(current)
+        for match in REFERENCE_PATTERN.finditer(source):
+          reference = int(match.group(1))
+          if reference not in self.object_digests and reference not in walking:
+            stack.append((reference, None))
+        continue
+
+      stack.pop()
+      walking.discard(current)
+      digest = hashlib.sha256()
+      digest.update(self.replace_references(source))
+      if self.doc.xref_is_stream(current):
+        digest.update(self.doc.xref_stream_raw(current))
+      self.object_digests[current] = digest.digest()
+    return self.object_digests.get(xref, b"cycle:%d" % xref)
+
+  def replace_references(self, source):
+    """Return a digest of object source with references replaced by the object digests known so far."""
+    digest = hashlib.sha256()
+    position = 0
+    for match in REFERENCE_PATTERN.finditer(source):
+      reference = int(match.group(1))
+      digest.update(source[position:match.start()])
+      # References back into the objects being walked, and invalid ones, only count by number
+      digest.update(self.object_digests.get(reference, b"cycle:%d" % reference))
+      position = match.end()
+    digest.update(source[position:])
+    return digest.digest()
+
+  def source_digest(self, source):
+    """Return a digest of PDF object source with references replaced by object digests."""
+    source = BACK_REFERENCE_PATTERN.sub(b"", source.encode("latin-1", "replace"))
+    for match in REFERENCE_PATTERN.finditer(source):
+      self.object_digest(int(match.group(1)))
+    return self.replace_references(source)
+
+  def page_key_digest(self, page, key):
+    """Return a digest of a page dictionary entry, following inheritance for Resources."""
+    xref = page.xref
+    while xref:
+      value_type, value = self.doc.xref_get_key(xref, key)
+      if value_type != "null":
+        return self.source_digest(value)
+      if key != "Resources":
+        break
+      parent_type, parent = self.doc.xref_get_key(xref, "Parent")
+      xref = int(parent.split()[0]) if parent_type == "xref" else 0
+    return b""
+
+  def fingerprint_page(self, page):
+    """
+    Fingerprint a single page
+    :param page: Page of the document passed to the constructor
+    :return: Hex digest identifying what the page draws
+    """
+    digest = hashlib.sha256()
+    digest.update(repr((tuple(page.mediabox), tuple(page.cropbox), page.rotation)).encode())
+    digest.update(page.read_contents())
+    digest.update(self.page_key_digest(page, "Resources"))
+    digest.update(self.page_key_digest(page, "Annots"))
+    return digest.hexdigest()
+
+  def fingerprint_document(self):
+    """Return the fingerprints of every page in the document."""
+    return [self.fingerprint_page(page) for page in self.doc]
@@ -0,0 +1,127 @@
+# PDF Comparer
+# Copyright (C) 2024 Ryan Lacadin
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+from io import BytesIO
+import numpy as np
+import pymupdf #PyMuPDF
+from PIL import Image
+from text_comparer import ADDED, REMOVED, MARKER
+
+# Names of the optional content layers of a report
+FORMAT_LAYER = "Format differences"
+TEXT_LAYER = "Text differences"
+
+def encode_tint_mask(old_array, overlay_array, opacity=0.5, top=0):
+  """
+  Encode where an overlay tinted the old page as a compact grayscale PNG alpha mask
+  :param old_array: RGB array of the old page
+  :param overlay_array: Tinted copy of old_array
+  :param top: Page row of the first array row, when the arrays are a strip of the page
+  :return: ((x0, y0, x1, y1) pixel box of the mask, PNG bytes), or None if nothing was tinted
+  """
+  height = min(old_array.shape[0], overlay_array.shape[0])
+  width = min(old_array.shape[1], overlay_array.shape[1])
+  mask = (overlay_array[:height, :width] != old_array[:height, :width, :3]).any(axis=2)
+  rows = np.flatnonzero(mask.any(axis=1))
+  columns = np.flatnonzero(mask.any(axis=0))
+  if not len(rows):
+    return None
+
+  x0, y0, x1, y1 = int(columns[0]), int(rows[0]), int(columns[-1]) + 1, int(rows[-1]) + 1
+  alpha = mask[y0:y1, x0:x1].astype(np.uint8) * np.uint8(int(opacity * 255))
+  buffer = BytesIO()
+  Image.fromarray(alpha, mode="L").save(buffer, "PNG", optimize=True)
+  return (x0, y0 + top, x1, y1 + top), buffer.getvalue()
+
+class PDFReport:
+  """
+  Single PDF of the differences of a document pair, replacing the overlay, combined and word
+  difference images. Every changed page embeds the old page once, as vectors, with the tint
+  of the format differences and the text annotations on optional content layers that
+  reviewers can toggle in their PDF viewer.
+  """
+
+  def __init__(self, quality, font_size, tint_color=(170, 51, 106)):
+    """
+    :param quality: Zoom factor the tint masks were rendered at
+    :param font_size: Font size of the text annotations in points
+    :param tint_color: RGB colour of the format differences
+    """
+    self.quality = quality
+    self.font_size = font_size
+    self.tint_color = tint_color
+    self.font = pymupdf.Font("helv")
+    self.widths = {}
+    self.doc = pymupdf.open()
+    self.format_layer = self.doc.add_ocg(FORMAT_LAYER)
+    self.text_layer = self.doc.add_ocg(TEXT_LAYER)
+    self.toc = []
+
+  def add_page(self, old_doc, old_page_num, page_num, tint_masks=(), word_diffs=None):
+    """
+    Append a changed page to the report
+    :param old_doc: Open old document the page is embedded from
+    :param old_page_num: Page number in the old document
+    :param page_num: Page number the page is reported under
+    :param tint_masks: Results of encode_tint_mask, one per strip of a page compared in strips
+    :param word_diffs: WordDiffs of the page, or None
+    """
+    old_page = old_doc.load_page(old_page_num)
+    page = self.doc.new_page(width=old_page.rect.width, height=old_page.rect.height)
+    if old_page.get_contents():
+      page.show_pdf_page(page.rect, old_doc, old_page_num)
+
+    for (x0, y0, x1, y1), mask_png in tint_masks:
+      colour = BytesIO()
+      Image.new("RGB", (x1 - x0, y1 - y0), self.tint_color).save(colour, "PNG")
+      rect = pymupdf.Rect(x0, y0, x1, y1) / self.quality
+      page.insert_image(rect, stream=colour.getvalue(), mask=mask_png, oc=self.format_layer)
+
+    if word_diffs:
+      self.write_word_diffs(page, word_diffs)
+
+    self.toc.append([1, f"page_{page_num:02d}", self.doc.page_count])
+
+  def text_width(self, text):
+    """Return the width of the text in the annotation font, measuring it only the first time."""
+    width = self.widths.get(text)
+    if width is None:
+      width = self.widths[text] = self.font.text_length(text, self.font_size)
+    return width
+
+  def write_word_diffs(self, page, word_diffs):
+    """Write the added and removed words above their positions, laid out like annotate_text_differences."""
+    writers = {
+      ADDED: pymupdf.TextWriter(page.rect, color=(0, 0.8, 0)),
+      REMOVED: pymupdf.TextWriter(page.rect, color=(0.8, 0, 0)),
+      MARKER: pymupdf.TextWriter(page.rect, color=(0, 0, 0)),
+    }
+    baseline_offset = self.font.descender * self.font_size
+    for text_pos_x, text_pos_y, word_text, sign in word_diffs.layout(self.text_width):
+      writers[sign].append((text_pos_x, text_pos_y + baseline_offset), word_text, font=self.font, fontsize=self.font_size)
+
+    for writer in writers.values():
+      if writer.text_rect.width:
+        writer.write_text(page, oc=self.text_layer)
+
+  def save(self, file_path):
+    """Write the report with a bookmark for every page and close it."""
+    self.doc.set_toc(self.toc)
+    temp_path = f"{file_path}.part"
+    self.doc.save(temp_path, garbage=3, deflate=True)
+    self.doc.close()
+    os.replace(temp_path, file_path)
@@ -15,57 +15,164 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import os
+import sys
 import time
 import shutil
 import json
-from io import BytesIO
-import pymupdf #PyMuPDF
-from text_comparer import TextComparer
-from image_utils import ImageUtils
-import gc
-from contextlib import contextmanager
+import argparse
+from contextlib import contextmanager, nullcontext, redirect_stdout
 from concurrent.futures import ThreadPoolExecutor, as_completed
 from threading import Lock
+from page_fingerprint import PageFingerprinter, graphics_fingerprint
+from collections import Counter
+from run_manifest import RunManifest
+from run_journal import RunJournal
+from results_writer import ResultsWriter, page_records
+from vector_compare import VectorComparer, changed_boxes, change_records
+from memory_budget import MemoryBudget, default_budget_bytes, page_footprint, peak_rss_bytes
+from instrumentation import Metrics, MetricsExporter, profile_capture
+# PyMuPDF, NumPy and PIL take most of the start-up time, so they are imported by the stages
+# that use them, keeping "import pdfcomparer" and the command line help fast
 
-# Load configuration from config.json
-with open('config.json', 'r') as config_file:
-  config = json.load(config_file)
-  
-# Set default core count if not specified by the user
-if config["core_count"] is None:
-  config["core_count"] = int(os.cpu_count())
+# Settings used by compare() when no config file is given, and for keys a config file leaves out
+DEFAULT_CONFIG = {
+  "old_documents_dir": "Old_Documents",
+  "new_documents_dir": "New_Documents",
+  "output_dir": "Output",
+  "quality": 2.0,
+  "font_size": 8,
+  "core_count": None,
+}
+
+def load_config(config_path="config.json", overrides=None):
+  """
+  Load the settings of a run
+  :param config_path: JSON config file, or None to start from DEFAULT_CONFIG alone
+  :param overrides: Dictionary of settings replacing those of the file
+  :return: Configuration dictionary
+  """
+  config = dict(DEFAULT_CONFIG)
+  if config_path:
+    with open(config_path, 'r') as config_file:
+      config.update(json.load(config_file))
+  config.update(overrides or {})
+
+  # Set default core count if not specified by the user
+  if config["core_count"] is None:
+    config["core_count"] = int(os.cpu_count())
+  return config
 
 @contextmanager
-def open_pdf(file_path: str):
-  doc = pymupdf.open(file_path)
+def open_pdf(file_path: str, metrics=None):
+  import pymupdf #PyMuPDF
+  with metrics.timer("open") if metrics else nullcontext():
+    doc = pymupdf.open(file_path)
   try:
     yield doc
   finally:
     doc.close()
 
 class PDFComparer:
-  def __init__(self,config):
+  def __init__(self, config, clear_output=True, structured_results=False):
     """
     Initialise PDFComparer with directories and quality settings from config.
     
     :param config: Configuration dictionary containing settings.
+    :param clear_output: Clear the output folder (disabled for worker processes).
+    :param structured_results: Collect the changed words and regions of every page even
+      without a results file, as compare() returns them.
     """
     
+    self.config = config
     self.old_documents_dir = config["old_documents_dir"]
     self.new_documents_dir = config["new_documents_dir"]
     self.output_dir = config["output_dir"]
     self.quality = config["quality"]
     self.font_size = config["font_size"] * self.quality # Scale font size with quality
     self.core_count = config["core_count"]
+    self.engine = config.get("engine", "process")
+    self.skip_identical_pages = config.get("skip_identical_pages", True)
+    self.text_diff_scope = config.get("text_diff_scope", "page")
+    self.page_alignment = config.get("page_alignment", True)
+    self.output_format = config.get("output_format", "images")
+    self.image_output = config.get("image_output", "pages")
+
+    # Pages rendering to more pixels than the threshold are rendered, compared and written in strips
+    tile_threshold_mp = config.get("tile_threshold_mp", 50)
+    self.tile_threshold_pixels = tile_threshold_mp * 1000 * 1000 if tile_threshold_mp else None
+    self.tile_height = config.get("tile_height", 512)
+    self.text_only = config.get("comparison_mode", "full") == "text-only"
+
+    # Page work only starts while its estimated footprint fits in the memory budget
+    memory_budget_mb = config.get("memory_budget_mb")
+    budget_bytes = memory_budget_mb * 1024 * 1024 if memory_budget_mb else default_budget_bytes()
+    self.memory_budget = MemoryBudget(budget_bytes)
+
+    # Stage timers and counters, exported per document and per run when a metrics directory is set
+    self.metrics_dir = config.get("metrics_dir")
+    self.metrics = Metrics(enabled=bool(self.metrics_dir))
+    self.run_metrics = Metrics(enabled=bool(self.metrics_dir))
+    self.exporter = MetricsExporter(self.metrics_dir) if self.metrics_dir else None
+    self.profile_documents = set(config.get("profile_documents", []))
+
+    self.cache = None
+    if config.get("cache_dir"):
+      from render_cache import RenderCache
+      self.cache = RenderCache(config["cache_dir"], config.get("cache_max_mb", 2048) * 1024 * 1024)
+
+    # The text-only mode never rasterizes, so the imaging modules and PIL are only imported when pages are rendered
+    self.image_utils = None
+    if not self.text_only:
+      from image_utils import ImageUtils
+      coarse_zoom = config.get("coarse_zoom") if config.get("render_strategy") == "coarse" else None
+      self.image_utils = ImageUtils(
+        self.quality, config.get("diff_tolerance", 0), coarse_zoom, self.cache, self.metrics,
+        config.get("region_merge_distance", 4), config.get("min_region_area", 1)
+      )
+    from text_comparer import TextComparer
+    self.text_comparer = TextComparer(self.cache, self.metrics)
+
+    # The vector mode matches the objects pages draw and only rasterizes the ones that changed
+    self.vector_comparer = None
+    if config.get("comparison_mode", "full") == "vector":
+      self.vector_comparer = VectorComparer(config.get("vector_tolerance", 0.01), config.get("move_radius", 72), self.metrics)
 
-    self.image_utils = ImageUtils(self.quality)
-    self.text_comparer = TextComparer()
+    # Structured per-page results, always written in the text-only mode
+    results_file = config.get("results_file")
+    if self.text_only and not results_file:
+      results_file = os.path.join(self.output_dir, "results.ndjson")
+    self.structured_results = bool(results_file) or structured_results
 
     # Ensure output directory exists
     os.makedirs(self.output_dir, exist_ok=True)
-    self.clear_output_folder()
+
+    # Incremental runs keep the outputs the manifest of the last run vouches for, and resumed
+    # runs those the journal of the interrupted run records
+    self.manifest = None
+    self.journal = None
+    self.pair_states = {}
+    if clear_output:
+      if config.get("incremental", False):
+        self.manifest = RunManifest(self.output_dir, config)
+      if config.get("journal", True):
+        self.journal = RunJournal(self.output_dir, config, config.get("resume", False))
+      if not (self.manifest and self.manifest.exists) and not (self.journal and self.journal.resumed):
+        self.clear_output_folder()
+      if self.journal:
+        self.journal.open()
     
+    self.results = None
+    if results_file and clear_output:
+      self.results = ResultsWriter(results_file, keep_previous=bool(self.manifest and self.manifest.exists))
+
     self.completed_comparisons = 0
+    self.output_writer = None
+    self.writer_threads = config.get("writer_threads", 2)
+    self.writer_queue_bytes = config.get("writer_queue_mb", 512) * 1024 * 1024
+
+    self.skipped_pages = 0
+    self.reflowed_pages = 0
+    self.cache_stats = Counter()
     self.lock = Lock()
 
   def clear_output_folder(self):
@@ -73,14 +180,60 @@ class PDFComparer:
     for filename in os.listdir(self.output_dir):
       if filename == '.gitkeep':
         continue
-      file_path = os.path.join(self.output_dir, filename)
-      try:
-        if os.path.isfile(file_path) or os.path.islink(file_path):
-          os.unlink(file_path)
-        elif os.path.isdir(file_path):
-          shutil.rmtree(file_path)
-      except Exception as e:
-        print(f'Failed to delete {file_path}. Reason: {e}')
+      self.remove_output(os.path.join(self.output_dir, filename))
+
+  def remove_output(self, file_path):
+    """Delete an output file or directory if it exists."""
+    try:
+      if os.path.isfile(file_path) or os.path.islink(file_path):
+        os.unlink(file_path)
+      elif os.path.isdir(file_path):
+        shutil.rmtree(file_path)
+    except Exception as e:
+      print(f'Failed to delete {file_path}. Reason: {e}')
+
+  def select_changed_pairs(self, pairs):
+    """
+    Drop the pairs the last run already compared with the same inputs and settings,
+    and remove the outputs of pairs that changed or no longer exist
+    :param pairs: List of (old_file_path, new_file_path) tuples
+    :return: List of the pairs that need comparing
+    """
+    changed_pairs = []
+    for pair in pairs:
+      if self.prepare_pair(*pair):
+        changed_pairs.append(pair)
+      elif self.results and not self.results.keep_document(os.path.basename(pair[0])):
+        # The results file of the last run lacks the pair, e.g. as it was not written then
+        self.prepare_pair(*pair, force=True)
+        changed_pairs.append(pair)
+    pair_keys = {os.path.basename(old_file_path) for old_file_path, _ in pairs}
+    for pair_key in set(self.manifest.entries) - pair_keys:
+      entry = self.manifest.remove(pair_key)
+      if entry.get("output_dir"):
+        self.remove_output(entry["output_dir"])
+
+    print(f"Kept {len(pairs) - len(changed_pairs)} unchanged document pairs from the last run")
+    return changed_pairs
+
+  def prepare_pair(self, old_file_path, new_file_path, force=False):
+    """
+    Remove the outputs of a document pair about to be compared (again) and, in incremental
+    runs, record the state of its inputs
+    :param force: Prepare the pair even if the manifest shows it is current
+    :return: False if the manifest shows the pair was already compared with the same inputs and settings
+    """
+    if self.manifest:
+      pair_key = os.path.basename(old_file_path)
+      state = self.manifest.pair_state(pair_key, old_file_path, new_file_path)
+      if not force and self.manifest.is_current(pair_key, state):
+        return False
+      previous_output = self.manifest.entries.get(pair_key, {}).get("output_dir")
+      if previous_output:
+        self.remove_output(previous_output)
+      self.pair_states[old_file_path] = state
+    self.remove_output(self.get_output_path(old_file_path))
+    return True
 
   def get_pdf_files(self, directory):
     """
@@ -89,99 +242,691 @@ class PDFComparer:
     :return: List of PDF file names"""
     return [f for f in os.listdir(directory) if f.endswith('.pdf')]
   
-  def save_page_image(self, image, output_dir, page_num):
-    """Save a page image to the specified output directory."""
-    if not os.path.exists(output_dir):
-      os.makedirs(output_dir)
-    image_file_path = os.path.join(output_dir, f"page_{page_num:02d}.jpg")
-    image.convert("RGB").save(image_file_path, "JPEG", quality=85)
+  def save_page_image(self, image, output_dir, page_num, regions=None):
+    """
+    Queue a page image to be saved to the specified output directory by the output writer
+    :param regions: Pixel boxes of the changes on the page. With "image_output" set to
+      "regions" only crops around them are saved instead of the whole page, which is still
+      saved when there are none.
+    :return: Paths of the image files queued
+    """
+    if self.output_writer is None:
+      from output_writer import OutputWriter
+      self.output_writer = OutputWriter(self.writer_threads, self.writer_queue_bytes, self.metrics)
+    if self.image_output != "regions" or not regions:
+      image_file_path = os.path.join(output_dir, f"page_{page_num:02d}.jpg")
+      self.output_writer.submit(os.path.dirname(output_dir), image, image_file_path)
+      return [image_file_path]
+    image_file_paths = []
+    for region_num, box in enumerate(self.image_utils.crop_boxes(regions, image.size), start=1):
+      image_file_path = os.path.join(output_dir, f"page_{page_num:02d}_region_{region_num:02d}.jpg")
+      self.output_writer.submit(os.path.dirname(output_dir), image.crop(box), image_file_path)
+      image_file_paths.append(image_file_path)
+    return image_file_paths
+
+  def flush_page_images(self, output_dir):
+    """
+    Wait for the queued page images of a document to be written
+    :param output_dir: Output directory of the document
+    :raises OSError: if page images of the document could not be written
+    """
+    if self.output_writer is not None:
+      self.output_writer.flush(output_dir)
+
+  def close_output_writer(self):
+    """
+    Wait for queued page images to be written and stop the output writer
+    :raises OSError: if page images could not be written
+    """
+    if self.output_writer is not None:
+      output_writer, self.output_writer = self.output_writer, None
+      output_writer.close()
+
+  def close_worker(self):
+    """
+    Flush a worker process at exit, exporting the metrics no page result carried back
+    :return: Snapshot of those metrics, for the run totals
+    """
+    try:
+      self.close_output_writer()
+    except OSError as e:
+      # The main process finds the missing images through the outputs of the page results
+      print(e)
+    snapshot = self.metrics.drain()
+    if self.exporter:
+      worker_metrics = Metrics()
+      worker_metrics.merge(snapshot)
+      if worker_metrics.timers or worker_metrics.counters:
+        self.exporter.write_record("worker", worker_metrics)
+    return snapshot
+
+  def profile_scope(self, old_doc, label):
+    """Return a context manager profiling the work on old_doc if it is one of the profile_documents."""
+    document_name = os.path.basename(old_doc.name)
+    if document_name not in self.profile_documents:
+      return nullcontext()
+    profile_dir = os.path.join(self.metrics_dir or self.output_dir, "profiles")
+    return profile_capture(os.path.join(profile_dir, f"{os.path.splitext(document_name)[0]}_{label}"))
+
+  def get_output_dir(self, old_file_path):
+    """Return the output directory for the differences of a document pair."""
+    base_name = os.path.splitext(os.path.basename(old_file_path))[0]
+    return os.path.join(self.output_dir, f"diff_{base_name}")
+
+  def get_output_path(self, old_file_path):
+    """Return the output of a document pair: its image directory, or its report in the pdf output format."""
+    output_dir = self.get_output_dir(old_file_path)
+    return f"{output_dir}.pdf" if self.output_format == "pdf" else output_dir
+
+  def plan_document(self, old_doc, new_doc):
+    """
+    Work out which page pairs of two open documents need to be compared
+    :param old_doc: Open old document
+    :param new_doc: Open new document
+    :return: Plan dictionary whose "pages" entry lists the page units to compare
+    """
+    with self.profile_scope(old_doc, "plan"), self.metrics.timer("plan"):
+      plan = self.plan_pages(old_doc, new_doc)
+    if self.cache:
+      plan["cache_stats"] = self.cache.drain_stats()
+    if self.metrics.enabled:
+      plan["metrics"] = self.metrics.drain()
+    return plan
+
+  def plan_pages(self, old_doc, new_doc):
+    """Fingerprint, extract and align the pages of two open documents and list the page units to compare."""
+    # Text-only runs extract the words of the pages anyway, so fingerprints would not save any work
+    old_fingerprints = new_fingerprints = None
+    if self.skip_identical_pages and not self.text_only:
+      with self.metrics.timer("fingerprint"):
+        old_fingerprints = PageFingerprinter(old_doc).fingerprint_document()
+        new_fingerprints = PageFingerprinter(new_doc).fingerprint_document()
+
+    # Documents whose pages are all identical in order need no words, alignment or page work
+    all_identical = old_fingerprints is not None and old_fingerprints == new_fingerprints
+
+    # Words by page number, only extracted for the pages that need them
+    old_pages_words = {}
+    new_pages_words = {}
+
+    # Diff the text of the whole documents once, so reflowed text is not reported on every page
+    document_diff = None
+    if self.text_diff_scope == "document" and not all_identical:
+      old_pages_words = dict(enumerate(self.text_comparer.extract_document(old_doc)))
+      new_pages_words = dict(enumerate(self.text_comparer.extract_document(new_doc)))
+      from document_diff import DocumentDiff
+      with self.metrics.timer("text_diff"):
+        document_diff = DocumentDiff(list(old_pages_words.values()), list(new_pages_words.values()))
+
+    # Pair up the pages, finding inserted and deleted pages from cheap page signatures. Pages
+    # with an identical page on the other side match it outright and need no signature.
+    if self.page_alignment and not all_identical:
+      import numpy as np
+      from page_alignment import PageAligner
+      with self.metrics.timer("alignment"):
+        aligner = PageAligner(use_images=not self.text_only)
+        similarity = np.zeros((len(old_doc), len(new_doc)))
+        old_rest = list(range(len(old_doc)))
+        new_rest = list(range(len(new_doc)))
+        if old_fingerprints:
+          identical = np.array(old_fingerprints)[:, None] == np.array(new_fingerprints)[None, :]
+          similarity[identical] = 1
+          old_rest = [page_num for page_num in old_rest if not identical[page_num].any()]
+          new_rest = [page_num for page_num in new_rest if not identical[:, page_num].any()]
+        if old_rest and new_rest:
+          self.extract_missing_words(old_doc, old_pages_words, old_rest)
+          self.extract_missing_words(new_doc, new_pages_words, new_rest)
+          similarity[np.ix_(old_rest, new_rest)] = aligner.similarity(
+            aligner.signatures(old_doc, [old_pages_words[page_num] for page_num in old_rest], old_rest),
+            aligner.signatures(new_doc, [new_pages_words[page_num] for page_num in new_rest], new_rest),
+          )
+        alignment = aligner.align(similarity)
+    else:
+      common = min(len(old_doc), len(new_doc))
+      alignment = (
+        [(page_num, page_num) for page_num in range(common)]
+        + [(page_num, None) for page_num in range(common, len(old_doc))]
+        + [(None, page_num) for page_num in range(common, len(new_doc))]
+      )
+
+    page_units = []
+    inserted_pages = []
+    deleted_pages = []
+    unchanged_pairs = []
+    identical_pages = 0
+    reflowed_pages = 0
+    for old_page_num, new_page_num in alignment:
+      if old_page_num is None:
+        inserted_pages.append(new_page_num)
+        continue
+      if new_page_num is None:
+        deleted_pages.append(old_page_num)
+        continue
+      if old_fingerprints and old_fingerprints[old_page_num] == new_fingerprints[new_page_num]:
+        identical_pages += 1
+        unchanged_pairs.append((old_page_num, new_page_num, "identical"))
+        continue
+      page_unit = {"page": new_page_num, "old_page": old_page_num, "new_page": new_page_num}
+      if not self.text_only:
+        page_unit["footprint"] = max(
+          page_footprint(old_doc, old_page_num, self.quality, self.tile_threshold_pixels, self.tile_height),
+          page_footprint(new_doc, new_page_num, self.quality, self.tile_threshold_pixels, self.tile_height),
+        )
+      if document_diff:
+        if document_diff.is_reflowed(old_page_num, new_page_num) and self.graphics_unchanged(old_doc, new_doc, old_page_num, new_page_num):
+          reflowed_pages += 1
+          unchanged_pairs.append((old_page_num, new_page_num, "reflowed"))
+          continue
+        page_unit["word_diffs"] = document_diff.page_word_diffs(old_page_num, new_page_num)
+      page_units.append(page_unit)
+
+    # Without rasterizing, the page results come straight from the words already extracted
+    page_results = []
+    if self.text_only:
+      self.extract_missing_words(old_doc, old_pages_words, [page_unit["old_page"] for page_unit in page_units])
+      self.extract_missing_words(new_doc, new_pages_words, [page_unit["new_page"] for page_unit in page_units])
+      for page_unit in page_units:
+        word_diffs = page_unit.get("word_diffs")
+        if word_diffs is None:
+          word_diffs = self.text_comparer.compare_text(
+            old_pages_words[page_unit["old_page"]], new_pages_words[page_unit["new_page"]]
+          )
+        page_results.append(self.make_page_result(page_unit, bool(word_diffs), word_diffs))
+      page_units = []
+
+    return {
+      "pages": page_units,
+      "page_results": page_results,
+      "unchanged_pairs": unchanged_pairs,
+      "skipped_pages": identical_pages,
+      "reflowed_pages": reflowed_pages,
+      "inserted_pages": inserted_pages,
+      "deleted_pages": deleted_pages,
+    }
+
+  def extract_missing_words(self, doc, pages_words, page_nums):
+    """Extract the words of the pages of page_nums not yet in the pages_words dictionary into it."""
+    missing = [page_num for page_num in page_nums if page_num not in pages_words]
+    if missing:
+      pages_words.update(self.text_comparer.extract_pages(doc, missing))
+
+  def graphics_unchanged(self, old_doc, new_doc, old_page_num, new_page_num):
+    """Return True if a page pair draws the same paths, images and annotations, or pages are not rasterized anyway."""
+    if self.text_only:
+      return True
+    with self.metrics.timer("fingerprint"):
+      return graphics_fingerprint(old_doc[old_page_num]) == graphics_fingerprint(new_doc[new_page_num])
+
+  def compare_page(self, old_doc, new_doc, page_unit, output_dir):
+    """
+    Compare a single page pair and save images of any differences
+    :param old_doc: Open old document
+    :param new_doc: Open new document
+    :param page_unit: Page unit from plan_document
+    :param output_dir: Output directory of the document pair
+    :return: Page result dictionary
+    """
+    with self.profile_scope(old_doc, f"page_{page_unit['page']:02d}"):
+      old_page = old_doc.load_page(page_unit["old_page"])
+      new_page = new_doc.load_page(page_unit["new_page"])
+
+      # Extract and compare text (word-level differences), unless the document diff already did
+      word_diffs = page_unit.get("word_diffs")
+      if word_diffs is None:
+        word_diffs = self.text_comparer.extract_and_compare_text(old_page, new_page)
+
+      if self.output_format == "pdf":
+        page_result = self.compare_page_layers(old_page, new_page, page_unit, word_diffs)
+      else:
+        page_result = self.save_page_differences(old_page, new_page, page_unit, word_diffs, output_dir)
+
+    if self.cache:
+      page_result["cache_stats"] = self.cache.drain_stats()
+    if self.metrics.enabled:
+      page_result["metrics"] = self.metrics.drain()
+    return page_result
+
+  def make_page_result(self, page_unit, differences_found, word_diffs, regions=None, vector_diff=None):
+    """
+    Build the result of a compared page pair, with its changed words, raster regions and
+    changed objects when structured results are written
+    :param regions: Changed regions in pixels, or None if the pages were not rasterized
+    :param vector_diff: Result of VectorComparer.compare, or None outside the vector mode
+    """
+    self.metrics.count("pages_compared")
+    if differences_found:
+      self.metrics.count("pages_with_differences")
+    page_result = {
+      "page": page_unit["page"],
+      "old_page": page_unit["old_page"],
+      "new_page": page_unit["new_page"],
+      "differences": differences_found,
+    }
+    if self.structured_results:
+      page_result["words"] = word_diffs.to_records() if word_diffs else []
+      page_result["regions"] = self.image_utils.regions_to_points(regions) if regions else []
+      if vector_diff is not None:
+        page_result["objects"] = change_records(vector_diff)
+    return page_result
+
+  def compare_vectors(self, old_page, new_page):
+    """
+    Compare a page pair by the objects it draws in the vector mode
+    :return: (vector diff or None, pixel boxes holding every difference or None), both None
+      when the pages need a full raster comparison
+    """
+    vector_diff = self.vector_comparer.compare(old_page, new_page) if self.vector_comparer else None
+    if vector_diff is None:
+      return None, None
+    return vector_diff, self.image_utils.vector_regions(changed_boxes(vector_diff, 0), old_page)
+
+  def save_page_differences(self, old_page, new_page, page_unit, word_diffs, output_dir):
+    """
+    Render a page pair and save the overlay, combined and word difference images
+    :return: Page result dictionary
+    """
+    if self.is_tiled(old_page, new_page):
+      return self.save_tiled_page_differences(old_page, new_page, page_unit, word_diffs, output_dir)
+    from PIL import Image
+    page_num = page_unit["page"]
+
+    # Render pages and overlay differences (image-level differences)
+    vector_diff, dirty_regions = self.compare_vectors(old_page, new_page)
+    old_array, overlay_array = self.image_utils.compare_page_images(
+      old_page, new_page, tint_color=(170, 51, 106), base_required=bool(word_diffs), dirty_regions=dirty_regions
+    )
+    regions = None
+    if overlay_array is not None and (self.structured_results or self.image_output == "regions"):
+      regions = self.image_utils.changed_regions(old_array, overlay_array)
+    overlay_image = Image.fromarray(overlay_array) if overlay_array is not None else None
+    del overlay_array
+    outputs = []
+
+    # Save the overlay before it is annotated into the combined image
+    if overlay_image:
+      overlay_output_dir = os.path.join(output_dir, "overlay_differences")
+      outputs += self.save_page_image(overlay_image, overlay_output_dir, page_num, regions)
+
+    # Combined image: Overlay + Annotated text differences
+    combined_image = None
+    word_boxes = []
+    if overlay_image or word_diffs:
+      combined_image = overlay_image if overlay_image else Image.fromarray(old_array)
+      if word_diffs:
+        if overlay_image:
+          combined_image = overlay_image.copy() # The queued overlay must not change
+
+        word_boxes = self.image_utils.annotate_text_differences(
+          combined_image, word_diffs, self.font_size
+        )
+      combined_output_dir = os.path.join(output_dir, "combined_differences")
+      outputs += self.save_page_image(combined_image, combined_output_dir, page_num, (regions or []) + word_boxes)
+
+    if word_diffs:
+      word_diff_output_dir = os.path.join(output_dir, "word_differences")
+      word_diff_image = Image.fromarray(old_array)
+      self.image_utils.annotate_text_differences(
+        word_diff_image, word_diffs, self.font_size
+      )
+      outputs += self.save_page_image(word_diff_image, word_diff_output_dir, page_num, word_boxes)
+
+    differences_found = bool(overlay_image or word_diffs)
 
-  def compare_pdfs(self, old_file_path, new_file_path):
+    # Drop the page buffers before the next page is rendered
+    del overlay_image, combined_image, old_array
+
+    page_result = self.make_page_result(page_unit, differences_found, word_diffs, regions, vector_diff)
+    page_result["outputs"] = outputs
+    return page_result
+
+  def compare_page_layers(self, old_page, new_page, page_unit, word_diffs):
+    """
+    Compare a single page pair for the PDF report: instead of saving images, return the
+    tint mask and word differences the report draws as layers over the old page
+    :return: Page result dictionary with a "layers" entry when the pages differ
+    """
+    from pdf_report import encode_tint_mask
+    if self.is_tiled(old_page, new_page):
+      return self.compare_tiled_page_layers(old_page, new_page, page_unit, word_diffs)
+    vector_diff, dirty_regions = self.compare_vectors(old_page, new_page)
+    old_array, overlay_array = self.image_utils.compare_page_images(
+      old_page, new_page, tint_color=(170, 51, 106), base_required=False, dirty_regions=dirty_regions
+    )
+    tint_masks = []
+    regions = None
+    if overlay_array is not None:
+      tint_mask = encode_tint_mask(old_array, overlay_array)
+      tint_masks = [tint_mask] if tint_mask else []
+      if self.structured_results:
+        regions = self.image_utils.changed_regions(old_array, overlay_array)
+    del old_array, overlay_array
+
+    return self.make_layers_result(page_unit, tint_masks, word_diffs, regions, vector_diff)
+
+  def make_layers_result(self, page_unit, tint_masks, word_diffs, regions, vector_diff=None):
+    """Build the page result of compare_page_layers, with a "layers" entry when the pages differ."""
+    page_result = self.make_page_result(page_unit, bool(tint_masks or word_diffs), word_diffs, regions, vector_diff)
+    if page_result["differences"]:
+      page_result["layers"] = {
+        "old_page": page_unit["old_page"],
+        "tint_masks": tint_masks,
+        "word_diffs": word_diffs if word_diffs else None,
+      }
+    return page_result
+
+  def is_tiled(self, old_page, new_page):
+    """Return True if the page pair is large enough to be compared in strips."""
+    if not self.tile_threshold_pixels or old_page.rotation or new_page.rotation:
+      return False
+    return any(
+      width * height > self.tile_threshold_pixels
+      for width, height in (self.image_utils.render_size(old_page), self.image_utils.render_size(new_page))
+    )
+
+  def save_tiled_page_differences(self, old_page, new_page, page_unit, word_diffs, output_dir):
+    """
+    Compare an oversized page pair strip by strip, streaming the overlay, combined and word
+    difference images to PNG files as the strips are compared, so no full page image is held
+    :return: Page result dictionary
+    """
+    import numpy as np
+    from PIL import Image
+    from output_writer import PNGStreamWriter
+    page_num = page_unit["page"]
+    size = self.image_utils.render_size(old_page)
+    kinds = ["overlay_differences", "combined_differences"] + (["word_differences"] if word_diffs else [])
+    writers = {
+      kind: PNGStreamWriter(os.path.join(output_dir, kind, f"page_{page_num:02d}.png"), *size)
+      for kind in kinds
+    }
+    regions = []
+    tinted_any = False
+    try:
+      for top, old_strip, tinted_strip in self.image_utils.compare_page_strips(
+        old_page, new_page, self.tile_height, tint_color=(170, 51, 106)
+      ):
+        overlay_strip = old_strip
+        if tinted_strip is not None:
+          tinted_any = True
+          overlay_strip = tinted_strip
+          if self.structured_results:
+            strip_regions = self.image_utils.changed_regions(old_strip, tinted_strip)
+            regions += [(x0, y0 + top, x1, y1 + top) for x0, y0, x1, y1 in strip_regions]
+
+        strips = {"overlay_differences": overlay_strip, "combined_differences": overlay_strip}
+        if word_diffs:
+          for kind, base_strip in (("combined_differences", overlay_strip), ("word_differences", old_strip)):
+            strip_image = Image.fromarray(base_strip)
+            self.image_utils.annotate_text_differences(strip_image, word_diffs, self.font_size, top)
+            strips[kind] = np.asarray(strip_image)
+        with self.metrics.timer("encode"):
+          for kind, writer in writers.items():
+            writer.write_rows(strips[kind])
+        del old_strip, tinted_strip, overlay_strip, strips
+    except BaseException:
+      for writer in writers.values():
+        writer.close(keep=False)
+      raise
+
+    kept = {
+      "overlay_differences": tinted_any,
+      "combined_differences": tinted_any or bool(word_diffs),
+      "word_differences": True,
+    }
+    for kind, writer in writers.items():
+      writer.close(keep=kept[kind])
+
+    regions = self.image_utils.merge_regions(regions, size) if regions else None
+    page_result = self.make_page_result(page_unit, tinted_any or bool(word_diffs), word_diffs, regions)
+    page_result["outputs"] = [writer.file_path for kind, writer in writers.items() if kept[kind]]
+    return page_result
+
+  def compare_tiled_page_layers(self, old_page, new_page, page_unit, word_diffs):
+    """
+    Compare an oversized page pair for the PDF report strip by strip, with one tint mask per
+    changed strip
+    :return: Page result dictionary with a "layers" entry when the pages differ
+    """
+    from pdf_report import encode_tint_mask
+    size = self.image_utils.render_size(old_page)
+    tint_masks = []
+    regions = []
+    for top, old_strip, tinted_strip in self.image_utils.compare_page_strips(
+      old_page, new_page, self.tile_height, tint_color=(170, 51, 106)
+    ):
+      if tinted_strip is None:
+        continue
+      tint_mask = encode_tint_mask(old_strip, tinted_strip, top=top)
+      if tint_mask:
+        tint_masks.append(tint_mask)
+      if self.structured_results:
+        strip_regions = self.image_utils.changed_regions(old_strip, tinted_strip)
+        regions += [(x0, y0 + top, x1, y1 + top) for x0, y0, x1, y1 in strip_regions]
+
+    regions = self.image_utils.merge_regions(regions, size) if regions else None
+    return self.make_layers_result(page_unit, tint_masks, word_diffs, regions)
+
+  def write_report(self, old_file_path, page_results):
+    """Write the PDF report of a document pair from the layers of its changed pages."""
+    changed_pages = [page_result for page_result in page_results if page_result.get("layers")]
+    if not changed_pages:
+      return
+    from pdf_report import PDFReport
+    with self.metrics.timer("report"):
+      report = PDFReport(self.quality, self.config["font_size"])
+      with open_pdf(old_file_path) as old_doc:
+        for page_result in changed_pages:
+          layers = page_result["layers"]
+          report.add_page(
+            old_doc, layers["old_page"], page_result["page"], layers["tint_masks"], layers["word_diffs"]
+          )
+      report.save(self.get_output_path(old_file_path))
+
+  def compare_pdfs(self, old_file_path, new_file_path, journal=None):
     """
-    Compare two PDF files and return a document with differences highlighted
+    Compare two PDF files page by page in the calling thread
     :param old_file_path: Path to the old PDF file
     :param new_file_path: Path to the new PDF file
+    :param journal: Optional RunJournal the pages are recorded in and resumed from
+    :return: Summary of the document pair from report_document
     """
-    base_name = os.path.splitext(os.path.basename(old_file_path))[0]
-    output_dir = os.path.join(self.output_dir, f"diff_{base_name}")
+    output_dir = self.get_output_dir(old_file_path)
     start_time = time.time()
+    done_pages = {}
+    if journal:
+      finished, done_pages = self.start_journaled_pair(journal, old_file_path, new_file_path)
+      if finished:
+        return self.report_journaled(old_file_path, finished, done_pages)
+
+    with open_pdf(old_file_path, self.metrics) as old_doc, open_pdf(new_file_path, self.metrics) as new_doc:
+      plan = self.plan_document(old_doc, new_doc)
+      page_results = []
+      for page_unit in plan["pages"]:
+        if page_unit["page"] in done_pages:
+          page_results.append(done_pages[page_unit["page"]])
+          continue
+        self.memory_budget.acquire(page_unit["footprint"])
+        try:
+          page_result = self.compare_page(old_doc, new_doc, page_unit, output_dir)
+        finally:
+          self.memory_budget.release(page_unit["footprint"])
+        if journal:
+          journal.record_page(old_file_path, page_result)
+        page_results.append(page_result)
+
+    elapsed_time = time.time() - start_time
+    summary = self.report_document(old_file_path, plan, page_results, elapsed_time)
+    if journal:
+      journal.record_document(old_file_path, plan, elapsed_time)
+    return summary
+
+  def start_journaled_pair(self, journal, old_file_path, new_file_path):
+    """
+    Look a pair up in the journal, removing the outputs of an earlier attempt at it if its
+    files changed since
+    :return: (finished, pages) from RunJournal.start_pair
+    """
+    finished, pages, changed = journal.start_pair(old_file_path, new_file_path)
+    if changed:
+      self.prepare_pair(old_file_path, new_file_path, force=True)
+    return finished, pages
+
+  def report_journaled(self, old_file_path, finished, done_pages):
+    """Report a document the journal of an interrupted run holds as finished, without comparing it again."""
+    plan, elapsed_time = finished
+    print(f"Resuming {os.path.basename(old_file_path)} from the journal")
+    page_results = sorted(done_pages.values(), key=lambda page_result: page_result["page"])
+    return self.report_document(old_file_path, plan, page_results, elapsed_time)
 
-    with open_pdf(old_file_path) as old_doc, open_pdf(new_file_path) as new_doc:
-        differences_found = False
-
-        for page_num in range(min(len(old_doc), len(new_doc))):
-            old_page = old_doc.load_page(page_num)
-            new_page = new_doc.load_page(page_num)
-
-            # Render pages to images
-            old_image_pil, new_image_pil = self.image_utils.render_pages_to_images(old_page, new_page)
-
-            # Overlay differences (image-level differences)
-            overlay_image = self.image_utils.overlay_differences(
-                old_image_pil, new_image_pil, tint_color=(170, 51, 106)
-            )
-
-            # Extract and compare text (word-level differences)
-            word_diffs = self.text_comparer.extract_and_compare_text(old_page, new_page)
-
-            # Combined image: Overlay + Annotated text differences
-            combined_image = None
-            if overlay_image or word_diffs:
-                differences_found = True
-                if overlay_image:
-                    combined_image = overlay_image.convert("RGBA")
-
-                if word_diffs:
-                    if combined_image is None:
-                        combined_image = old_image_pil.convert("RGBA")
-                    self.image_utils.annotate_text_differences(
-                        combined_image, word_diffs, self.font_size
-                    )
-
-            # Save the outputs
-            if overlay_image:
-                overlay_output_dir = os.path.join(output_dir, "overlay_differences")
-                self.save_page_image(overlay_image, overlay_output_dir, page_num)
-            
-            if combined_image:
-                combined_output_dir = os.path.join(output_dir, "combined_differences")
-                self.save_page_image(combined_image, combined_output_dir, page_num)
-
-            if word_diffs:
-                word_diff_output_dir = os.path.join(output_dir, "word_differences")
-                word_diff_image = old_image_pil.convert("RGBA")
-                self.image_utils.annotate_text_differences(
-                    word_diff_image, word_diffs, self.font_size
-                )
-                self.save_page_image(word_diff_image, word_diff_output_dir, page_num)
-
-            # Cleanup to free memory
-            if overlay_image:
-                del overlay_image
-            if combined_image:
-                del combined_image
-            del old_image_pil, new_image_pil
-            gc.collect()
-
-    end_time = time.time()
-    elapsed_time = end_time - start_time
+  def report_document(self, old_file_path, plan, page_results, elapsed_time):
+    """
+    Print the outcome of a finished document pair and update progress
+    :param old_file_path: Path to the old PDF file of the document pair
+    :param plan: Plan the document pair was compared with
+    :param page_results: Page results in page order
+    :param elapsed_time: Seconds spent on the document pair
+    :return: Summary dictionary of the document pair, page numbers 1-based
+    """
+    page_results = plan["page_results"] + page_results
+    if self.output_format == "pdf" and not self.text_only:
+      self.write_report(old_file_path, page_results)
+
+    output_dir = self.get_output_path(old_file_path)
+    differences_found = any(page_result["differences"] for page_result in page_results)
+    differences_found = differences_found or bool(plan["inserted_pages"] or plan["deleted_pages"])
+
+    if self.exporter:
+      document_metrics = Metrics()
+      document_metrics.merge(plan.get("metrics"))
+      for page_result in page_results:
+        document_metrics.merge(page_result.get("metrics"))
+      if self.output_format == "pdf":
+        document_metrics.merge(self.metrics.drain())
+      document_metrics.count("documents")
+      self.exporter.write_record(
+        "document", document_metrics,
+        document=os.path.basename(old_file_path),
+        elapsed_seconds=round(elapsed_time, 6),
+        compared_pages=len(page_results),
+        differences=differences_found,
+      )
+      self.run_metrics.merge(document_metrics.drain())
 
     with self.lock:
-        if differences_found:
-            print(f"Differences found: {output_dir}")
-        else:
-            print(f"No differences found for {output_dir}")
+      if self.results:
+        self.results.write_document(os.path.basename(old_file_path), plan, page_results, differences_found)
 
-        print(f"Time taken for {output_dir}: {elapsed_time:.2f} seconds")
+      if differences_found:
+        print(f"Differences found: {output_dir}")
+      else:
+        print(f"No differences found for {output_dir}")
 
-        self.completed_comparisons += 1
-        print(f"Progress: {self.completed_comparisons}/{self.total_comparisons} comparisons completed\n")
-  
-  def run_comparison(self):
-    """Run the comparison for all PDFs in the specified directories"""
-    
-    print("Starting PDF Comparison tool now")
-    
+      if plan["inserted_pages"]:
+        print(f"Inserted pages in the new document: {self.format_pages(plan['inserted_pages'])}")
+      if plan["deleted_pages"]:
+        print(f"Deleted pages of the old document: {self.format_pages(plan['deleted_pages'])}")
+      if plan["skipped_pages"]:
+        print(f"Skipped {plan['skipped_pages']} identical pages for {output_dir}")
+      if plan["reflowed_pages"]:
+        print(f"Skipped {plan['reflowed_pages']} pages with only reflowed text for {output_dir}")
+      print(f"Time taken for {output_dir}: {elapsed_time:.2f} seconds")
+      self.skipped_pages += plan["skipped_pages"]
+      self.reflowed_pages += plan["reflowed_pages"]
+      self.cache_stats.update(plan.get("cache_stats", {}))
+      for page_result in page_results:
+        self.cache_stats.update(page_result.get("cache_stats", {}))
+
+      if self.manifest:
+        result = {
+          "differences": differences_found,
+          "compared_pages": len(page_results),
+          "skipped_pages": plan["skipped_pages"],
+          "inserted_pages": plan["inserted_pages"],
+          "deleted_pages": plan["deleted_pages"],
+        }
+        pair_key = os.path.basename(old_file_path)
+        self.manifest.record(pair_key, self.pair_states[old_file_path], output_dir, result)
+
+      self.completed_comparisons += 1
+      print(f"Progress: {self.completed_comparisons}/{self.total_comparisons} comparisons completed\n")
+
+    summary = {
+      "document": os.path.basename(old_file_path),
+      "differences": differences_found,
+      "output": output_dir,
+      "changed_pages": [page_result["new_page"] + 1 for page_result in page_results if page_result["differences"]],
+      "inserted_pages": [page_num + 1 for page_num in plan["inserted_pages"]],
+      "deleted_pages": [page_num + 1 for page_num in plan["deleted_pages"]],
+      "elapsed_seconds": round(elapsed_time, 3),
+    }
+    if self.structured_results:
+      summary["pages"] = page_records(summary["document"], plan, page_results)
+    return summary
+
+  def format_pages(self, page_nums):
+    """Format page numbers the way output images are named."""
+    return ", ".join(f"page_{page_num:02d}" for page_num in page_nums)
+
+  def report_cache(self):
+    """Print the cache hit rates of the run and trim the cache to its byte budget."""
+    for kind in ("render", "words"):
+      hits = self.cache_stats[f"{kind}_hits"]
+      misses = self.cache_stats[f"{kind}_misses"]
+      if hits + misses:
+        print(f"Cache {kind}: {hits} hits, {misses} misses ({100 * hits / (hits + misses):.1f}% hit rate)")
+    self.cache.evict()
+
+  def report_metrics(self, total_elapsed_time):
+    """Print where the time of the run went and export the run totals as JSON lines and a Prometheus textfile."""
+    # Encodes of the thread engine still queued when the last page result came back
+    self.run_metrics.merge(self.metrics.drain())
+    stages = self.run_metrics.to_dict()["stages"]
+    stage_seconds = sum(timer["seconds"] for timer in stages.values()) or 1
+    for stage, timer in sorted(stages.items(), key=lambda item: -item[1]["seconds"]):
+      print(f"Stage {stage}: {timer['seconds']:.2f}s over {timer['calls']} calls ({100 * timer['seconds'] / stage_seconds:.0f}%)")
+
+    self.exporter.write_record("run", self.run_metrics, elapsed_seconds=round(total_elapsed_time, 6))
+    gauges = {"run_seconds": round(total_elapsed_time, 6), "last_run_timestamp_seconds": round(time.time(), 3)}
+    peak_rss = peak_rss_bytes()
+    if peak_rss is not None:
+      gauges["peak_rss_bytes"] = peak_rss
+    self.exporter.write_prometheus(self.run_metrics, **gauges)
+
+  def report_memory(self):
+    """Print the peak resident memory of the run next to the peak estimate of the memory budget."""
+    peak_rss = peak_rss_bytes()
+    if peak_rss is None:
+      return
+    if self.engine == "process":
+      peak_worker_rss = peak_rss_bytes(children=True)
+      print(f"Peak memory: {peak_rss / 2**20:.0f} MB main process, {peak_worker_rss / 2**20:.0f} MB largest worker")
+    else:
+      print(f"Peak memory: {peak_rss / 2**20:.0f} MB")
+    print(
+      f"Peak estimated page work: {self.memory_budget.peak_in_use / 2**20:.0f} MB "
+      f"of a {self.memory_budget.max_bytes / 2**20:.0f} MB budget"
+    )
+
+  def compare_pair(self, old_file_path, new_file_path):
+    """
+    Compare a single document pair in the calling process, without starting a worker pool
+    or touching the outputs of other pairs
+    :return: Summary of the document pair from report_document
+    """
+    self.total_comparisons = 1
+    self.prepare_pair(old_file_path, new_file_path)
+    try:
+      return self.compare_pdfs(old_file_path, new_file_path)
+    finally:
+      self.close_output_writer()
+
+  def find_pairs(self):
+    """
+    Return the (old_file_path, new_file_path) pairs of the document directories. Files are
+    paired by name, and with "pairing" set to "content" the files left over are paired by
+    their content signatures. A pairing.json report in the output directory then lists every
+    pair with its confidence and the files left unpaired.
+    """
     old_files = self.get_pdf_files(self.old_documents_dir)
     new_files = self.get_pdf_files(self.new_documents_dir)
 
@@ -191,26 +936,213 @@ class PDFComparer:
     if not new_files:
       print(f"No PDF files found in the new documents directory: {self.new_documents_dir}")
 
-    total_start_time = time.time()
+    pairs = [
+      (os.path.join(self.old_documents_dir, file_name), os.path.join(self.new_documents_dir, file_name), 1.0, "name")
+      for file_name in sorted(set(old_files) & set(new_files))
+    ]
+    unpaired_old = {os.path.join(self.old_documents_dir, file_name) for file_name in set(old_files) - set(new_files)}
+    unpaired_new = {os.path.join(self.new_documents_dir, file_name) for file_name in set(new_files) - set(old_files)}
+    if not (unpaired_old or unpaired_new):
+      return [(old_path, new_path) for old_path, new_path, _, _ in pairs]
+
+    from document_pairing import DocumentIndex, match_documents, write_pairing_report
+    if self.config.get("pairing", "content") == "content" and unpaired_old and unpaired_new:
+      start_time = time.time()
+      index = DocumentIndex(self.config.get("pairing_index_file") or None, self.core_count)
+      matched = match_documents(
+        index.signatures(sorted(unpaired_old)), index.signatures(sorted(unpaired_new)),
+        self.config.get("pairing_threshold", 0.5),
+      )
+      index.save()
+      for old_path, new_path, confidence in matched:
+        pairs.append((old_path, new_path, confidence, "content"))
+        unpaired_old.discard(old_path)
+        unpaired_new.discard(new_path)
+      print(f"Paired {len(matched)} renamed documents by content in {time.time() - start_time:.2f} seconds")
+
+    for old_path in sorted(unpaired_old):
+      print(f"No new version found for {os.path.basename(old_path)}, skipping it")
+    write_pairing_report(os.path.join(self.output_dir, "pairing.json"), pairs, unpaired_old, unpaired_new)
+    return [(old_path, new_path) for old_path, new_path, _, _ in pairs]
+
+  def run_comparison(self):
+    """Run the comparison for all PDFs in the specified directories"""
     
-    self.total_comparisons = len(old_files)
+    print("Starting PDF Comparison tool now")
     
-    with ThreadPoolExecutor(max_workers=self.core_count) as executor:
-      futures = []
-      for old_file in old_files:
-        old_file_path = os.path.join(self.old_documents_dir, old_file)
-        new_file_path = os.path.join(self.new_documents_dir, old_file)
-        futures.append(executor.submit(self.compare_pdfs, old_file_path, new_file_path))
+    pairs = self.find_pairs()
+    total_start_time = time.time()
+    if self.manifest:
+      pairs = self.select_changed_pairs(pairs)
+    self.total_comparisons = len(pairs)
+
+    if self.engine == "process":
+      # Documents the journal holds as finished are reported straight away, and the pages it
+      # holds of the others are not compared again
+      jobs = []
+      done_pages = {}
+      for old_path, new_path in pairs:
+        if self.journal:
+          finished, done_pages[old_path] = self.start_journaled_pair(self.journal, old_path, new_path)
+          if finished:
+            self.report_journaled(old_path, finished, done_pages[old_path])
+            continue
+        jobs.append((old_path, new_path, self.get_output_dir(old_path)))
+
+      from process_engine import ProcessEngine
+      on_page = (lambda job, page_result: self.journal.record_page(job.old_file_path, page_result)) if self.journal else None
+      outputs = []
+      with ProcessEngine(type(self), self.config, self.core_count, self.memory_budget) as engine:
+        for job, page_results, elapsed_time in engine.compare_documents(jobs, done_pages=done_pages, on_page=on_page):
+          if job.error:
+            raise job.error
+          self.report_document(job.old_file_path, job.plan, page_results, elapsed_time)
+          if self.journal:
+            self.journal.record_document(job.old_file_path, job.plan, elapsed_time)
+          outputs += [file_path for page_result in page_results for file_path in page_result.get("outputs", ())]
+      # Images still being encoded when their page result came back are only counted by the worker
+      for snapshot in engine.worker_metrics:
+        self.run_metrics.merge(snapshot)
+
+      # The workers write their images in the background, so their failures only show once they are gone
+      missing = [file_path for file_path in outputs if not os.path.exists(file_path)]
+      if missing:
+        raise OSError(f"Failed to write {len(missing)} images, the first {missing[0]}")
+    else:
+      with ThreadPoolExecutor(max_workers=self.core_count) as executor:
+        futures = []
+        for old_file_path, new_file_path in pairs:
+          futures.append(executor.submit(self.compare_pdfs, old_file_path, new_file_path, self.journal))
+
+        for future in as_completed(futures):
+          future.result()
+      self.close_output_writer()
 
-      for future in as_completed(futures):
-        future.result()
+    if self.manifest:
+      self.manifest.save()
+    if self.journal:
+      self.journal.close()
 
     total_end_time = time.time()
     total_elapsed_time = total_end_time - total_start_time
 
+    print(f"Identical pages skipped: {self.skipped_pages}")
+    if self.reflowed_pages:
+      print(f"Reflowed pages skipped: {self.reflowed_pages}")
+    if self.cache:
+      self.report_cache()
+    self.report_memory()
+    if self.exporter:
+      self.report_metrics(total_elapsed_time)
     print(f"Total time taken for comparing all documents: {total_elapsed_time:.2f} seconds")
-    print(f"Average time taken per file: {total_elapsed_time/self.total_comparisons:.2f} seconds")
+    print(f"Average time taken per file: {total_elapsed_time/max(1, self.total_comparisons):.2f} seconds")
+
+def compare(old_file_path, new_file_path, config_path=None, **options):
+  """
+  Compare two PDF files in the calling process and return the result in memory. Images or a
+  report are still written to the output directory, unless comparison_mode is "text-only".
+  :param old_file_path: Path to the old PDF file
+  :param new_file_path: Path to the new PDF file
+  :param config_path: Optional JSON config file the options are applied over
+  :param options: Config settings, e.g. quality=2.0 or comparison_mode="text-only"
+  :return: Summary dictionary of the pair, with a "pages" list of page records as written to a results file
+  """
+  comparer = PDFComparer(load_config(config_path, options), clear_output=False, structured_results=True)
+  return comparer.compare_pair(old_file_path, new_file_path)
+
+def parse_value(text):
+  """Parse a --set value as JSON, falling back to the plain string."""
+  try:
+    return json.loads(text)
+  except ValueError:
+    return text
+
+def parse_args(argv=None):
+  """Parse the command line into (arguments, config overrides)."""
+  parser = argparse.ArgumentParser(
+    description="Compare the PDFs of the old and new documents directories, or a single pair, and save their differences."
+  )
+  parser.add_argument("old_file", nargs="?", help="Old PDF of a single pair to compare instead of the document directories")
+  parser.add_argument("new_file", nargs="?", help="New PDF of the single pair")
+  parser.add_argument("--config", default="config.json", help="JSON config file (default: config.json, optional for a single pair)")
+  parser.add_argument("--old-dir", dest="old_documents_dir", help="Directory of the old documents")
+  parser.add_argument("--new-dir", dest="new_documents_dir", help="Directory of the new documents")
+  parser.add_argument("--output-dir", dest="output_dir", help="Directory the differences are saved to")
+  parser.add_argument("--quality", type=float, help="Render zoom factor")
+  parser.add_argument("--engine", choices=["process", "thread"], help="How document pairs are spread over the cores")
+  parser.add_argument("--mode", dest="comparison_mode", choices=["full", "text-only", "vector"], help="Comparison mode")
+  parser.add_argument("--output-format", dest="output_format", choices=["images", "pdf"], help="Save page images or a PDF report")
+  parser.add_argument("--set", action="append", default=[], metavar="KEY=VALUE", help="Override any config key, VALUE is parsed as JSON where possible")
+  parser.add_argument("--json", action="store_true", help="Print the result of a single pair as JSON")
+  parser.add_argument("--resume", action="store_true", help="Continue an interrupted run from the journal in the output folder")
+  parser.add_argument("--watch", action="store_true", help="Keep running and compare pairs as they arrive, see watch_service.py")
+  parser.add_argument("--queue", metavar="PATH", help="SQLite work queue shared by workers on many hosts, used with one of:")
+  queue_roles = parser.add_mutually_exclusive_group()
+  queue_roles.add_argument("--enqueue", action="store_true", help="Queue the pairs of the document directories, clearing the output folder")
+  queue_roles.add_argument("--work", action="store_true", help="Compare queued jobs until the queue is drained")
+  queue_roles.add_argument("--merge", action="store_true", help="Write the reports, results and summary.json of a drained queue")
+  parser.add_argument("--workers", type=int, help="Worker processes started by --work (default: core_count)")
+  args = parser.parse_args(argv)
+  if bool(args.old_file) != bool(args.new_file):
+    parser.error("a single pair needs both old_file and new_file")
+  if bool(args.queue) != (args.enqueue or args.work or args.merge):
+    parser.error("--queue needs one of --enqueue, --work or --merge, and they need --queue")
+
+  overrides = {}
+  for key in ("old_documents_dir", "new_documents_dir", "output_dir", "quality", "engine", "comparison_mode", "output_format"):
+    if getattr(args, key) is not None:
+      overrides[key] = getattr(args, key)
+  if args.resume:
+    overrides["resume"] = True
+  for setting in args.set:
+    key, separator, value = setting.partition("=")
+    if not separator:
+      parser.error(f"--set expects KEY=VALUE, got {setting}")
+    overrides[key] = parse_value(value)
+  if args.old_file and args.config == "config.json" and not os.path.exists(args.config):
+    args.config = None # A single pair can be compared with the default settings alone
+  return args, overrides
+
+def main(argv=None):
+  """
+  Command line entry point
+  :return: Exit status: for a single pair 0 if identical and 1 if it differs, like diff, and
+    for --merge 1 if any job failed
+  """
+  args, overrides = parse_args(argv)
+  config = load_config(args.config, overrides)
+  if args.watch:
+    from watch_service import run_service
+    run_service(config)
+    return 0
+
+  if args.queue:
+    import work_queue
+    if args.enqueue:
+      # Only pairing is needed here, the workers and --merge open their own journal and results
+      comparer = PDFComparer(config, clear_output=False)
+      comparer.clear_output_folder()
+      work_queue.enqueue(comparer, args.queue, comparer.find_pairs())
+      return 0
+    if args.work:
+      work_queue.run_workers(config, args.queue, args.workers or config["core_count"])
+      return 0
+    comparer = PDFComparer(config, clear_output=False)
+    if config.get("results_file"):
+      comparer.results = ResultsWriter(config["results_file"])
+    return 0 if work_queue.merge(comparer, args.queue) else 1
+
+  if args.old_file:
+    comparer = PDFComparer(config, clear_output=False, structured_results=args.json)
+    # With --json the progress goes to stderr, so stdout only holds the result
+    with redirect_stdout(sys.stderr) if args.json else nullcontext():
+      summary = comparer.compare_pair(args.old_file, args.new_file)
+    if args.json:
+      print(json.dumps(summary))
+    return 1 if summary["differences"] else 0
+
+  PDFComparer(config).run_comparison()
+  return 0
 
 if __name__ == "__main__":
-  comparer = PDFComparer(config)
-  comparer.run_comparison()
+  sys.exit(main())
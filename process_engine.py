@@ -0,0 +1,227 @@
+# PDF Comparer
+# Copyright (C) 2024 Ryan Lacadin
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import time
+import queue
+import pickle
+import shutil
+import tempfile
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from multiprocessing.util import Finalize
+import pymupdf #PyMuPDF
+
+# Number of documents each worker process keeps open between work units
+MAX_OPEN_DOCUMENTS = 8
+
+# Seconds between checks for newly submitted pairs while documents are in flight
+INCOMING_POLL_SECONDS = 0.05
+
+# Per-process state, set up once by _init_worker
+_comparer = None
+_flush_pages = False
+_documents = OrderedDict()
+
+def _init_worker(comparer_class, config, metrics_dir, flush_pages):
+  """Create the comparer used by every work unit of this worker process."""
+  global _comparer, _flush_pages
+  _comparer = comparer_class(config, clear_output=False)
+  _flush_pages = flush_pages
+  # Write out queued images before the worker process exits
+  Finalize(None, _close_worker, args=(metrics_dir,), exitpriority=10)
+
+def _close_worker(metrics_dir):
+  """Flush the comparer at exit and leave the metrics no page result carried back in metrics_dir."""
+  snapshot = _comparer.close_worker()
+  if snapshot and (snapshot["timers"] or snapshot["counters"]):
+    with open(os.path.join(metrics_dir, f"{os.getpid()}.pickle"), "wb") as metrics_file:
+      pickle.dump(snapshot, metrics_file)
+
+def _open_document(file_path):
+  """
+  Return an open document for file_path, reusing documents this worker already opened as
+  long as the file was not replaced since
+  """
+  stat = os.stat(file_path)
+  key = (file_path, stat.st_size, stat.st_mtime_ns)
+  doc = _documents.pop(key, None)
+  if doc is None:
+    for stale_key in [cached for cached in _documents if cached[0] == file_path]:
+      _documents.pop(stale_key).close()
+    with _comparer.metrics.timer("open"):
+      doc = pymupdf.open(file_path)
+  _documents[key] = doc
+  while len(_documents) > MAX_OPEN_DOCUMENTS:
+    _, stale_doc = _documents.popitem(last=False)
+    stale_doc.close()
+  return doc
+
+def _plan_document(old_file_path, new_file_path):
+  """Work unit: plan the page comparisons for a document pair."""
+  return _comparer.plan_document(_open_document(old_file_path), _open_document(new_file_path))
+
+def _compare_page(old_file_path, new_file_path, page_unit, output_dir):
+  """Work unit: compare a single page pair of a document pair."""
+  old_doc = _open_document(old_file_path)
+  new_doc = _open_document(new_file_path)
+  page_result = _comparer.compare_page(old_doc, new_doc, page_unit, output_dir)
+  if _flush_pages:
+    # Failing the unit reports the images that could not be written with the document
+    _comparer.flush_page_images(output_dir)
+  return page_result
+
+class _DocumentJob:
+  """Book-keeping for one document pair while its pages are in flight."""
+
+  def __init__(self, old_file_path, new_file_path, output_dir):
+    self.old_file_path = old_file_path
+    self.new_file_path = new_file_path
+    self.output_dir = output_dir
+    self.start_time = time.time()
+    self.plan = None
+    self.page_results = []
+    self.remaining = 0
+    self.running = 0 # Work units submitted and not done yet
+    self.error = None
+
+class ProcessEngine:
+  """
+  Compare document pairs by scheduling (document, page) work units across a pool of processes.
+  Each worker keeps its own open pymupdf documents, so a large document is spread over
+  every core instead of occupying a single thread.
+  """
+
+  def __init__(self, comparer_class, config, core_count, memory_budget=None, flush_pages=False):
+    """
+    :param comparer_class: Class instantiated once in every worker to do the page work.
+    :param config: Configuration dictionary passed to comparer_class.
+    :param core_count: Number of worker processes.
+    :param memory_budget: Optional MemoryBudget page units are only started within,
+      using the "footprint" estimate of each unit.
+    :param flush_pages: Whether page units wait for their images to be written before
+      returning, so the images of a yielded document are all on disk.
+    """
+    self.memory_budget = memory_budget
+    self.metrics_dir = tempfile.mkdtemp(prefix="pdfcomparer-metrics-")
+    self.worker_metrics = [] # Metrics snapshots the workers left at exit, once closed
+    self.executor = ProcessPoolExecutor(
+      max_workers=core_count, initializer=_init_worker, initargs=(comparer_class, config, self.metrics_dir, flush_pages)
+    )
+
+  def close(self):
+    """Shut down the worker processes and collect the metrics they recorded after their last result."""
+    self.executor.shutdown(wait=True)
+    for file_name in os.listdir(self.metrics_dir):
+      with open(os.path.join(self.metrics_dir, file_name), "rb") as metrics_file:
+        self.worker_metrics.append(pickle.load(metrics_file))
+    shutil.rmtree(self.metrics_dir, ignore_errors=True)
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    self.close()
+
+  def compare_documents(self, pairs, incoming=None, done_pages=None, on_page=None):
+    """
+    Compare document pairs, yielding each document as soon as all of its pages are done.
+    A document whose work failed is yielded once with page_results None and job.error set,
+    after its work units already running are done, so none of them still writes its output.
+    :param pairs: Iterable of (old_file_path, new_file_path, output_dir) tuples.
+    :param incoming: Optional queue.Queue of further pairs, taken up while other documents
+      are in flight. The generator then only ends once None is put on the queue.
+    :param done_pages: Optional dictionary of old_file_path -> {page: page result} of pages
+      compared before, which are not compared again.
+    :param on_page: Optional callback(job, page_result) called as every page result arrives.
+    :return: Generator of (job, page_results, elapsed_time), page_results in page order.
+    """
+    done_pages = done_pages or {}
+    pending = {}
+    ready = deque() # Page units waiting for room in the memory budget
+    for pair in pairs:
+      self.start_document(pair, pending)
+
+    accepting = incoming is not None
+    while pending or accepting:
+      # Wait for new pairs only while there is nothing else to wait for
+      while accepting:
+        try:
+          pair = incoming.get(block=not pending)
+        except queue.Empty:
+          break
+        if pair is None:
+          accepting = False
+        else:
+          self.start_document(pair, pending)
+      if not pending:
+        continue
+
+      done, _ = wait(pending, timeout=INCOMING_POLL_SECONDS if accepting else None, return_when=FIRST_COMPLETED)
+      for future in done:
+        job, page_unit = pending.pop(future)
+        job.running -= 1
+        if page_unit is not None and self.memory_budget:
+          self.memory_budget.release(page_unit["footprint"])
+        if not job.error:
+          try:
+            result = future.result()
+          except Exception as e:
+            job.error = e
+        if job.error:
+          # The units not started yet are dropped
+          if not job.running:
+            yield job, None, time.time() - job.start_time
+          continue
+
+        if page_unit is None:
+          job.plan = result
+          pages_done = done_pages.get(job.old_file_path, {})
+          units = [unit for unit in result["pages"] if unit["page"] not in pages_done]
+          job.page_results = [pages_done[unit["page"]] for unit in result["pages"] if unit["page"] in pages_done]
+          job.remaining = len(units)
+          ready.extend((job, unit) for unit in units)
+        else:
+          if on_page:
+            on_page(job, result)
+          job.page_results.append(result)
+          job.remaining -= 1
+
+        if job.remaining == 0:
+          job.page_results.sort(key=lambda page_result: page_result["page"])
+          yield job, job.page_results, time.time() - job.start_time
+
+      # Start the waiting page units, in plan order, that fit in the memory budget
+      while ready:
+        job, unit = ready[0]
+        if job.error:
+          ready.popleft()
+          continue
+        if self.memory_budget and not self.memory_budget.try_acquire(unit["footprint"]):
+          break
+        ready.popleft()
+        page_future = self.executor.submit(
+          _compare_page, job.old_file_path, job.new_file_path, unit, job.output_dir
+        )
+        pending[page_future] = (job, unit)
+        job.running += 1
+
+  def start_document(self, pair, pending):
+    """Submit the planning of an (old_file_path, new_file_path, output_dir) pair."""
+    old_file_path, new_file_path, output_dir = pair
+    job = _DocumentJob(old_file_path, new_file_path, output_dir)
+    pending[self.executor.submit(_plan_document, old_file_path, new_file_path)] = (job, None)
+    job.running += 1
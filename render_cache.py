@@ -0,0 +1,158 @@
+# PDF Comparer
+# Copyright (C) 2024 Ryan Lacadin
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import zlib
+import struct
+import hashlib
+import threading
+from collections import Counter
+import numpy as np
+import pymupdf #PyMuPDF
+from page_fingerprint import hash_file
+
+# Header of a cached raster: height, width and channel count
+ARRAY_HEADER = struct.Struct("<III")
+
+# Fraction of the byte budget a cache may write before it checks the budget again
+EVICTION_CHECK_FRACTION = 8
+
+# Fraction of the byte budget eviction trims the cache down to
+EVICTION_TARGET = 0.9
+
+class RenderCache:
+  """
+  On-disk cache of page renders and extracted words shared by every worker of a run and
+  by later runs. Entries are keyed by the content hash of the document, the page number,
+  the zoom and the pymupdf version, and are evicted least recently used first once the
+  cache grows past its byte budget. Entries are written to a temporary file and renamed
+  into place, so concurrent workers never see a partial entry.
+  """
+
+  def __init__(self, cache_dir, max_bytes):
+    """
+    :param cache_dir: Directory holding the cache entries.
+    :param max_bytes: Byte budget of the cache directory.
+    """
+    self.cache_dir = cache_dir
+    self.max_bytes = max_bytes
+    self.written_bytes = 0
+    self.file_digests = {}
+    self.stats = Counter()
+    self.lock = threading.Lock()
+    os.makedirs(cache_dir, exist_ok=True)
+
+  def file_digest(self, file_path):
+    """Return the SHA-256 of a file, hashing it again only when its size or mtime changed."""
+    stat = os.stat(file_path)
+    memo_key = (os.path.abspath(file_path), stat.st_size, stat.st_mtime_ns)
+    if memo_key not in self.file_digests:
+      self.file_digests[memo_key] = hash_file(file_path)
+    return self.file_digests[memo_key]
+
+  def make_key(self, kind, page, *params):
+    """Return the cache key of an entry of the given kind for a page."""
+    parts = [kind, self.file_digest(page.parent.name), page.number, pymupdf.VersionBind, *params]
+    return hashlib.sha256("|".join(map(str, parts)).encode()).hexdigest()
+
+  def entry_path(self, key):
+    """Return the path of a cache entry, fanned out over subdirectories."""
+    return os.path.join(self.cache_dir, key[:2], key)
+
+  def count(self, kind, hit):
+    """Record a hit or miss for an entry kind."""
+    with self.lock:
+      self.stats[f"{kind}_{'hits' if hit else 'misses'}"] += 1
+
+  def get(self, kind, key):
+    """Return the decompressed bytes of an entry, or None if it is not cached."""
+    path = self.entry_path(key)
+    try:
+      with open(path, "rb") as file:
+        data = zlib.decompress(file.read())
+      os.utime(path) # Mark as recently used
+    except (OSError, zlib.error):
+      self.count(kind, False)
+      return None
+    self.count(kind, True)
+    return data
+
+  def put(self, key, data):
+    """Compress and store an entry, evicting old entries when the budget is exceeded."""
+    path = self.entry_path(key)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    compressed = zlib.compress(data, 1)
+    try:
+      with open(temp_path, "wb") as file:
+        file.write(compressed)
+      os.replace(temp_path, path)
+    except OSError as e:
+      print(f"Failed to write cache entry {path}. Reason: {e}")
+      return
+
+    with self.lock:
+      self.written_bytes += len(compressed)
+      check_budget = self.written_bytes > self.max_bytes // EVICTION_CHECK_FRACTION
+      if check_budget:
+        self.written_bytes = 0
+    if check_budget:
+      self.evict()
+
+  def get_array(self, key):
+    """Return a cached raster as an RGB array, or None if it is not cached."""
+    data = self.get("render", key)
+    if data is None:
+      return None
+    height, width, channels = ARRAY_HEADER.unpack_from(data)
+    return np.frombuffer(data, dtype=np.uint8, offset=ARRAY_HEADER.size).reshape(height, width, channels)
+
+  def put_array(self, key, array):
+    """Store a raster."""
+    self.put(key, ARRAY_HEADER.pack(*array.shape) + array.tobytes())
+
+  def evict(self):
+    """Delete least recently used entries until the cache fits its byte budget."""
+    entries = []
+    total_bytes = 0
+    for directory in os.scandir(self.cache_dir):
+      if not directory.is_dir():
+        continue
+      for entry in os.scandir(directory.path):
+        try:
+          stat = entry.stat()
+        except OSError:
+          continue # Removed by another worker
+        entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total_bytes += stat.st_size
+
+    if total_bytes <= self.max_bytes:
+      return
+    target_bytes = self.max_bytes * EVICTION_TARGET
+    for _, size, path in sorted(entries):
+      try:
+        os.unlink(path)
+      except OSError:
+        pass
+      total_bytes -= size
+      if total_bytes <= target_bytes:
+        break
+
+  def drain_stats(self):
+    """Return the hit and miss counts since the last call and reset them."""
+    with self.lock:
+      stats, self.stats = self.stats, Counter()
+    return dict(stats)
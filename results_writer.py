@@ -0,0 +1,105 @@
+# PDF Comparer
+# Copyright (C) 2024 Ryan Lacadin
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import json
+
+def page_records(document, plan, page_results):
+  """Return the page records of a document pair in new document order, deleted pages last."""
+  records = []
+  for page_result in page_results:
+    record = {
+      "type": "page",
+      "document": document,
+      "old_page": page_result["old_page"] + 1,
+      "new_page": page_result["new_page"] + 1,
+      "status": "changed" if page_result["differences"] else "unchanged",
+      "words": page_result.get("words", []),
+      "regions": page_result.get("regions", []),
+    }
+    if "objects" in page_result:
+      record["objects"] = page_result["objects"]
+    records.append(record)
+  for old_page_num, new_page_num, status in plan["unchanged_pairs"]:
+    records.append({
+      "type": "page", "document": document,
+      "old_page": old_page_num + 1, "new_page": new_page_num + 1, "status": status,
+    })
+  for new_page_num in plan["inserted_pages"]:
+    records.append({"type": "page", "document": document, "old_page": None, "new_page": new_page_num + 1, "status": "inserted"})
+  records.sort(key=lambda record: record["new_page"])
+  for old_page_num in plan["deleted_pages"]:
+    records.append({"type": "page", "document": document, "old_page": old_page_num + 1, "new_page": None, "status": "deleted"})
+  return records
+
+class ResultsWriter:
+  """
+  Write the comparison results as NDJSON: one "page" record for every page of a document
+  pair, with its status, changed words, changed raster regions and, in the vector mode,
+  changed objects, followed by one "document" record summing the pair up. Page numbers are
+  1-based, like a PDF viewer shows them.
+  """
+
+  def __init__(self, file_path, keep_previous=False):
+    """
+    :param file_path: NDJSON file the records are written to, replaced at the start of the run
+    :param keep_previous: Read the records of the last run first, so keep_document can carry
+      those of the pairs an incremental run skips over to the new file.
+    """
+    self.file_path = file_path
+    self.previous = {} # Document -> NDJSON lines of the last run
+    os.makedirs(os.path.dirname(os.path.abspath(file_path)), exist_ok=True)
+    if keep_previous and os.path.exists(file_path):
+      with open(file_path) as results_file:
+        for line in results_file:
+          try:
+            document = json.loads(line)["document"]
+          except (ValueError, KeyError):
+            continue # A line torn by an interrupted run
+          self.previous.setdefault(document, []).append(line)
+    open(file_path, "w").close()
+
+  def keep_document(self, document):
+    """
+    Write the records the last run wrote for a document pair that is not compared again
+    :return: False if the last run wrote no complete records of it
+    """
+    lines = self.previous.get(document, [])
+    if not lines or json.loads(lines[-1])["type"] != "document":
+      return False
+    with open(self.file_path, "a") as results_file:
+      results_file.write("".join(lines))
+    return True
+
+  def write_document(self, document, plan, page_results, differences_found):
+    """
+    Append the records of a finished document pair. Callers serialise calls, e.g. under a lock.
+    :param document: File name of the document pair
+    :param plan: Plan the document pair was compared with
+    :param page_results: Page results in page order
+    :param differences_found: Whether the document pair differs
+    """
+    records = page_records(document, plan, page_results)
+    records.append({
+      "type": "document",
+      "document": document,
+      "differences": differences_found,
+      "changed_pages": sum(record["status"] == "changed" for record in records),
+      "inserted_pages": len(plan["inserted_pages"]),
+      "deleted_pages": len(plan["deleted_pages"]),
+    })
+    with open(self.file_path, "a") as results_file:
+      results_file.write("".join(json.dumps(record) + "\n" for record in records))
@@ -0,0 +1,161 @@
+# PDF Comparer
+# Copyright (C) 2024 Ryan Lacadin
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import zlib
+import pickle
+import struct
+import threading
+from run_manifest import config_digest
+
+JOURNAL_NAME = "journal.bin"
+
+# Header of a journal record: payload length and CRC32
+RECORD_HEADER = struct.Struct("<II")
+
+# Page result entries that only describe the run that computed them
+RUN_ONLY_KEYS = ("metrics", "cache_stats")
+
+class RunJournal:
+  """
+  Append-only journal of the finished work of a run, kept in the output directory, from which
+  an interrupted run is resumed. Every compared page is recorded with its result and the
+  files it wrote, and every finished document with its plan. Records are framed by their
+  length and CRC32 and synced to disk one by one, so a crash can at worst tear the last
+  record, which is dropped on resume. Image files are written under a temporary name and
+  renamed into place, so a page whose recorded files all exist is complete.
+  """
+
+  def __init__(self, output_dir, config, resume=False):
+    """
+    :param output_dir: Output directory the journal is kept in
+    :param config: Configuration dictionary of the run. A journal of other settings is not resumed.
+    :param resume: Continue the journal of the last run instead of starting a new one once
+      open is called. resumed tells whether there was one to continue.
+    """
+    self.path = os.path.join(output_dir, JOURNAL_NAME)
+    self.config_digest = config_digest(config)
+    self.lock = threading.Lock()
+    self.documents = {} # Document -> {"state", "pages": {page: result}, "finished": (plan, elapsed) or None}
+    self.resumed = resume and self.load()
+    self.file = None
+
+  def open(self):
+    """Open the journal for writing, after the output directory was cleared for a new run."""
+    if self.resumed:
+      self.file = open(self.path, "ab")
+    else:
+      self.file = open(self.path, "wb")
+      self.append(("run", self.config_digest))
+
+  def load(self):
+    """
+    Read the journal of the last run, cutting off a torn last record
+    :return: False if there is no journal to resume
+    """
+    try:
+      with open(self.path, "rb") as journal_file:
+        data = journal_file.read()
+    except OSError:
+      print(f"No journal to resume in {os.path.dirname(self.path)}, starting a new run")
+      return False
+
+    offset = 0
+    records = []
+    while offset + RECORD_HEADER.size <= len(data):
+      length, crc = RECORD_HEADER.unpack_from(data, offset)
+      payload = data[offset + RECORD_HEADER.size:offset + RECORD_HEADER.size + length]
+      if len(payload) < length or zlib.crc32(payload) != crc:
+        break
+      try:
+        records.append(pickle.loads(payload))
+      except Exception:
+        break
+      offset += RECORD_HEADER.size + length
+    if offset < len(data):
+      print(f"Dropping {len(data) - offset} bytes of an unfinished journal record")
+      with open(self.path, "r+b") as journal_file:
+        journal_file.truncate(offset)
+
+    if not records or records[0] != ("run", self.config_digest):
+      print("The journal was written with other settings, starting a new run")
+      return False
+    for record in records[1:]:
+      kind, document = record[:2]
+      if kind == "pair":
+        self.documents[document] = {"state": record[2], "pages": {}, "finished": None}
+      elif kind == "page":
+        self.documents[document]["pages"][record[2]["page"]] = record[2]
+      elif kind == "document":
+        self.documents[document]["finished"] = record[2:]
+    return True
+
+  def append(self, record):
+    """Write a record and sync it to disk."""
+    payload = pickle.dumps(record, protocol=pickle.HIGHEST_PROTOCOL)
+    with self.lock:
+      self.file.write(RECORD_HEADER.pack(len(payload), zlib.crc32(payload)) + payload)
+      self.file.flush()
+      os.fsync(self.file.fileno())
+
+  def pair_state(self, old_file_path, new_file_path):
+    """Return the size and mtime of both files of a pair, to tell whether they changed since the journal."""
+    states = []
+    for file_path in (old_file_path, new_file_path):
+      stat = os.stat(file_path)
+      states.append((stat.st_size, stat.st_mtime_ns))
+    return tuple(states)
+
+  def outputs_exist(self, page_result):
+    """Return True if every file a page result wrote exists."""
+    return all(os.path.exists(file_path) for file_path in page_result.get("outputs", ()))
+
+  def start_pair(self, old_file_path, new_file_path):
+    """
+    Look up what the journal holds of a pair about to be compared, starting its record over
+    if its files changed
+    :return: (finished, pages, changed): the (plan, elapsed_time) of a document finished with
+      all of its outputs in place or None, the page results whose outputs are in place, by
+      page, and whether the journal holds an earlier attempt at the pair whose files changed since
+    """
+    document = os.path.basename(old_file_path)
+    state = self.pair_state(old_file_path, new_file_path)
+    entry = self.documents.get(document)
+    if entry is None or entry["state"] != state:
+      self.documents[document] = {"state": state, "pages": {}, "finished": None}
+      self.append(("pair", document, state))
+      return None, {}, entry is not None
+
+    pages = {page: result for page, result in entry["pages"].items() if self.outputs_exist(result)}
+    if len(pages) < len(entry["pages"]):
+      print(f"Comparing {len(entry['pages']) - len(pages)} pages of {document} again whose images are missing")
+      return None, pages, False
+    return entry["finished"], pages, False
+
+  def record_page(self, old_file_path, page_result):
+    """Record a compared page."""
+    result = {key: value for key, value in page_result.items() if key not in RUN_ONLY_KEYS}
+    self.append(("page", os.path.basename(old_file_path), result))
+
+  def record_document(self, old_file_path, plan, elapsed_time):
+    """Record a finished document with the plan it was reported with."""
+    stored_plan = {key: value for key, value in plan.items() if key not in RUN_ONLY_KEYS}
+    stored_plan["pages"] = [] # The page units are not needed to report the document again
+    self.append(("document", os.path.basename(old_file_path), stored_plan, elapsed_time))
+
+  def close(self):
+    if self.file:
+      self.file.close()
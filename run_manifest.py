@@ -0,0 +1,108 @@
+# PDF Comparer
+# Copyright (C) 2024 Ryan Lacadin
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import json
+import hashlib
+from page_fingerprint import hash_file
+
+MANIFEST_NAME = "manifest.json"
+
+# Config keys that change how a run is executed but not what it writes
+RUNTIME_CONFIG_KEYS = {
+  "old_documents_dir", "new_documents_dir", "output_dir", "core_count", "engine",
+  "cache_dir", "cache_max_mb", "incremental", "writer_threads", "writer_queue_mb",
+  "memory_budget_mb", "metrics_dir", "profile_documents", "results_file",
+  "service_address", "watch_settle_seconds", "watch_poll_seconds", "queue_lease_seconds",
+  "queue_pages_per_job", "journal", "resume", "pairing", "pairing_threshold",
+  "pairing_index_file",
+}
+
+def config_digest(config):
+  """Return a digest of the settings that affect the output."""
+  output_config = {key: value for key, value in config.items() if key not in RUNTIME_CONFIG_KEYS}
+  return hashlib.sha256(json.dumps(output_config, sort_keys=True).encode()).hexdigest()
+
+class RunManifest:
+  """
+  Record of the last run kept in the output directory. For every document pair it stores
+  the state of both input files, a digest of the settings that affect the output and the
+  result, so the next run only has to compare pairs whose inputs or settings changed.
+  """
+
+  def __init__(self, output_dir, config):
+    """
+    :param output_dir: Output directory the manifest is stored in.
+    :param config: Configuration dictionary of the current run.
+    """
+    self.path = os.path.join(output_dir, MANIFEST_NAME)
+    self.config_digest = config_digest(config)
+    self.entries = {}
+    self.exists = os.path.exists(self.path)
+    if self.exists:
+      try:
+        with open(self.path, "r") as manifest_file:
+          self.entries = json.load(manifest_file)["pairs"]
+      except (OSError, ValueError, KeyError) as e:
+        print(f"Ignoring unreadable manifest {self.path}. Reason: {e}")
+        self.exists = False
+
+  def file_state(self, file_path, previous_state=None):
+    """
+    Return the size, mtime and content hash of a file
+    :param previous_state: State recorded by the last run, whose hash is reused if size and mtime match
+    """
+    stat = os.stat(file_path)
+    state = {"name": os.path.basename(file_path), "size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+    if previous_state and all(previous_state.get(key) == state[key] for key in state):
+      state["sha256"] = previous_state["sha256"]
+    else:
+      state["sha256"] = hash_file(file_path)
+    return state
+
+  def pair_state(self, pair_key, old_file_path, new_file_path):
+    """Return the current state of a document pair, to compare with and later record."""
+    previous = self.entries.get(pair_key, {})
+    return {
+      "old": self.file_state(old_file_path, previous.get("old")),
+      "new": self.file_state(new_file_path, previous.get("new")),
+      "config": self.config_digest,
+    }
+
+  def is_current(self, pair_key, state):
+    """Return True if the last run compared the pair with the same inputs and settings."""
+    previous = self.entries.get(pair_key)
+    if not previous or "result" not in previous:
+      return False
+    return all(
+      previous[side]["sha256"] == state[side]["sha256"] and previous[side]["name"] == state[side]["name"]
+      for side in ("old", "new")
+    ) and previous["config"] == state["config"]
+
+  def record(self, pair_key, state, output_dir, result):
+    """Record the outcome of a compared pair."""
+    self.entries[pair_key] = dict(state, output_dir=output_dir, result=result)
+
+  def remove(self, pair_key):
+    """Forget a pair, returning its entry if there was one."""
+    return self.entries.pop(pair_key, None)
+
+  def save(self):
+    """Write the manifest atomically."""
+    temp_path = f"{self.path}.tmp"
+    with open(temp_path, "w") as manifest_file:
+      json.dump({"pairs": self.entries}, manifest_file, indent=2, sort_keys=True)
+    os.replace(temp_path, self.path)
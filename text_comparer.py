@@ -14,50 +14,137 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-import difflib
-from text_extractor import TextExtractor
+import numpy as np
+from text_extractor import TextExtractor, WordVocabulary
+from token_diff import diff_opcodes
+
+# Signs marking added and removed words in WordDiffs
+ADDED = 1
+REMOVED = -1
+# Sign of the " >" markers placed between overlapping annotations
+MARKER = 0
+
+class WordDiffs:
+  """
+  Struct-of-arrays list of added and removed words in the order they are annotated.
+  signs holds ADDED or REMOVED, bboxes the float32 (n, 4) word boxes and ids the word ids
+  in vocabulary.
+  """
+
+  __slots__ = ("signs", "bboxes", "ids", "vocabulary")
+
+  def __init__(self, signs, bboxes, ids, vocabulary):
+    self.signs = signs
+    self.bboxes = bboxes
+    self.ids = ids
+    self.vocabulary = vocabulary
+
+  def __len__(self):
+    return len(self.signs)
+
+  def texts(self):
+    """Return the word strings."""
+    words = self.vocabulary.words
+    return [words[word_id] for word_id in self.ids.tolist()]
+
+  def to_records(self):
+    """Return the words as JSON-ready dictionaries with their change and bbox in PDF points."""
+    return [
+      {"change": "added" if sign > 0 else "removed", "text": text, "bbox": [round(value, 2) for value in bbox]}
+      for sign, bbox, text in zip(self.signs.tolist(), self.bboxes.tolist(), self.texts())
+    ]
+
+  def layout(self, text_width, scale=1.0):
+    """
+    Lay out the words for annotation, line by line. Every word is placed at its own position
+    unless it would run into the word before it on the same line, in which case it follows
+    that word after a " >" marker.
+    :param text_width: Function returning the width of a string in the annotation font
+    :param scale: Factor from PDF points to annotation coordinates
+    :return: List of (x, y, text, sign) in drawing order, sign MARKER for the markers
+    """
+    positions = self.bboxes[:, :2].astype(np.float64) * scale
+    order = np.argsort(positions[:, 1], kind="stable") # Group by line, keeping the order within a line
+    xs, ys = positions[order].T.tolist()
+    signs = self.signs[order].tolist()
+    words = self.vocabulary.words
+    texts = [words[word_id] for word_id in self.ids[order].tolist()]
+    space_width = text_width(" ")
+    marker_width = text_width(" >")
+
+    items = []
+    line_y = line_end = None
+    for x, y, text, sign in zip(xs, ys, texts, signs):
+      if y == line_y and line_end + space_width > x:
+        items.append((line_end, y, " >", MARKER))
+        x = line_end + marker_width + space_width
+      items.append((x, y, text, sign))
+      line_y, line_end = y, x + text_width(text)
+    return items
+
+  def __getstate__(self):
+    # Pickle the words themselves rather than the whole vocabulary
+    return self.signs, self.bboxes, self.texts()
+
+  def __setstate__(self, state):
+    self.signs, self.bboxes, texts = state
+    self.vocabulary = WordVocabulary()
+    self.ids = self.vocabulary.intern(texts)
+
+  @classmethod
+  def from_segments(cls, segments, vocabulary):
+    """Build from (sign, page_words, indices) segments, concatenated in order."""
+    signs = [np.zeros(0, dtype=np.int8)]
+    bboxes = [np.zeros((0, 4), dtype=np.float32)]
+    ids = [np.zeros(0, dtype=np.int32)]
+    for sign, page_words, indices in segments:
+      ids.append(page_words.ids[indices])
+      bboxes.append(page_words.bboxes[indices])
+      signs.append(np.full(len(ids[-1]), sign, dtype=np.int8))
+    return cls(np.concatenate(signs), np.concatenate(bboxes), np.concatenate(ids), vocabulary)
 
 class TextComparer:
 
-  def __init__(self):
-    self.text_extractor = TextExtractor()
+  def __init__(self, cache=None, metrics=None):
+    self.text_extractor = TextExtractor(cache, metrics)
+    self.metrics = self.text_extractor.metrics
   
-  def compare_text(self, old_text_with_positions, new_text_with_positions):
-    """Compare text from two PDF pages and return only added or removed words with positions."""
-    old_text = self.collect_text_with_positions(old_text_with_positions)
-    new_text = self.collect_text_with_positions(new_text_with_positions)
-
-    old_words = [word["text"] for word in old_text]
-    new_words = [word["text"] for word in new_text]
-
-    diff = list(difflib.ndiff(old_words, new_words))
-    word_diffs = []
-
-    old_index = 0
-    new_index = 0
-    for word in diff:
-      if word.startswith("+ "):
-        if new_index < len(new_words):
-          word_diffs.append((word, new_text[new_index]["bbox"]))
-        new_index += 1
-      elif word.startswith("- "):
-        if old_index < len(old_words):
-          word_diffs.append((word, old_text[old_index]["bbox"]))
-        old_index += 1
-      else:
-        old_index += 1
-        new_index += 1
+  def compare_text(self, old_words, new_words):
+    """
+    Compare the words of two PDF pages and return only added or removed words with positions
+    :param old_words: PageWords of the old page
+    :param new_words: PageWords of the new page
+    :return: WordDiffs
+    """
+    with self.metrics.timer("text_diff"):
+      # Pages extracted with different vocabularies are compared in the old one
+      new_words = new_words.with_vocabulary(old_words.vocabulary)
 
-    return word_diffs
+      # Opcodes index straight into the word arrays, so bboxes need no separate walk
+      segments = []
+      for tag, i1, i2, j1, j2 in diff_opcodes(old_words.ids.tolist(), new_words.ids.tolist()):
+        if tag in ("delete", "replace"):
+          segments.append((REMOVED, old_words, slice(i1, i2)))
+        if tag in ("insert", "replace"):
+          segments.append((ADDED, new_words, slice(j1, j2)))
+
+      return WordDiffs.from_segments(segments, old_words.vocabulary)
 
-  def collect_text_with_positions(self, text_with_positions):
-    """Collect all words with positions from the given text with positions"""
-    text_list = [word for line in text_with_positions.values() for word in line]
-    return text_list
+  def extract_document(self, doc):
+    """Extract the words of every page of a document with one vocabulary."""
+    pages = [self.text_extractor.extract_text(page) for page in doc]
+    vocabulary = pages[-1].vocabulary if pages else None
+    return [page_words.with_vocabulary(vocabulary) for page_words in pages]
   
+  def extract_pages(self, doc, page_nums):
+    """Extract the words of some pages of a document with one vocabulary, by page number."""
+    pages = {page_num: self.text_extractor.extract_text(doc[page_num]) for page_num in page_nums}
+    vocabulary = pages[page_nums[-1]].vocabulary if pages else None
+    return {page_num: page_words.with_vocabulary(vocabulary) for page_num, page_words in pages.items()}
+
   def extract_and_compare_text(self, old_page, new_page):
     """Extract and compare text from PDF pages."""
-    old_text_with_positions = self.text_extractor.extract_text(old_page)
-    new_text_with_positions = self.text_extractor.extract_text(new_page)
-    word_diffs = self.compare_text(old_text_with_positions, new_text_with_positions)
+    old_words = self.text_extractor.extract_text(old_page)
+    new_words = self.text_extractor.extract_text(new_page)
+    word_diffs = self.compare_text(old_words, new_words)
     return word_diffs
@@ -14,21 +14,136 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-class TextExtractor:
+import struct
+import numpy as np
+from instrumentation import Metrics
+
+# Vocabulary size after which a fresh vocabulary is started, so long runs stay bounded
+MAX_VOCABULARY_SIZE = 1000000
+
+# Header of serialised page words: the word count
+WORD_COUNT_HEADER = struct.Struct("<I")
+
+class WordVocabulary:
+  """Interns word strings to integer ids shared by every page extracted with it."""
 
   def __init__(self):
-    pass
-  
-  def extract_text(self, page):
-    """Extract text from a PDF page with their positions, line by line."""
-    words = page.get_text("words") # Extract words with positions
-    lines = {}
+    self.ids = {}
+    self.words = []
+
+  def __len__(self):
+    return len(self.words)
+
+  def intern(self, words):
+    """Return the ids of the given words as an int32 array, adding unseen words."""
+    ids = self.ids
     for word in words:
-      line_key = word[1] # Use bottom y-coordinate as a unique key for the line
-      if line_key not in lines:
-        lines[line_key] = []
-      lines[line_key].append({
-        "text": word[4],
-        "bbox": word[:4] # Bounding box of the word
-      })
-    return lines
+      if word not in ids:
+        ids[word] = len(self.words)
+        self.words.append(word)
+    return np.fromiter((ids[word] for word in words), dtype=np.int32, count=len(words))
+
+class PageWords:
+  """
+  Struct-of-arrays store of the words on a page, in reading order.
+  bboxes is a float32 (n, 4) array, blocks/lines/word_numbers hold the pymupdf block, line
+  and word indices, and ids index into the vocabulary the words were interned with.
+  """
+
+  __slots__ = ("bboxes", "blocks", "lines", "word_numbers", "ids", "vocabulary")
+
+  def __init__(self, bboxes, blocks, lines, word_numbers, ids, vocabulary):
+    self.bboxes = bboxes
+    self.blocks = blocks
+    self.lines = lines
+    self.word_numbers = word_numbers
+    self.ids = ids
+    self.vocabulary = vocabulary
+
+  def __len__(self):
+    return len(self.ids)
+
+  @classmethod
+  def from_words(cls, words, vocabulary):
+    """Build from the tuples returned by page.get_text("words")."""
+    if not words:
+      empty = np.zeros(0, dtype=np.int32)
+      return cls(np.zeros((0, 4), dtype=np.float32), empty, empty, empty, empty, vocabulary)
+    x0, y0, x1, y1, texts, blocks, lines, word_numbers = zip(*words)
+    return cls(
+      np.array((x0, y0, x1, y1), dtype=np.float32).T.copy(),
+      np.array(blocks, dtype=np.int32),
+      np.array(lines, dtype=np.int32),
+      np.array(word_numbers, dtype=np.int32),
+      vocabulary.intern(texts),
+      vocabulary,
+    )
+
+  def with_vocabulary(self, vocabulary):
+    """Return these words with ids in vocabulary, re-interning them if they use another one."""
+    if vocabulary is self.vocabulary:
+      return self
+    return PageWords(
+      self.bboxes, self.blocks, self.lines, self.word_numbers, vocabulary.intern(self.texts()), vocabulary
+    )
+
+  def texts(self, indices=None):
+    """Return the word strings, optionally only those at the given indices."""
+    words = self.vocabulary.words
+    ids = self.ids if indices is None else self.ids[indices]
+    return [words[word_id] for word_id in ids.tolist()]
+
+  def to_bytes(self):
+    """Serialise independently of the vocabulary, for the render cache."""
+    texts = "\0".join(self.texts()).encode("utf-8")
+    return b"".join((
+      WORD_COUNT_HEADER.pack(len(self)),
+      self.bboxes.tobytes(),
+      self.blocks.tobytes(),
+      self.lines.tobytes(),
+      self.word_numbers.tobytes(),
+      texts,
+    ))
+
+  @classmethod
+  def from_bytes(cls, data, vocabulary):
+    """Rebuild serialised page words, interning them with vocabulary."""
+    count, = WORD_COUNT_HEADER.unpack_from(data)
+    offset = WORD_COUNT_HEADER.size
+    bboxes = np.frombuffer(data, dtype=np.float32, count=count * 4, offset=offset).reshape(count, 4)
+    offset += bboxes.nbytes
+    columns = []
+    for _ in range(3):
+      columns.append(np.frombuffer(data, dtype=np.int32, count=count, offset=offset))
+      offset += count * 4
+    texts = data[offset:].decode("utf-8").split("\0") if count else []
+    return cls(bboxes, *columns, vocabulary.intern(texts), vocabulary)
+
+class TextExtractor:
+
+  def __init__(self, cache=None, metrics=None):
+    """
+    :param cache: Optional RenderCache extracted words are read from and stored in.
+    :param metrics: Optional Metrics the text_extraction stage is timed in.
+    """
+    self.cache = cache
+    self.metrics = metrics or Metrics(enabled=False)
+    self.vocabulary = WordVocabulary()
+
+  def extract_text(self, page):
+    """Extract the words of a PDF page with their positions, through the cache when one is configured."""
+    if len(self.vocabulary) > MAX_VOCABULARY_SIZE:
+      self.vocabulary = WordVocabulary()
+
+    with self.metrics.timer("text_extraction"):
+      cache_key = None
+      if self.cache:
+        cache_key = self.cache.make_key("page_words", page)
+        data = self.cache.get("words", cache_key)
+        if data is not None:
+          return PageWords.from_bytes(data, self.vocabulary)
+
+      page_words = PageWords.from_words(page.get_text("words"), self.vocabulary)
+      if cache_key:
+        self.cache.put(cache_key, page_words.to_bytes())
+      return page_words
@@ -0,0 +1,141 @@
+# PDF Comparer
+# Copyright (C) 2024 Ryan Lacadin
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import difflib
+
+# Tokens occurring more often than this in a region are not used as anchors
+MAX_CHAIN_LENGTH = 64
+
+# Largest region (old length * new length) handed to difflib when no anchor is found
+MAX_FALLBACK_CELLS = 250000
+
+def intern_tokens(*sequences):
+  """
+  Map the tokens of several sequences to shared integer ids.
+  :return: One list of ids per sequence, equal tokens getting equal ids
+  """
+  ids = {}
+  return [[ids.setdefault(token, len(ids)) for token in sequence] for sequence in sequences]
+
+def diff_opcodes(a, b):
+  """
+  Diff two sequences of token ids with a histogram diff.
+  Each region is split at its longest match around the tokens that occur least often in
+  it, so repeated tokens such as table cells and numbers never drive the matching, and
+  the two halves are diffed the same way.
+  :return: List of (tag, i1, i2, j1, j2) opcodes as produced by difflib.SequenceMatcher
+  """
+  opcodes = []
+  stack = [(0, len(a), 0, len(b))]
+  while stack:
+    region = stack.pop()
+    if region[0] == "equal":
+      _append_opcode(opcodes, *region)
+      continue
+
+    a_lo, a_hi, b_lo, b_hi = region
+
+    # Trim the common prefix and suffix
+    prefix_hi = a_lo
+    while a_lo < a_hi and b_lo < b_hi and a[a_lo] == b[b_lo]:
+      a_lo += 1
+      b_lo += 1
+    suffix_lo = a_hi
+    while a_hi > a_lo and b_hi > b_lo and a[a_hi - 1] == b[b_hi - 1]:
+      a_hi -= 1
+      b_hi -= 1
+    suffix_length = suffix_lo - a_hi
+
+    if suffix_length:
+      stack.append(("equal", a_hi, suffix_lo, b_hi, b_hi + suffix_length))
+    if a_lo > prefix_hi:
+      _append_opcode(opcodes, "equal", prefix_hi, a_lo, b_lo - (a_lo - prefix_hi), b_lo)
+
+    if a_lo == a_hi or b_lo == b_hi:
+      _append_opcode(opcodes, "delete" if a_lo < a_hi else "insert", a_lo, a_hi, b_lo, b_hi)
+      continue
+
+    match = _find_anchor(a, a_lo, a_hi, b, b_lo, b_hi)
+    if match is None:
+      for opcode in _fallback_opcodes(a, a_lo, a_hi, b, b_lo, b_hi):
+        _append_opcode(opcodes, *opcode)
+      continue
+
+    # Diff the left side first, then the match, then the right side
+    match_a, match_b, length = match
+    stack.append((match_a + length, a_hi, match_b + length, b_hi))
+    stack.append(("equal", match_a, match_a + length, match_b, match_b + length))
+    stack.append((a_lo, match_a, b_lo, match_b))
+
+  return opcodes
+
+def _find_anchor(a, a_lo, a_hi, b, b_lo, b_hi):
+  """Return (i, j, length) of the longest match around the rarest shared tokens, or None."""
+  occurrences = {}
+  for i in range(a_lo, a_hi):
+    occurrences.setdefault(a[i], []).append(i)
+
+  best = None
+  best_count = MAX_CHAIN_LENGTH + 1
+  j = b_lo
+  while j < b_hi:
+    positions = occurrences.get(b[j])
+    if positions is None or len(positions) > best_count:
+      j += 1
+      continue
+
+    next_j = j + 1
+    for i in positions:
+      start_i, start_j = i, j
+      while start_i > a_lo and start_j > b_lo and a[start_i - 1] == b[start_j - 1]:
+        start_i -= 1
+        start_j -= 1
+      end_i, end_j = i + 1, j + 1
+      while end_i < a_hi and end_j < b_hi and a[end_i] == b[end_j]:
+        end_i += 1
+        end_j += 1
+
+      length = end_i - start_i
+      count = min(len(occurrences[b[k]]) for k in range(start_j, end_j))
+      if best is None or count < best_count or (count == best_count and length > best[2]):
+        best = (start_i, start_j, length)
+        best_count = count
+      next_j = max(next_j, end_j)
+    j = next_j
+
+  return best
+
+def _fallback_opcodes(a, a_lo, a_hi, b, b_lo, b_hi):
+  """Diff a region without a usable anchor, replacing it outright when it is too large."""
+  if (a_hi - a_lo) * (b_hi - b_lo) > MAX_FALLBACK_CELLS:
+    return [("replace", a_lo, a_hi, b_lo, b_hi)]
+  matcher = difflib.SequenceMatcher(None, a[a_lo:a_hi], b[b_lo:b_hi], autojunk=False)
+  return [
+    (tag, i1 + a_lo, i2 + a_lo, j1 + b_lo, j2 + b_lo)
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes()
+  ]
+
+def _append_opcode(opcodes, tag, i1, i2, j1, j2):
+  """Append an opcode, merging it with the previous one where they touch."""
+  if i1 == i2 and j1 == j2:
+    return
+  if opcodes:
+    last_tag, last_i1, last_i2, last_j1, last_j2 = opcodes[-1]
+    if last_i2 == i1 and last_j2 == j1 and (last_tag == tag or "equal" not in (last_tag, tag)):
+      merged_tag = tag if last_tag == tag else "replace"
+      opcodes[-1] = (merged_tag, last_i1, i2, last_j1, j2)
+      return
+  opcodes.append((tag, i1, i2, j1, j2))
@@ -0,0 +1,205 @@
+# PDF Comparer
+# Copyright (C) 2024 Ryan Lacadin
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import math
+from instrumentation import Metrics
+
+# Drawing keys that describe how a path is painted rather than where
+PATH_STYLE_KEYS = (
+  "type", "color", "fill", "width", "closePath", "even_odd", "dashes", "lineCap", "lineJoin",
+  "stroke_opacity", "fill_opacity", "layer",
+)
+
+class Primitive:
+  """
+  One object a page draws: a path, a text span, an image or an annotation. shape describes
+  the object relative to its bbox origin, so the same object drawn elsewhere has the same shape.
+  """
+
+  __slots__ = ("kind", "shape", "origin", "bbox")
+
+  def __init__(self, kind, shape, origin, bbox):
+    self.kind = kind
+    self.shape = shape
+    self.origin = origin
+    self.bbox = bbox
+
+class VectorComparer:
+  """
+  Compare pages by the objects they draw instead of by their pixels. Paths from the display
+  list, text spans, images and annotations are normalised to position independent shapes,
+  objects found unchanged on both pages are paired off, and a grid index over the rest pairs
+  objects whose shape reappears nearby as moved. Only the boxes of the added, removed and
+  moved objects then need to be rasterized.
+  Changes that leave every object the same, such as a different drawing order or a shading,
+  are not seen.
+  """
+
+  def __init__(self, tolerance=0.01, move_radius=72, metrics=None):
+    """
+    :param tolerance: Coordinates closer than this many points are treated as equal.
+    :param move_radius: Objects that reappear within this many points are reported as moved.
+    :param metrics: Optional Metrics the vector_diff stage is timed in.
+    """
+    self.tolerance = tolerance
+    self.move_radius = move_radius
+    self.metrics = metrics or Metrics(enabled=False)
+
+  def quantize(self, value):
+    """Round a coordinate to the tolerance."""
+    return round(value / self.tolerance)
+
+  def relative_points(self, values, x0, y0):
+    """Quantize a flat sequence of x, y values relative to an origin."""
+    return tuple(self.quantize(value - (x0 if index % 2 == 0 else y0)) for index, value in enumerate(values))
+
+  def style(self, values):
+    """Round the floats of a style tuple, so rounding noise does not count as a change."""
+    if isinstance(values, float):
+      return round(values, 4)
+    if isinstance(values, (tuple, list)):
+      return tuple(self.style(value) for value in values)
+    return values
+
+  def extract(self, page):
+    """Return the Primitives a page draws."""
+    primitives = []
+    for drawing in page.get_cdrawings():
+      x0, y0, x1, y1 = drawing["rect"]
+      items = []
+      for operator, *operands in drawing["items"]:
+        values = []
+        extras = []
+        for operand in operands:
+          if isinstance(operand, (tuple, list)) and operand and isinstance(operand[0], (tuple, list)):
+            values.extend(value for point in operand for value in point) # Quad
+          elif isinstance(operand, (tuple, list)):
+            values.extend(operand) # Point or rectangle
+          else:
+            extras.append(operand) # Rectangle orientation
+        items.append((operator, self.relative_points(values, x0, y0), tuple(extras)))
+      style = tuple(self.style(drawing.get(key)) for key in PATH_STYLE_KEYS)
+      # The rect of a path leaves out the half of a stroke that lies outside it
+      grow = (drawing.get("width") or 0) / 2 if "s" in drawing["type"] else 0
+      self.add(primitives, "path", (style, tuple(items)), (x0 - grow, y0 - grow, x1 + grow, y1 + grow))
+
+    for span in page.get_texttrace():
+      x0, y0, x1, y1 = span["bbox"]
+      text = "".join(chr(char[0]) for char in span["chars"])
+      origins = self.relative_points([value for char in span["chars"] for value in char[2]], x0, y0)
+      style = self.style((span["font"], span["size"], span["color"], span["opacity"], span["flags"], span["dir"], span["type"]))
+      self.add(primitives, "text", (style, text, origins), span["bbox"])
+
+    for image in page.get_image_info(hashes=True):
+      a, b, c, d, e, f = image["transform"]
+      self.add(primitives, "image", (image["digest"], self.relative_points((a, b, c, d), 0, 0)), image["bbox"])
+
+    for annot in page.annots():
+      x0, y0, x1, y1 = annot.rect
+      shape = (annot.type[0], self.style(annot.colors), annot.info.get("content"), self.relative_points((x1, y1), x0, y0))
+      self.add(primitives, "annotation", shape, tuple(annot.rect))
+    return primitives
+
+  def add(self, primitives, kind, shape, bbox):
+    """Append a Primitive, skipping objects with an invalid box."""
+    if not all(math.isfinite(value) for value in bbox):
+      return
+    x0, y0, x1, y1 = bbox
+    primitives.append(Primitive(kind, (kind, shape), (self.quantize(x0), self.quantize(y0)), (x0, y0, x1, y1)))
+
+  def compare(self, old_page, new_page):
+    """
+    Match the objects of two pages
+    :return: Dictionary of "added" and "removed" Primitive lists and "moved" (old, new) pairs,
+      or None if the pages cannot be compared this way and need a raster comparison
+    """
+    if old_page.rotation or new_page.rotation or old_page.rect != new_page.rect:
+      return None
+    with self.metrics.timer("vector_diff"):
+      old_primitives = self.extract(old_page)
+      new_primitives = self.extract(new_page)
+
+      # Pair off the objects drawn identically on both pages
+      unmatched_new = {}
+      for primitive in new_primitives:
+        unmatched_new.setdefault((primitive.shape, primitive.origin), []).append(primitive)
+      removed = []
+      for primitive in old_primitives:
+        matches = unmatched_new.get((primitive.shape, primitive.origin))
+        if matches:
+          matches.pop()
+        else:
+          removed.append(primitive)
+      added = [primitive for matches in unmatched_new.values() for primitive in matches]
+
+      moved = self.match_moved(removed, added)
+      moved_old = {id(old) for old, _ in moved}
+      moved_new = {id(new) for _, new in moved}
+      return {
+        "added": [primitive for primitive in added if id(primitive) not in moved_new],
+        "removed": [primitive for primitive in removed if id(primitive) not in moved_old],
+        "moved": moved,
+      }
+
+  def match_moved(self, removed, added):
+    """
+    Pair removed and added objects of the same shape within move_radius of each other, using
+    a grid index of the added objects with cells of move_radius points
+    :return: List of (old Primitive, new Primitive) pairs
+    """
+    cell = self.move_radius
+    grid = {}
+    for primitive in added:
+      x0, y0 = primitive.bbox[:2]
+      grid.setdefault((int(x0 // cell), int(y0 // cell)), []).append(primitive)
+
+    moved = []
+    taken = set()
+    for old in removed:
+      x0, y0 = old.bbox[:2]
+      column, row = int(x0 // cell), int(y0 // cell)
+      best = None
+      best_distance = self.move_radius
+      for neighbour in ((column + dx, row + dy) for dx in (-1, 0, 1) for dy in (-1, 0, 1)):
+        for new in grid.get(neighbour, ()):
+          if new.shape != old.shape or id(new) in taken:
+            continue
+          distance = math.hypot(new.bbox[0] - x0, new.bbox[1] - y0)
+          if distance <= best_distance:
+            best, best_distance = new, distance
+      if best is not None:
+        taken.add(id(best))
+        moved.append((old, best))
+    return moved
+
+def changed_boxes(vector_diff, margin):
+  """Return the boxes in points that need rasterizing to show a vector diff, grown by margin."""
+  boxes = [primitive.bbox for primitive in vector_diff["added"] + vector_diff["removed"]]
+  for old, new in vector_diff["moved"]:
+    boxes += [old.bbox, new.bbox]
+  return [(x0 - margin, y0 - margin, x1 + margin, y1 + margin) for x0, y0, x1, y1 in boxes]
+
+def change_records(vector_diff):
+  """Return the changed objects of a vector diff as JSON-ready dictionaries with boxes in PDF points."""
+  def box(primitive):
+    return [round(value, 2) for value in primitive.bbox]
+  records = [{"change": "added", "kind": primitive.kind, "bbox": box(primitive)} for primitive in vector_diff["added"]]
+  records += [{"change": "removed", "kind": primitive.kind, "bbox": box(primitive)} for primitive in vector_diff["removed"]]
+  records += [
+    {"change": "moved", "kind": new.kind, "bbox": box(new), "from_bbox": box(old)}
+    for old, new in vector_diff["moved"]
+  ]
+  return records
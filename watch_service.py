@@ -0,0 +1,462 @@
+# PDF Comparer
+# Copyright (C) 2024 Ryan Lacadin
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import json
+import time
+import queue
+import select
+import signal
+import socket
+import ctypes
+import ctypes.util
+import threading
+import socketserver
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from process_engine import ProcessEngine
+
+# inotify events that mean a file in a watched directory appeared, changed or went away
+IN_MODIFY = 0x002
+IN_CLOSE_WRITE = 0x008
+IN_MOVED_FROM = 0x040
+IN_MOVED_TO = 0x080
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+WATCH_EVENTS = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+# Bytes at the end of a PDF searched for its end-of-file marker
+PDF_TRAILER_BYTES = 1024
+
+# Finished requests kept for the results API before the oldest are forgotten
+MAX_KEPT_REQUESTS = 1000
+
+class Inotify:
+  """
+  Wake-up source for FolderWatcher using Linux inotify through libc, so changes are picked up
+  as they happen instead of at the next poll. Events are only used as a signal to rescan.
+  """
+
+  def __init__(self, directories):
+    """
+    :param directories: Directories to watch
+    :raises OSError: If inotify is not available
+    """
+    libc_name = ctypes.util.find_library("c")
+    if not libc_name:
+      raise OSError("libc not found")
+    libc = ctypes.CDLL(libc_name, use_errno=True)
+    if not hasattr(libc, "inotify_init1"):
+      raise OSError("inotify is not supported")
+    self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+    if self.fd < 0:
+      raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+    for directory in directories:
+      if libc.inotify_add_watch(self.fd, os.fsencode(directory), WATCH_EVENTS) < 0:
+        error = ctypes.get_errno()
+        os.close(self.fd)
+        raise OSError(error, f"Cannot watch {directory}")
+
+  def wait(self, timeout):
+    """Wait up to timeout seconds for events, discarding them."""
+    readable, _, _ = select.select([self.fd], [], [], timeout)
+    if readable:
+      try:
+        while os.read(self.fd, 65536):
+          pass
+      except BlockingIOError:
+        pass
+
+  def close(self):
+    os.close(self.fd)
+
+class FolderWatcher:
+  """
+  Watch the old and new documents directories for document pairs to compare. A file only
+  counts once it has not been modified for settle_seconds and ends with the %%EOF marker,
+  so pairs are not picked up while they are still being copied in. Changes are noticed
+  through inotify where available and by polling every poll_seconds otherwise.
+  """
+
+  def __init__(self, old_documents_dir, new_documents_dir, settle_seconds=1.0, poll_seconds=1.0):
+    """
+    :param old_documents_dir: Directory of the old documents
+    :param new_documents_dir: Directory of the new documents, with files named like the old ones
+    :param settle_seconds: Seconds a file must stay unmodified before it is compared
+    :param poll_seconds: Seconds between rescans of the directories
+    """
+    self.old_documents_dir = old_documents_dir
+    self.new_documents_dir = new_documents_dir
+    self.settle_seconds = settle_seconds
+    self.poll_seconds = poll_seconds
+    self.reported = {} # File name -> (old state, new state) of the pair when it was last reported
+    self.stopped = threading.Event()
+    try:
+      self.inotify = Inotify([old_documents_dir, new_documents_dir])
+    except OSError as e:
+      print(f"Polling the document directories every {poll_seconds} seconds. Reason: {e}")
+      self.inotify = None
+
+  def file_state(self, file_path, now):
+    """Return the (size, mtime) of a settled, complete PDF, or None if it is not ready."""
+    try:
+      stat = os.stat(file_path)
+      if now - stat.st_mtime < self.settle_seconds or stat.st_size == 0:
+        return None
+      with open(file_path, "rb") as pdf_file:
+        pdf_file.seek(max(0, stat.st_size - PDF_TRAILER_BYTES))
+        if b"%%EOF" not in pdf_file.read():
+          return None
+    except OSError:
+      return None
+    return stat.st_size, stat.st_mtime_ns
+
+  def scan(self):
+    """Return the pairs whose files are both ready and changed since they were last reported."""
+    now = time.time()
+    ready_pairs = []
+    try:
+      names = sorted(name for name in os.listdir(self.old_documents_dir) if name.endswith(".pdf"))
+    except OSError:
+      return ready_pairs
+    for name in names:
+      old_file_path = os.path.join(self.old_documents_dir, name)
+      new_file_path = os.path.join(self.new_documents_dir, name)
+      states = (self.file_state(old_file_path, now), self.file_state(new_file_path, now))
+      if None in states or self.reported.get(name) == states:
+        continue
+      self.reported[name] = states
+      ready_pairs.append((old_file_path, new_file_path))
+    return ready_pairs
+
+  def changes(self):
+    """Yield (old_file_path, new_file_path) for every pair that is ready, until stop is called."""
+    try:
+      while not self.stopped.is_set():
+        yield from self.scan()
+        if self.inotify:
+          self.inotify.wait(self.poll_seconds)
+          # Let a burst of writes end before rescanning
+          self.stopped.wait(min(self.settle_seconds, self.poll_seconds))
+        else:
+          self.stopped.wait(self.poll_seconds)
+    finally:
+      if self.inotify:
+        self.inotify.close()
+        self.inotify = None
+
+  def stop(self):
+    """Make changes return after its current wait, also safe to call from a signal handler."""
+    self.stopped.set()
+
+class ComparisonService:
+  """
+  Long running comparison service. Document pairs are submitted while others are in flight
+  and compared by a warm pool of PDFComparer workers, so a pair does not pay for process
+  start-up, imports and pool creation. A pair submitted again while it is being compared
+  is compared once more afterwards.
+  """
+
+  def __init__(self, comparer):
+    """
+    :param comparer: PDFComparer of the service, whose config the workers are created with
+    """
+    self.comparer = comparer
+    self.comparer.total_comparisons = 0
+    self.incoming = queue.Queue()
+    self.lock = threading.Lock()
+    self.finished = threading.Condition(self.lock)
+    self.requests = OrderedDict() # Request id -> request record
+    self.in_flight = {} # (old_file_path, new_file_path) -> request ids waiting for the running comparison
+    self.queued_again = {} # (old_file_path, new_file_path) -> request ids waiting for the next comparison
+    self.next_id = 1
+    self.dispatcher = None
+    self.executor = None
+
+  def start(self):
+    """Start the worker pool."""
+    if self.comparer.engine == "process":
+      self.dispatcher = threading.Thread(target=self.run_process_engine, daemon=True)
+      self.dispatcher.start()
+    else:
+      self.executor = ThreadPoolExecutor(max_workers=self.comparer.core_count)
+
+  def run_process_engine(self):
+    """Feed submitted pairs to a process engine and finish them as their documents complete."""
+    comparer = self.comparer
+    # Pages only return once their images are written, so a finished request has all of its images
+    engine = ProcessEngine(type(comparer), comparer.config, comparer.core_count, comparer.memory_budget, flush_pages=True)
+    with engine:
+      for job, page_results, elapsed_time in engine.compare_documents([], self.incoming):
+        pair = (job.old_file_path, job.new_file_path)
+        if job.error:
+          self.finish(pair, error=job.error)
+          continue
+        try:
+          summary = comparer.report_document(job.old_file_path, job.plan, page_results, elapsed_time)
+        except Exception as e:
+          self.finish(pair, error=e)
+        else:
+          self.finish(pair, summary)
+
+  def compare_in_thread(self, pair):
+    """Compare a pair with the thread engine, finishing it once its page images are written."""
+    summary = error = None
+    try:
+      summary = self.comparer.compare_pdfs(*pair)
+    except Exception as e:
+      error = e
+    try:
+      self.comparer.flush_page_images(self.comparer.get_output_dir(pair[0]))
+    except OSError as e:
+      error = error or e
+    self.finish(pair, summary, error)
+
+  def stop(self):
+    """Finish the pairs in flight and shut the worker pool down."""
+    if self.dispatcher:
+      self.incoming.put(None)
+      self.dispatcher.join()
+    if self.executor:
+      self.executor.shutdown(wait=True)
+      self.comparer.close_output_writer()
+    if self.comparer.manifest:
+      self.comparer.manifest.save()
+
+  def submit(self, old_file_path, new_file_path):
+    """
+    Queue a document pair for comparison
+    :return: Id of the request, to look its result up with get_request
+    """
+    pair = (old_file_path, new_file_path)
+    with self.lock:
+      request_id = self.next_id
+      self.next_id += 1
+      self.requests[request_id] = {
+        "id": request_id,
+        "old_file": old_file_path,
+        "new_file": new_file_path,
+        "status": "queued",
+        "submitted": time.time(),
+      }
+      if pair in self.in_flight:
+        self.queued_again.setdefault(pair, []).append(request_id)
+        return request_id
+      self.in_flight[pair] = [request_id]
+    self.start_pair(pair)
+    return request_id
+
+  def start_pair(self, pair):
+    """Hand a pair to the workers, or finish it straight away if the manifest shows it is current."""
+    old_file_path, new_file_path = pair
+    try:
+      needs_comparing = self.comparer.prepare_pair(old_file_path, new_file_path)
+    except Exception as e:
+      self.finish(pair, error=e)
+      return
+    if not needs_comparing:
+      entry = self.comparer.manifest.entries[os.path.basename(old_file_path)]
+      self.finish(pair, dict(entry["result"], document=os.path.basename(old_file_path), output=entry["output_dir"], unchanged=True))
+      return
+
+    with self.comparer.lock:
+      self.comparer.total_comparisons += 1
+    if self.executor:
+      self.executor.submit(self.compare_in_thread, pair)
+    else:
+      self.incoming.put((old_file_path, new_file_path, self.comparer.get_output_dir(old_file_path)))
+
+  def finish(self, pair, summary=None, error=None):
+    """Record the outcome of a pair for the requests waiting on it and start a queued rerun."""
+    if error is not None:
+      print(f"Comparison of {pair[0]} failed. Reason: {error}")
+    with self.lock:
+      now = time.time()
+      for request_id in self.in_flight.pop(pair, []):
+        request = self.requests.get(request_id)
+        if request is None:
+          continue
+        request["status"] = "failed" if error is not None else "done"
+        request["latency_seconds"] = round(now - request["submitted"], 3)
+        if error is not None:
+          request["error"] = str(error)
+        else:
+          request["result"] = summary
+      rerun = self.queued_again.pop(pair, None)
+      if rerun:
+        self.in_flight[pair] = rerun
+      self.forget_old_requests()
+      self.finished.notify_all()
+    if self.comparer.manifest:
+      with self.comparer.lock:
+        self.comparer.manifest.save()
+    if rerun:
+      self.start_pair(pair)
+
+  def forget_old_requests(self):
+    """Drop the oldest finished requests beyond MAX_KEPT_REQUESTS. Called under the lock."""
+    finished = [request_id for request_id, request in self.requests.items() if request["status"] in ("done", "failed")]
+    for request_id in finished[:max(0, len(self.requests) - MAX_KEPT_REQUESTS)]:
+      del self.requests[request_id]
+
+  def get_request(self, request_id, timeout=0):
+    """
+    Return a copy of a request record, waiting up to timeout seconds for it to finish
+    :return: Request dictionary, or None if the id is unknown
+    """
+    deadline = time.time() + timeout
+    with self.lock:
+      while True:
+        request = self.requests.get(request_id)
+        if request is None or request["status"] != "queued":
+          break
+        remaining = deadline - time.time()
+        if remaining <= 0:
+          break
+        self.finished.wait(remaining)
+      return dict(request) if request else None
+
+  def status(self):
+    """Return the number of pairs in flight and of requests kept."""
+    with self.lock:
+      return {"in_flight": len(self.in_flight), "requests": len(self.requests), "completed": self.comparer.completed_comparisons}
+
+class ServiceRequestHandler(BaseHTTPRequestHandler):
+  """
+  JSON API of the service:
+    POST /compare {"old_file": path, "new_file": path, "wait": true} compares a pair, returning
+      its request record once done, or straight away with "wait" false
+    GET /requests/<id> returns a request record
+    GET /status returns the number of pairs in flight
+  """
+
+  service = None
+  request_timeout = 600
+
+  def send_json(self, status, body):
+    data = json.dumps(body).encode()
+    self.send_response(status)
+    self.send_header("Content-Type", "application/json")
+    self.send_header("Content-Length", str(len(data)))
+    self.end_headers()
+    self.wfile.write(data)
+
+  def do_GET(self):
+    if self.path == "/status":
+      self.send_json(200, self.service.status())
+      return
+    if self.path.startswith("/requests/"):
+      try:
+        request = self.service.get_request(int(self.path.rsplit("/", 1)[1]))
+      except ValueError:
+        request = None
+      if request is None:
+        self.send_json(404, {"error": "Unknown request"})
+      else:
+        self.send_json(200, request)
+      return
+    self.send_json(404, {"error": f"Unknown path {self.path}"})
+
+  def do_POST(self):
+    if self.path != "/compare":
+      self.send_json(404, {"error": f"Unknown path {self.path}"})
+      return
+    try:
+      body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+      old_file_path, new_file_path = body["old_file"], body["new_file"]
+    except (ValueError, KeyError, TypeError):
+      self.send_json(400, {"error": "Expected a JSON body with old_file and new_file"})
+      return
+    for file_path in (old_file_path, new_file_path):
+      if not os.path.isfile(file_path):
+        self.send_json(400, {"error": f"File not found: {file_path}"})
+        return
+
+    request_id = self.service.submit(old_file_path, new_file_path)
+    if body.get("wait", True):
+      request = self.service.get_request(request_id, timeout=self.request_timeout)
+      self.send_json(200 if request["status"] != "queued" else 202, request)
+    else:
+      self.send_json(202, self.service.get_request(request_id))
+
+  def log_message(self, format, *args):
+    pass # The service prints every comparison already
+
+class UnixHTTPServer(ThreadingHTTPServer):
+  """HTTP server listening on a Unix socket instead of a TCP port."""
+
+  address_family = socket.AF_UNIX
+
+  def server_bind(self):
+    if os.path.exists(self.server_address):
+      os.unlink(self.server_address)
+    socketserver.TCPServer.server_bind(self)
+    self.server_name = "localhost"
+    self.server_port = 0
+
+  def get_request(self):
+    connection, _ = self.socket.accept()
+    return connection, ("unix", 0)
+
+def make_server(service, address):
+  """
+  Create the API server of a service
+  :param address: "host:port" to listen on, or "unix:<path>" for a Unix socket
+  """
+  handler = type("Handler", (ServiceRequestHandler,), {"service": service})
+  if address.startswith("unix:"):
+    return UnixHTTPServer(address[len("unix:"):], handler)
+  host, _, port = address.rpartition(":")
+  return ThreadingHTTPServer((host or "127.0.0.1", int(port)), handler)
+
+def run_service(config):
+  """Watch the document directories and serve the API until interrupted."""
+  from pdfcomparer import PDFComparer
+  # Pairs are compared again whenever their files change, so there is no run to resume
+  comparer = PDFComparer(dict(config, journal=False))
+  service = ComparisonService(comparer)
+  service.start()
+
+  server = None
+  address = config.get("service_address", "127.0.0.1:8765")
+  if address:
+    server = make_server(service, address)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print(f"Serving the comparison API on {address}")
+
+  watcher = FolderWatcher(
+    comparer.old_documents_dir, comparer.new_documents_dir,
+    config.get("watch_settle_seconds", 1.0), config.get("watch_poll_seconds", 1.0),
+  )
+  print(f"Watching {comparer.old_documents_dir} and {comparer.new_documents_dir} for document pairs")
+  signal.signal(signal.SIGTERM, lambda signum, frame: watcher.stop())
+  try:
+    for old_file_path, new_file_path in watcher.changes():
+      service.submit(old_file_path, new_file_path)
+  except KeyboardInterrupt:
+    pass
+  finally:
+    print("Stopping the comparison service")
+    watcher.stop()
+    if server:
+      server.shutdown()
+      server.server_close()
+    service.stop()
+
+if __name__ == "__main__":
+  from pdfcomparer import load_config
+  run_service(load_config())
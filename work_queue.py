@@ -0,0 +1,384 @@
+# PDF Comparer
+# Copyright (C) 2024 Ryan Lacadin
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import json
+import time
+import pickle
+import socket
+import sqlite3
+import threading
+import multiprocessing
+from contextlib import contextmanager
+
+# Attempts a job gets before it is marked failed, counting claims of expired leases
+MAX_ATTEMPTS = 3
+
+# Seconds an idle worker waits before asking for work again while other workers are busy
+IDLE_POLL_SECONDS = 2.0
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS documents (
+  document TEXT PRIMARY KEY,
+  old_file TEXT NOT NULL,
+  new_file TEXT NOT NULL,
+  output_dir TEXT NOT NULL,
+  plan BLOB
+);
+CREATE TABLE IF NOT EXISTS jobs (
+  id INTEGER PRIMARY KEY,
+  document TEXT NOT NULL REFERENCES documents(document),
+  kind TEXT NOT NULL,
+  page_units BLOB,
+  state TEXT NOT NULL DEFAULT 'pending',
+  worker TEXT,
+  lease_expires REAL,
+  attempts INTEGER NOT NULL DEFAULT 0,
+  started REAL,
+  finished REAL,
+  result BLOB,
+  error TEXT
+);
+CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, kind, id);
+"""
+
+class WorkQueue:
+  """
+  Queue of comparison jobs in a SQLite file that processes on many hosts share, e.g. on a
+  network filesystem. Every document pair starts as a "plan" job; the worker that plans it
+  adds one "pages" job per range of page units. Jobs are claimed under an exclusive SQLite
+  transaction, so each is handed to one worker at a time, and held by a lease that the worker
+  renews while it works. A job whose lease ran out, because its worker died, is handed out
+  again, and only the worker holding the lease can complete it, so every job is recorded
+  once. Plans and page results are stored pickled, so the file must only be shared with
+  trusted workers.
+  """
+
+  def __init__(self, path, lease_seconds=300):
+    """
+    :param path: SQLite file of the queue, created if missing
+    :param lease_seconds: Seconds a claimed job is reserved without a renewal. Leases are
+      compared across hosts, so this must be well above their clock differences.
+    """
+    self.path = path
+    self.lease_seconds = lease_seconds
+    self.worker = f"{socket.gethostname()}:{os.getpid()}"
+    # The rollback journal, unlike WAL, only needs file locks and so works on shared filesystems
+    self.connection = sqlite3.connect(path, timeout=60, isolation_level=None, check_same_thread=False)
+    self.lock = threading.Lock()
+    with self.transaction() as cursor:
+      for statement in SCHEMA.split(";"):
+        if statement.strip():
+          cursor.execute(statement)
+
+  @contextmanager
+  def transaction(self):
+    """Run statements in a transaction that holds the write lock of the file from the start."""
+    with self.lock:
+      cursor = self.connection.cursor()
+      cursor.execute("BEGIN IMMEDIATE")
+      try:
+        yield cursor
+      except BaseException:
+        cursor.execute("ROLLBACK")
+        raise
+      cursor.execute("COMMIT")
+
+  def close(self):
+    self.connection.close()
+
+  def add_pairs(self, pairs):
+    """
+    Queue a plan job for every (old_file_path, new_file_path, output_dir) pair not queued yet
+    :return: Number of pairs added
+    """
+    added = 0
+    with self.transaction() as cursor:
+      for old_file_path, new_file_path, output_dir in pairs:
+        document = os.path.basename(old_file_path)
+        cursor.execute(
+          "INSERT OR IGNORE INTO documents (document, old_file, new_file, output_dir) VALUES (?, ?, ?, ?)",
+          (document, os.path.abspath(old_file_path), os.path.abspath(new_file_path), os.path.abspath(output_dir)),
+        )
+        if cursor.rowcount:
+          cursor.execute("INSERT INTO jobs (document, kind) VALUES (?, 'plan')", (document,))
+          added += 1
+    return added
+
+  def claim(self):
+    """
+    Lease the next job: page ranges before plans, so started documents finish first
+    :return: Job dictionary, or None if no job is free
+    """
+    now = time.time()
+    with self.transaction() as cursor:
+      while True:
+        row = cursor.execute(
+          "SELECT jobs.id, jobs.document, jobs.kind, jobs.page_units, jobs.attempts, old_file, new_file, output_dir, plan "
+          "FROM jobs JOIN documents USING (document) "
+          "WHERE state = 'pending' OR (state = 'leased' AND lease_expires < ?) "
+          "ORDER BY kind = 'plan', jobs.id LIMIT 1",
+          (now,),
+        ).fetchone()
+        if row is None:
+          return None
+        job_id, document, kind, page_units, attempts, old_file, new_file, output_dir, plan = row
+        if attempts >= MAX_ATTEMPTS:
+          cursor.execute(
+            "UPDATE jobs SET state = 'failed', worker = NULL, error = COALESCE(error, 'Lease expired') WHERE id = ?",
+            (job_id,),
+          )
+          continue
+        cursor.execute(
+          "UPDATE jobs SET state = 'leased', worker = ?, lease_expires = ?, attempts = attempts + 1, "
+          "started = COALESCE(started, ?) WHERE id = ?",
+          (self.worker, now + self.lease_seconds, now, job_id),
+        )
+        return {
+          "id": job_id,
+          "document": document,
+          "kind": kind,
+          "old_file": old_file,
+          "new_file": new_file,
+          "output_dir": output_dir,
+          "page_units": pickle.loads(page_units) if page_units else None,
+        }
+
+  def renew(self, job_id):
+    """Extend the lease of a job this worker holds. :return: False if the lease was lost."""
+    with self.transaction() as cursor:
+      cursor.execute(
+        "UPDATE jobs SET lease_expires = ? WHERE id = ? AND state = 'leased' AND worker = ?",
+        (time.time() + self.lease_seconds, job_id, self.worker),
+      )
+      return cursor.rowcount == 1
+
+  def complete_plan(self, job_id, document, plan, pages_per_job):
+    """
+    Record the plan of a document and queue its page units in ranges of pages_per_job
+    :return: False if the lease was lost and another worker owns the job
+    """
+    page_units = plan["pages"]
+    stored_plan = dict(plan, pages=[]) # The page units live in the page jobs
+    with self.transaction() as cursor:
+      if not self.finish(cursor, job_id, None):
+        return False
+      cursor.execute("UPDATE documents SET plan = ? WHERE document = ?", (pickle.dumps(stored_plan), document))
+      for start in range(0, len(page_units), pages_per_job):
+        cursor.execute(
+          "INSERT INTO jobs (document, kind, page_units) VALUES (?, 'pages', ?)",
+          (document, pickle.dumps(page_units[start:start + pages_per_job])),
+        )
+    return True
+
+  def complete_pages(self, job_id, page_results):
+    """Record the page results of a page range job. :return: False if the lease was lost."""
+    with self.transaction() as cursor:
+      return self.finish(cursor, job_id, pickle.dumps(page_results))
+
+  def finish(self, cursor, job_id, result):
+    """Mark a job this worker holds as done inside a transaction."""
+    cursor.execute(
+      "UPDATE jobs SET state = 'done', finished = ?, result = ?, lease_expires = NULL "
+      "WHERE id = ? AND state = 'leased' AND worker = ?",
+      (time.time(), result, job_id, self.worker),
+    )
+    return cursor.rowcount == 1
+
+  def fail(self, job_id, error):
+    """Give a job back after an error, or mark it failed once it used up its attempts."""
+    with self.transaction() as cursor:
+      cursor.execute(
+        "UPDATE jobs SET state = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END, "
+        "worker = NULL, lease_expires = NULL, error = ? WHERE id = ? AND state = 'leased' AND worker = ?",
+        (MAX_ATTEMPTS, error, job_id, self.worker),
+      )
+
+  def counts(self):
+    """Return the number of jobs in every state."""
+    with self.lock:
+      return dict(self.connection.execute("SELECT state, COUNT(*) FROM jobs GROUP BY state").fetchall())
+
+  def unfinished(self):
+    """Return the number of jobs still pending or leased."""
+    counts = self.counts()
+    return counts.get("pending", 0) + counts.get("leased", 0)
+
+  def documents(self):
+    """
+    Yield every queued document for merging
+    :return: Generator of (document, old_file, new_file, plan or None, page results, elapsed
+      seconds, error or None)
+    """
+    with self.lock:
+      rows = self.connection.execute("SELECT document, old_file, new_file, plan FROM documents ORDER BY document").fetchall()
+    for document, old_file, new_file, plan in rows:
+      with self.lock:
+        jobs = self.connection.execute(
+          "SELECT kind, state, started, finished, result, error FROM jobs WHERE document = ?", (document,)
+        ).fetchall()
+      page_results = []
+      error = None
+      for kind, state, started, finished, result, job_error in jobs:
+        if state == "failed":
+          error = job_error or "Failed"
+        elif kind == "pages" and result:
+          page_results.extend(pickle.loads(result))
+      page_results.sort(key=lambda page_result: page_result["page"])
+      starts = [job[2] for job in jobs if job[2]]
+      ends = [job[3] for job in jobs if job[3]]
+      elapsed_time = max(ends) - min(starts) if starts and ends else 0
+      yield document, old_file, new_file, pickle.loads(plan) if plan else None, page_results, elapsed_time, error
+
+  def worker_counts(self):
+    """Return the number of jobs every worker completed."""
+    with self.lock:
+      return dict(self.connection.execute(
+        "SELECT worker, COUNT(*) FROM jobs WHERE state = 'done' GROUP BY worker ORDER BY worker"
+      ).fetchall())
+
+class LeaseKeeper:
+  """Renew the lease of a job on a background thread while the job runs."""
+
+  def __init__(self, work_queue, job_id):
+    self.work_queue = work_queue
+    self.job_id = job_id
+    self.lost = False
+    self.stopped = threading.Event()
+    self.thread = threading.Thread(target=self.run, daemon=True)
+
+  def run(self):
+    while not self.stopped.wait(self.work_queue.lease_seconds / 3):
+      try:
+        if not self.work_queue.renew(self.job_id):
+          self.lost = True
+          return
+      except sqlite3.Error as e:
+        print(f"Could not renew the lease of job {self.job_id}. Reason: {e}")
+
+  def __enter__(self):
+    self.thread.start()
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    self.stopped.set()
+    self.thread.join()
+
+def enqueue(comparer, queue_path, pairs):
+  """Queue document pairs for the workers of a queue."""
+  work_queue = WorkQueue(queue_path)
+  added = work_queue.add_pairs((old_path, new_path, comparer.get_output_dir(old_path)) for old_path, new_path in pairs)
+  print(f"Queued {added} of {len(pairs)} document pairs in {queue_path}")
+  work_queue.close()
+
+def run_worker(config, queue_path):
+  """Claim and run jobs from the queue until no work is left."""
+  from pdfcomparer import PDFComparer, open_pdf
+  comparer = PDFComparer(config, clear_output=False)
+  work_queue = WorkQueue(queue_path, config.get("queue_lease_seconds", 300))
+  pages_per_job = config.get("queue_pages_per_job", 16)
+  completed = 0
+  while True:
+    job = work_queue.claim()
+    if job is None:
+      if not work_queue.unfinished():
+        break
+      time.sleep(IDLE_POLL_SECONDS) # Plans in flight may still add page jobs
+      continue
+
+    try:
+      with LeaseKeeper(work_queue, job["id"]), open_pdf(job["old_file"], comparer.metrics) as old_doc, \
+          open_pdf(job["new_file"], comparer.metrics) as new_doc:
+        if job["kind"] == "plan":
+          result = comparer.plan_document(old_doc, new_doc)
+        else:
+          result = [comparer.compare_page(old_doc, new_doc, page_unit, job["output_dir"]) for page_unit in job["page_units"]]
+          # A job only counts as done once its images are on disk
+          if comparer.output_writer:
+            comparer.output_writer.flush()
+    except Exception as e:
+      if comparer.output_writer:
+        try:
+          comparer.output_writer.flush()
+        except OSError:
+          pass # The job is failed either way
+      print(f"Job {job['id']} ({job['kind']} of {job['document']}) failed. Reason: {e}")
+      work_queue.fail(job["id"], f"{type(e).__name__}: {e}")
+      continue
+
+    if job["kind"] == "plan":
+      recorded = work_queue.complete_plan(job["id"], job["document"], result, pages_per_job)
+    else:
+      recorded = work_queue.complete_pages(job["id"], result)
+    if recorded:
+      completed += 1
+    else:
+      print(f"Dropped the result of job {job['id']} of {job['document']}: its lease expired and it was handed out again")
+  work_queue.close()
+  comparer.close_output_writer()
+  print(f"Worker {work_queue.worker} completed {completed} jobs")
+
+def run_workers(config, queue_path, count):
+  """Run count worker processes on this host until the queue is drained."""
+  if count <= 1:
+    run_worker(config, queue_path)
+    return
+  processes = [multiprocessing.Process(target=run_worker, args=(config, queue_path)) for _ in range(count)]
+  for process in processes:
+    process.start()
+  for process in processes:
+    process.join()
+
+def merge(comparer, queue_path):
+  """
+  Assemble the results of a drained queue: report every document like a local run would,
+  writing the PDF reports and results file, and write a summary.json of the whole batch
+  :return: True if every job completed
+  """
+  work_queue = WorkQueue(queue_path)
+  unfinished = work_queue.unfinished()
+  if unfinished:
+    print(f"{unfinished} jobs in {queue_path} are not finished yet, merge once the workers are done")
+    work_queue.close()
+    return False
+
+  documents = list(work_queue.documents())
+  comparer.total_comparisons = len(documents)
+  summaries = []
+  failed = []
+  for document, old_file, new_file, plan, page_results, elapsed_time, error in documents:
+    if error or plan is None:
+      print(f"Comparison of {document} failed. Reason: {error}")
+      failed.append({"document": document, "old_file": old_file, "new_file": new_file, "error": error})
+      continue
+    summaries.append(comparer.report_document(old_file, plan, page_results, elapsed_time))
+
+  summary = {
+    "documents": len(documents),
+    "differences": sum(document_summary["differences"] for document_summary in summaries),
+    "failed": failed,
+    "jobs": work_queue.counts(),
+    "workers": work_queue.worker_counts(),
+    "results": [
+      {key: value for key, value in document_summary.items() if key != "pages"}
+      for document_summary in summaries
+    ],
+  }
+  with open(os.path.join(comparer.output_dir, "summary.json"), "w") as summary_file:
+    json.dump(summary, summary_file, indent=2)
+  work_queue.close()
+  print(f"Merged {len(summaries)} documents, {len(failed)} failed, into {os.path.join(comparer.output_dir, 'summary.json')}")
+  return not failed